@@ -1,14 +1,36 @@
+from contextlib import asynccontextmanager
 from typing import Annotated, Dict, List, Literal, Optional
 
 import uvicorn
-from fastapi import FastAPI, Header, Response
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Header, HTTPException, Response
+from fastapi.responses import (FileResponse, HTMLResponse, PlainTextResponse,
+                               StreamingResponse)
 from pydantic import BaseModel, Field
 
-from page import render
+from page import RenderOptions, browser_pool, job_queue, metrics, render
+from page.artifacts import artifact_store
+from page.cache import s3_stats
+from page.compression import accepts_encoding, decompress_stream
+from page.deadline import DeadlineExceeded
+from page.intercept import block_counters
+from page.localcache import local_cache
+from page.prewarm import SourceNotAllowed, prewarm
+from page.retry import CircuitOpen, circuit_breaker
+from page.subresources import subresource_cache
 from util import config
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    config.log_conf()
+    await browser_pool.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await browser_pool.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 class ReadinessChecks(BaseModel):
@@ -26,20 +48,47 @@ class ReadinessChecks(BaseModel):
     )
 
 
+class ArtifactResponse(BaseModel):
+    sha256: str = Field(description="SHA-256 of the page (its name)")
+    path: str = Field(description="Artifact file path")
+    size: int = Field(description="Bytes")
+
+
 class RenderResponse(BaseModel):
     code: int = Field(200, description="Status Code")
     s3_url: Optional[str] = Field(None, description="S3 cache URL")
     message: Optional[str] = Field(None, description="Exception Information")
     cache_hit: Optional[bool] = Field(None, description="Cache hit")
+    cache_stale: Optional[bool] = Field(
+        None,
+        description="Cache hit was stale (a re-render was queued)"
+    )
     cache_url: Optional[str] = Field(None, description="Cache URL")
     data: Optional[str] = Field(
         None,
         description="Rendered SPA page (DOM dump)"
     )
+    artifact: Optional[ArtifactResponse] = Field(
+        None,
+        description="Rendered page file (render_to_disk, instead of data)"
+    )
+
+
+async def _render_or_5xx(url: str, options: RenderOptions, **kwargs):
+    try:
+        return await render(url, options, **kwargs)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except CircuitOpen as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={'Retry-After': str(int(e.retry_after))}
+        )
 
 
 @app.get('/render')
-def render_get(
+async def render_get(
         url: str,
         add_base_url: bool = None,
         device: str = None,
@@ -49,53 +98,80 @@ def render_get(
         debug: bool = None,
         network_idle_check: bool = None,
         s3_store_pages: bool = None,
+        render_to_disk: bool = None,
         x_spa_renderer_return_cached: Annotated[bool | None, Header()] = None,
+        accept_encoding: Annotated[str | None, Header()] = None,
+        x_spa_renderer_timeout: Annotated[int | None, Header()] = None,
 ) -> Response:
+    timings = metrics.start_timings()
 
-    if network_idle_check is not None:
-        config.set('network_idle_check', network_idle_check)
-    if debug is not None:
-        config.set('debug', debug)
-    if add_base_url is not None:
-        config.set('add_base_url', add_base_url)
-    if user_agent_append is not None:
-        config.set('user_agent_append', user_agent_append)
-    if s3_store_pages is not None:
-        config.set('s3_store_pages', s3_store_pages)
-    if x_spa_renderer_return_cached is not None:
-        config.set('s3_return_cached_pages', x_spa_renderer_return_cached)
-        pass
-
-    page_user_agent = ''
-
-    def on_ready(page):
-        nonlocal page_user_agent
-        page_user_agent = page.evaluate('navigator.userAgent')
-        pass
+    options = RenderOptions.from_config(
+        default_timeout=x_spa_renderer_timeout,
+        network_idle_check=network_idle_check,
+        debug=debug,
+        add_base_url=add_base_url,
+        user_agent_append=user_agent_append,
+        s3_store_pages=s3_store_pages,
+        s3_return_cached_pages=x_spa_renderer_return_cached,
+        render_to_disk=render_to_disk
+    )
 
-    data, cache_hit, _ = render(
+    result = await _render_or_5xx(
         url,
+        options,
         screen=screen,
         user_agent=user_agent,
         device=device,
-        on_ready=on_ready
+        stream=True
     )
 
-    return HTMLResponse(
-        content=data,
-        headers={
-            'Content-Type': 'text/html',
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'X-Spa-Renderer-Cache-Hit': str(cache_hit),
-            'X-Spa-Renderer-User-Agent': page_user_agent
-        }
-    )
+    headers = {
+        'Content-Type': 'text/html',
+        'Cache-Control': 'no-cache, no-store, must-revalidate',
+        'Pragma': 'no-cache',
+        'Vary': 'Accept-Encoding',
+        'X-Spa-Renderer-Cache-Hit': str(result.cache_hit),
+        'X-Spa-Renderer-Cache-Stale': str(result.cache_stale),
+        'X-Spa-Renderer-Deadline-Exceeded': str(result.deadline_exceeded),
+        'X-Spa-Renderer-User-Agent': result.user_agent,
+        'Server-Timing': metrics.server_timing(timings)
+    }
+
+    passthrough = accepts_encoding(accept_encoding, result.content_encoding)
+    if passthrough:
+        # pass the stored (compressed) bytes through as they are
+        headers['Content-Encoding'] = result.content_encoding
+        pass
+
+    if result.artifact:
+        headers['X-Spa-Renderer-Artifact'] = result.artifact.sha256
+        return FileResponse(
+            result.artifact.path,
+            media_type='text/html',
+            headers=headers
+        )
+
+    if result.stream:
+        # S3 cache hit: stream it through, never holding the whole page
+        return StreamingResponse(
+            result.stream if passthrough else decompress_stream(
+                result.stream,
+                result.content_encoding
+            ),
+            media_type='text/html',
+            headers=headers
+        )
+
+    if passthrough:
+        return HTMLResponse(content=result.body, headers=headers)
+
+    return HTMLResponse(content=result.html, headers=headers)
 
 
 @app.post('/render', response_model=RenderResponse)
-def render_post(
+async def render_post(
         url: str,
+        response: Response,
         checks: List[ReadinessChecks] = None,
         extra_headers: Dict[str, str] = None,
         screen: str = None,
@@ -107,46 +183,249 @@ def render_post(
         device: str = None,
         network_idle_check: bool = None,
         s3_store_pages: bool = None,
-        use_cached_pages: bool = None
+        use_cached_pages: bool = None,
+        render_to_disk: bool = None,
+        x_spa_renderer_timeout: Annotated[int | None, Header()] = None
 ):
+    timings = metrics.start_timings()
+    ready_conditions = None
     if checks is not None:
         ready_conditions = [(k.when, k.selectors, k.state) for k in checks]
-        config.set('ready_conditions', ready_conditions)
-    if network_idle_check is not None:
-        config.set('network_idle_check', network_idle_check)
-    if debug is not None:
-        config.set('debug', debug)
-    if add_base_url is not None:
-        config.set('add_base_url', add_base_url)
-    if user_agent_append is not None:
-        config.set('user_agent_append', user_agent_append)
-    if remove_elements is not None:
-        config.set('remove_elements', remove_elements)
-    if extra_headers is not None:
-        config.set('extra_http_headers', extra_headers)
-    if s3_store_pages is not None:
-        config.set('s3_store_pages', s3_store_pages)
-    if use_cached_pages is not None:
-        config.set('s3_return_cached_pages', use_cached_pages)
-    else:
-        config.set('s3_return_cached_pages', False)
         pass
 
-    data, cache_hit, s3_url = render(
+    options = RenderOptions.from_config(
+        default_timeout=x_spa_renderer_timeout,
+        ready_conditions=ready_conditions,
+        network_idle_check=network_idle_check,
+        debug=debug,
+        add_base_url=add_base_url,
+        user_agent_append=user_agent_append,
+        remove_elements=remove_elements,
+        extra_http_headers=extra_headers,
+        s3_store_pages=s3_store_pages,
+        s3_return_cached_pages=bool(use_cached_pages),
+        render_to_disk=render_to_disk
+    )
+
+    result = await _render_or_5xx(
         url,
+        options,
         screen=screen,
         user_agent=user_agent,
         device=device,
     )
 
+    response.headers['Server-Timing'] = metrics.server_timing(timings)
     return RenderResponse(
         code=200,
-        data=data,
-        s3_url=s3_url,
-        cache_hit=cache_hit,
-        cache_url=s3_url
+        data=None if result.artifact else result.html,
+        artifact=result.artifact.to_dict() if result.artifact else None,
+        s3_url=result.s3_url,
+        cache_hit=result.cache_hit,
+        cache_stale=result.cache_stale,
+        cache_url=result.s3_url
     ).model_dump()
 
 
+class BatchRenderRequest(BaseModel):
+    urls: List[str] = Field(description="URLs to render")
+    devices: List[str] = Field(
+        None,
+        description="Render every URL for each of these devices"
+    )
+    priority: int = Field(0, description="Lower values are rendered first")
+    checks: List[ReadinessChecks] = None
+    remove_elements: List[str] = None
+    use_cached_pages: bool = Field(
+        False,
+        description="Skip URLs already in cache rather than re-rendering"
+    )
+    render_to_disk: bool = Field(
+        None,
+        description="Also write the pages to artifact files"
+    )
+
+
+class JobItemResponse(BaseModel):
+    url: str
+    device: Optional[str] = None
+    status: Literal["pending", "running", "done", "failed"]
+    s3_url: Optional[str] = None
+    cache_hit: Optional[bool] = None
+    artifact: Optional[str] = Field(
+        None,
+        description="SHA-256 of the page artifact (render_to_disk)"
+    )
+    message: Optional[str] = Field(None, description="Exception Information")
+    duration: Optional[float] = Field(None, description="Seconds")
+
+
+class JobResponse(BaseModel):
+    id: str
+    status: Literal["queued", "running", "finished"]
+    priority: int
+    created: float
+    finished: Optional[float] = None
+    progress: Dict[str, int]
+    items: List[JobItemResponse]
+
+
+@app.post('/render/batch', response_model=JobResponse)
+async def render_batch(batch: BatchRenderRequest):
+    overrides = dict(
+        s3_store_pages=True,
+        s3_return_cached_pages=batch.use_cached_pages
+    )
+    if batch.checks is not None:
+        overrides['ready_conditions'] = [
+            (k.when, k.selectors, k.state) for k in batch.checks
+        ]
+        pass
+    if batch.remove_elements is not None:
+        overrides['remove_elements'] = batch.remove_elements
+        pass
+    if batch.render_to_disk is not None:
+        overrides['render_to_disk'] = batch.render_to_disk
+        pass
+
+    job = await job_queue.submit(
+        batch.urls,
+        devices=batch.devices,
+        priority=batch.priority,
+        overrides=overrides
+    )
+    return job.to_dict()
+
+
+@app.get('/jobs/{job_id}', response_model=JobResponse)
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='job not found')
+    return job.to_dict()
+
+
+class PrewarmRequest(BaseModel):
+    sources: List[str] = Field(
+        description="sitemap.xml, sitemap index or URL list http(s) URLs"
+    )
+    devices: List[str] = Field(
+        None,
+        description="Devices to render for (default: prewarm_devices)"
+    )
+    priority: int = Field(0, description="Lower values are rendered first")
+    force: bool = Field(
+        False,
+        description="Re-render pages even if their cached copy is up to date"
+    )
+
+
+class PrewarmResponse(BaseModel):
+    skipped: int = Field(description="URLs whose cached copy is up to date")
+    job: JobResponse
+
+
+@app.post('/prewarm', response_model=PrewarmResponse)
+async def prewarm_cache(request: PrewarmRequest):
+    try:
+        job, skipped = await prewarm(
+            request.sources,
+            job_queue,
+            devices=request.devices,
+            force=request.force,
+            priority=request.priority
+        )
+    except SourceNotAllowed as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return dict(skipped=skipped, job=job.to_dict())
+
+
+@app.get('/artifacts/{sha256}')
+async def get_artifact(sha256: str, meta: bool = False) -> Response:
+    artifact = artifact_store.get(sha256)
+    if artifact is None:
+        raise HTTPException(status_code=404, detail='artifact not found')
+    if meta:
+        return FileResponse(artifact.meta_path, media_type='application/json')
+    return FileResponse(artifact.path, media_type='text/html')
+
+
+@app.get('/stats')
+async def stats():
+    return dict(
+        browser_pool=browser_pool.stats(),
+        job_queue=job_queue.stats(),
+        interception=block_counters.stats(),
+        subresource_cache=subresource_cache.stats(),
+        artifacts=artifact_store.stats(),
+        circuit_breaker=circuit_breaker.stats()
+    )
+
+
+BROWSER_PAGES = metrics.Gauge(
+    'spa_renderer_browser_pages_active',
+    'Pages open per pooled browser',
+    ('browser',)
+)
+JOBS_QUEUED = metrics.Gauge(
+    'spa_renderer_batch_items_queued',
+    'Batch job items waiting for a worker'
+)
+LOCAL_CACHE = metrics.Gauge(
+    'spa_renderer_local_cache',
+    'Local page cache tier counters and sizes',
+    ('tier', 'stat')
+)
+SUBRESOURCE_CACHE = metrics.Gauge(
+    'spa_renderer_subresource_cache',
+    'Subresource cache counters and sizes',
+    ('tier', 'stat')
+)
+BLOCKED_REQUESTS = metrics.Gauge(
+    'spa_renderer_blocked_requests',
+    'Requests aborted by the interception policy',
+    ('rule',)
+)
+S3_CONNECTIONS = metrics.Gauge(
+    'spa_renderer_s3_client',
+    'Shared S3 client connection pool stats',
+    ('stat',)
+)
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics_endpoint():
+    for i, browser in enumerate(browser_pool.stats()):
+        BROWSER_PAGES.set(browser['active'], browser=i)
+        pass
+    JOBS_QUEUED.set(job_queue.stats()['queued'])
+    for tier, tier_stats in local_cache.stats().items():
+        for stat, value in tier_stats.items():
+            LOCAL_CACHE.set(value, tier=tier, stat=stat)
+            pass
+        pass
+    subresources = subresource_cache.stats()
+    for tier in ('memory', 'disk'):
+        for stat, value in subresources.pop(tier).items():
+            SUBRESOURCE_CACHE.set(value, tier=tier, stat=stat)
+            pass
+        pass
+    for stat, value in subresources.items():
+        if value is not None:
+            SUBRESOURCE_CACHE.set(value, tier='', stat=stat)
+            pass
+        pass
+    for rule, value in block_counters.stats()['blocked'].items():
+        BLOCKED_REQUESTS.set(value, rule=rule)
+        pass
+    for stat, value in s3_stats().items():
+        S3_CONNECTIONS.set(value, stat=stat)
+        pass
+    return PlainTextResponse(
+        metrics.exposition(),
+        media_type='text/plain; version=0.0.4'
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,144 @@
+"""
+Fixture SPA: an HTML shell whose JS bundle fetches the page data from
+a (slow) API, builds the DOM and then flags the page as ready with
+`<body data-ready="true">`.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlparse
+
+BUNDLE_VERSION = '3f2a9c1e'
+
+SHELL = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Fixture SPA</title>
+<link rel="stylesheet" href="/static/css/main.css">
+<script src="https://www.googletagmanager.com/gtag/js?id=G-1" async></script>
+</head>
+<body>
+<div id="root"><div data-test="loading-image">Loading...</div></div>
+<script src="/static/js/main.%s.js"></script>
+</body>
+</html>
+''' % BUNDLE_VERSION
+
+APP_JS = '''
+(async () => {
+    const path = location.pathname + location.search;
+    const response = await fetch('/api/page?path=' + encodeURIComponent(path));
+    const page = await response.json();
+    const root = document.getElementById('root');
+    const h1 = document.createElement('h1');
+    h1.textContent = page.title;
+    const list = document.createElement('ul');
+    for (const item of page.items) {
+        const li = document.createElement('li');
+        li.className = 'item';
+        li.innerHTML = '<img src="/static/img/' + item.id + '.png" alt="">'
+            + '<a href="/page/' + item.id + '">' + item.name + '</a>'
+            + '<p>' + item.description + '</p>';
+        list.appendChild(li);
+    }
+    root.replaceChildren(h1, list);
+    document.body.dataset.ready = 'true';
+})();
+'''
+
+CSS = 'body { font-family: sans-serif; } .item { margin: 4px; }\n'
+
+# 1x1 transparent PNG
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44'
+    'ae426082'
+)
+
+
+class FixtureConfig(NamedTuple):
+    api_latency_ms: int = 200
+    bundle_kb: int = 512
+    dom_size: int = 200
+
+
+def _handler(conf: FixtureConfig):
+    padding = '/*%s*/\n' % ('x' * max(conf.bundle_kb * 1024 - 5, 0))
+    bundle = (padding + APP_JS).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body: bytes, content_type: str,
+                  cache_control: str = 'no-cache'):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+                pass
+            pass
+
+        def do_HEAD(self):
+            self.do_GET()
+            pass
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            path = parsed.path
+            if path.startswith('/static/js/'):
+                self._send(
+                    bundle,
+                    'application/javascript',
+                    'public, max-age=31536000, immutable'
+                )
+            elif path.startswith('/static/css/'):
+                self._send(
+                    CSS.encode('utf-8'),
+                    'text/css',
+                    'public, max-age=31536000, immutable'
+                )
+            elif path.startswith('/static/img/'):
+                self._send(PNG, 'image/png', 'public, max-age=86400')
+            elif path == '/api/page':
+                time.sleep(conf.api_latency_ms / 1000)
+                page = parse_qs(parsed.query).get('path', ['/'])[0]
+                self._send(
+                    json.dumps(dict(
+                        title=f'Fixture page {page}',
+                        items=[
+                            dict(
+                                id=i,
+                                name=f'Item {i}',
+                                description=f'Description of item {i}'
+                            )
+                            for i in range(conf.dom_size)
+                        ]
+                    )).encode('utf-8'),
+                    'application/json'
+                )
+            elif path == '/' or path.startswith('/page/'):
+                self._send(SHELL.encode('utf-8'), 'text/html')
+            else:
+                self.send_error(404)
+                pass
+            pass
+
+    return Handler
+
+
+def start(port: int = 0, conf: FixtureConfig = FixtureConfig()) \
+        -> ThreadingHTTPServer:
+    """Serve the fixture SPA from a background thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _handler(conf))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
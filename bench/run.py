@@ -0,0 +1,418 @@
+"""
+Benchmark driver: starts the fixture SPA, the S3 stand-in and the app
+(as a subprocess, configured through environment overrides), drives
+GET and POST /render at the given concurrency and reports throughput,
+latency percentiles, Server-Timing phase averages, peak RSS and
+Chromium process count - as JSON, optionally compared to a previous
+run.
+
+    python -m bench.run --requests 50 --concurrency 4 -o bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Union
+
+import httpx
+
+from . import fixture, s3stub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+READY_CONDITIONS = [['body', ['body[data-ready="true"]'], 'attached']]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], p: float) -> Union[float, None]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(round(p / 100 * len(values))) - 1, 0)]
+
+
+class ProcessTreeSampler:
+    """Samples the RSS and Chromium process count of a process tree"""
+
+    def __init__(self, pid: int, interval: float = 0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_chromium = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        pass
+
+    @staticmethod
+    def _processes() -> Dict[int, tuple]:
+        processes = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    stat = f.read()
+                    pass
+                with open(f'/proc/{name}/statm') as f:
+                    rss = int(f.read().split()[1]) * PAGE_SIZE
+                    pass
+            except OSError:
+                continue
+            comm = stat[stat.index('(') + 1:stat.rindex(')')]
+            ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+            processes[int(name)] = (ppid, comm, rss)
+            pass
+        return processes
+
+    def sample(self):
+        processes = self._processes()
+        tree = {self.pid}
+        grew = True
+        while grew:
+            grew = False
+            for pid, (ppid, _, _) in processes.items():
+                if ppid in tree and pid not in tree:
+                    tree.add(pid)
+                    grew = True
+                    pass
+                pass
+            pass
+        rss = sum(processes[p][2] for p in tree if p in processes)
+        chromium = sum(
+            1 for p in tree
+            if p in processes and (
+                'chrom' in processes[p][1] or 'headless' in processes[p][1]
+            )
+        )
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_chromium = max(self.peak_chromium, chromium)
+        pass
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+            pass
+        pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        pass
+
+
+def _parse_server_timing(header: str) -> Dict[str, float]:
+    timings = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        if params.startswith('dur='):
+            timings[name] = float(params[4:])
+            pass
+        pass
+    return timings
+
+
+async def _request(
+        client: httpx.AsyncClient,
+        scenario: str,
+        url: str
+) -> httpx.Response:
+    if scenario == 'post':
+        return await client.post('/render', params=dict(url=url), json=dict(
+            checks=[
+                dict(when=w, selectors=s, state=st)
+                for w, s, st in READY_CONDITIONS
+            ]
+        ))
+    return await client.get(
+        '/render',
+        params=dict(url=url, s3_store_pages=scenario == 'get-cached'),
+        headers={
+            'x-spa-renderer-return-cached':
+                '1' if scenario == 'get-cached' else '0',
+            'accept-encoding': 'gzip'
+        }
+    )
+
+
+async def run_scenario(
+        app_url: str,
+        fixture_url: str,
+        scenario: str,
+        requests: int,
+        concurrency: int,
+        pages: int
+) -> Dict[str, Any]:
+    def page_url(i: int) -> str:
+        if scenario == 'get-cached':
+            return f'{fixture_url}/page/{i % pages}'
+        # unique URLs: no cache hits, no coalesced renders
+        return f'{fixture_url}/page/{i % pages}?bench={time.time_ns()}'
+
+    latencies: List[float] = []
+    phases: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    cache_hits = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=app_url, timeout=300) as client:
+        if scenario == 'get-cached':  # warm up the cache
+            await asyncio.gather(*[
+                _request(client, scenario, page_url(i)) for i in range(pages)
+            ])
+            pass
+
+        async def one(i: int):
+            nonlocal cache_hits
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await _request(client, scenario, page_url(i))
+                except httpx.HTTPError as e:
+                    key = type(e).__name__
+                    errors[key] = errors.get(key, 0) + 1
+                    return
+                latency = (time.perf_counter() - started) * 1000
+                pass
+            if response.status_code != 200:
+                key = str(response.status_code)
+                errors[key] = errors.get(key, 0) + 1
+                return
+            latencies.append(latency)
+            if response.headers.get('x-spa-renderer-cache-hit') == 'True' \
+                    or (scenario == 'post' and response.json()['cache_hit']):
+                cache_hits += 1
+                pass
+            for name, ms in _parse_server_timing(
+                    response.headers.get('server-timing', '')
+            ).items():
+                phases.setdefault(name, []).append(ms)
+                pass
+            pass
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        elapsed = time.perf_counter() - started
+        pass
+
+    return dict(
+        requests=requests,
+        concurrency=concurrency,
+        errors=errors,
+        cache_hits=cache_hits,
+        elapsed=round(elapsed, 3),
+        throughput=round(len(latencies) / elapsed, 3),
+        latency_ms=dict(
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            mean=sum(latencies) / len(latencies) if latencies else None,
+            max=max(latencies, default=None)
+        ),
+        phases_ms={
+            name: round(sum(values) / len(values), 1)
+            for name, values in sorted(phases.items())
+        }
+    )
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT,
+            text=True,
+            stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _start_app(port: int, env: Dict[str, str]) -> subprocess.Popen:
+    app = subprocess.Popen(
+        [
+            sys.executable, '-m', 'uvicorn', 'app:app',
+            '--host', '127.0.0.1',
+            '--port', str(port),
+            '--log-level', 'warning'
+        ],
+        cwd=ROOT,
+        env=dict(os.environ, **env)
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if app.poll() is not None:
+            raise RuntimeError(f'app exited with status {app.returncode}')
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/stats').status_code == 200:
+                return app
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+        pass
+    app.terminate()
+    raise RuntimeError('app did not start within 60s')
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Relative changes from a previous run"""
+    lines = []
+    for scenario, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if not previous:
+            continue
+        for label, now, before in [
+            ('throughput', current['throughput'], previous['throughput']),
+            *[
+                (f'latency {p}', current['latency_ms'][p],
+                 previous['latency_ms'][p])
+                for p in ('p50', 'p95', 'p99')
+            ]
+        ]:
+            if now is None or not before:
+                continue
+            lines.append(
+                f'{scenario:12} {label:12} {before:10.1f} -> {now:10.1f} '
+                f'({(now - before) / before * 100:+.1f}%)'
+            )
+            pass
+        pass
+    for label in ('peak_rss_mb', 'peak_chromium_processes'):
+        if baseline.get(label):
+            lines.append(
+                f'{label:25} {baseline[label]:10} -> {results[label]:10}'
+            )
+            pass
+        pass
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SPA Renderer benchmark')
+    parser.add_argument('-n', '--requests', type=int, default=40)
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument(
+        '-s', '--scenario',
+        action='append',
+        choices=['get', 'post', 'get-cached'],
+        help='scenarios to run (repeatable, default: all)'
+    )
+    parser.add_argument(
+        '--pages',
+        type=int,
+        default=20,
+        help='distinct fixture pages'
+    )
+    parser.add_argument('--api-latency-ms', type=int, default=200)
+    parser.add_argument('--bundle-kb', type=int, default=512)
+    parser.add_argument(
+        '--dom-size',
+        type=int,
+        default=200,
+        help='list items per page'
+    )
+    parser.add_argument(
+        '-e', '--env',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='app config override, e.g. -e BROWSER_POOL_SIZE=2'
+    )
+    parser.add_argument('-o', '--output', help='write the results here')
+    parser.add_argument(
+        '-b', '--baseline',
+        help='previous results to compare with'
+    )
+    args = parser.parse_args()
+
+    site = fixture.start(conf=fixture.FixtureConfig(
+        api_latency_ms=args.api_latency_ms,
+        bundle_kb=args.bundle_kb,
+        dom_size=args.dom_size
+    ))
+    s3 = s3stub.start()
+    fixture_url = 'http://127.0.0.1:%d' % site.server_address[1]
+    port = _free_port()
+    env = dict(
+        S3_ENDPOINT='http://127.0.0.1:%d' % s3.server_address[1],
+        S3_ADDRESSING_STYLE='path',
+        S3_BUCKET_NAME='bench',
+        S3_ACCESS_KEY='bench',
+        S3_SECRET_KEY='bench',
+        READY_CONDITIONS=json.dumps(READY_CONDITIONS),
+        # @BASE_URL@ has no port
+        NETWORK_IDLE_REQUESTS_URL_PATTERN=r'^@BASE_URL@(:\d+)?(/|\?|$)'
+    )
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key.upper()] = value
+        pass
+
+    app = _start_app(port, env)
+    scenarios = {}
+    try:
+        with ProcessTreeSampler(app.pid) as sampler:
+            for scenario in args.scenario or ['get', 'post', 'get-cached']:
+                print(f'running {scenario}...', file=sys.stderr)
+                scenarios[scenario] = asyncio.run(run_scenario(
+                    f'http://127.0.0.1:{port}',
+                    fixture_url,
+                    scenario,
+                    args.requests,
+                    args.concurrency,
+                    args.pages
+                ))
+                pass
+            sampler.sample()
+            pass
+        app_stats = httpx.get(f'http://127.0.0.1:{port}/stats').json()
+    finally:
+        app.terminate()
+        app.wait(30)
+        site.shutdown()
+        s3.shutdown()
+        pass
+
+    results = dict(
+        commit=_git_commit(),
+        date=datetime.now(timezone.utc).isoformat(),
+        args=vars(args),
+        env=env,
+        scenarios=scenarios,
+        peak_rss_mb=round(sampler.peak_rss / 2 ** 20, 1),
+        peak_chromium_processes=sampler.peak_chromium,
+        s3=s3.stub.stats(),
+        app_stats=app_stats
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            pass
+        pass
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+            pass
+        print('\n'.join(compare(results, baseline)), file=sys.stderr)
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
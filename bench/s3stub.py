@@ -0,0 +1,196 @@
+"""
+Minimal in-memory S3 stand-in (path-style addressing, no auth):
+GET/HEAD/PUT/DELETE of objects, with metadata, content encoding and
+(conditional) server-side copies - what page.cache uses.
+"""
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, NamedTuple
+from urllib.parse import unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class S3Object(NamedTuple):
+    body: bytes
+    headers: Dict[str, str]  # content-type, content-encoding, x-amz-meta-*
+    modified: float
+
+
+_STORED_HEADERS = ('content-type', 'content-encoding', 'cache-control')
+
+
+def _decode_aws_chunked(data: bytes) -> bytes:
+    """Body of an `aws-chunked` (streaming, checksum trailer) upload"""
+    body = bytearray()
+    while data:
+        header, _, data = data.partition(b'\r\n')
+        size = int(header.split(b';')[0], 16)
+        if size == 0:
+            break
+        body += data[:size]
+        data = data[size + 2:]  # chunk + CRLF
+        pass
+    return bytes(body)
+
+
+class S3Stub:
+    def __init__(self):
+        self.objects: Dict[str, S3Object] = {}
+        self.requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        pass
+
+    def count(self, method: str):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            pass
+        pass
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return dict(
+                objects=len(self.objects),
+                bytes=sum(len(o.body) for o in self.objects.values()),
+                requests=dict(self.requests)
+            )
+
+
+def _handler(stub: S3Stub):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _key(self) -> str:
+            return unquote(urlparse(self.path).path.lstrip('/'))
+
+        def _reply(self, status: int, body: bytes = b'',
+                   headers: Dict[str, str] = None):
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+                pass
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+                pass
+            pass
+
+        def _error(self, status: int, code: str):
+            self._reply(
+                status,
+                b'' if self.command == 'HEAD' else (
+                    '<?xml version="1.0" encoding="UTF-8"?>'
+                    f'<Error><Code>{code}</Code>'
+                    f'<Resource>{escape(self._key())}</Resource></Error>'
+                ).encode('utf-8'),
+                {'Content-Type': 'application/xml'}
+            )
+            pass
+
+        def _read_body(self) -> bytes:
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            encoding = self.headers.get('Content-Encoding', '')
+            if 'aws-chunked' in encoding or \
+                    self.headers.get('x-amz-content-sha256', '') \
+                    .startswith('STREAMING-'):
+                data = _decode_aws_chunked(data)
+                pass
+            return data
+
+        def _request_headers(self) -> Dict[str, str]:
+            headers = {}
+            for k, v in self.headers.items():
+                k = k.lower()
+                if k == 'content-encoding':
+                    v = ','.join(
+                        e for e in v.split(',')
+                        if e.strip() and e.strip() != 'aws-chunked'
+                    )
+                    if not v:
+                        continue
+                    pass
+                if k in _STORED_HEADERS or k.startswith('x-amz-meta-'):
+                    headers[k] = v
+                    pass
+                pass
+            return headers
+
+        def do_GET(self):
+            stub.count(self.command)
+            obj = stub.objects.get(self._key())
+            if obj is None:
+                self._error(404, 'NoSuchKey')
+                return
+            self._reply(200, obj.body, dict(
+                obj.headers,
+                **{
+                    'ETag': '"%s"' % hashlib.md5(obj.body).hexdigest(),
+                    'Last-Modified': formatdate(obj.modified, usegmt=True)
+                }
+            ))
+            pass
+
+        def do_HEAD(self):
+            self.do_GET()
+            pass
+
+        def do_PUT(self):
+            stub.count(self.command)
+            body = self._read_body()
+            source = self.headers.get('x-amz-copy-source')
+            headers = self._request_headers()
+            if source:
+                src = stub.objects.get(unquote(source).lstrip('/'))
+                if src is None:
+                    self._error(404, 'NoSuchKey')
+                    return
+                if_match = self.headers.get('x-amz-copy-source-if-match')
+                if if_match and if_match != \
+                        '"%s"' % hashlib.md5(src.body).hexdigest():
+                    self._error(412, 'PreconditionFailed')
+                    return
+                if self.headers.get('x-amz-metadata-directive') != 'REPLACE':
+                    headers = src.headers
+                    pass
+                body = src.body
+                pass
+            stub.objects[self._key()] = S3Object(body, headers, time.time())
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if source:
+                self._reply(200, (
+                    '<?xml version="1.0" encoding="UTF-8"?>'
+                    f'<CopyObjectResult><ETag>{escape(etag)}</ETag>'
+                    '<LastModified>'
+                    f'{time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())}'
+                    '</LastModified></CopyObjectResult>'
+                ).encode('utf-8'), {'Content-Type': 'application/xml'})
+            else:
+                self._reply(200, headers={'ETag': etag})
+                pass
+            pass
+
+        def do_DELETE(self):
+            stub.count(self.command)
+            stub.objects.pop(self._key(), None)
+            self._reply(204)
+            pass
+
+    return Handler
+
+
+def start(port: int = 0) -> ThreadingHTTPServer:
+    """Serve an empty S3 stand-in from a background thread; the S3Stub
+    is available as `server.stub`"""
+    stub = S3Stub()
+    server = ThreadingHTTPServer(('127.0.0.1', port), _handler(stub))
+    server.daemon_threads = True
+    server.stub = stub
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
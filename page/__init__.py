@@ -1,3 +1,14 @@
-from .render import ReadyCondition, render
+from .browserpool import browser_pool
+from .jobs import job_queue
+from .options import RenderOptions
+from .render import RenderResult, render
+from .waitready import ReadyCondition
 
-__all__ = ['render', 'ReadyCondition']
+__all__ = [
+    'render',
+    'ReadyCondition',
+    'RenderOptions',
+    'RenderResult',
+    'browser_pool',
+    'job_queue'
+]
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple, Union
+
+from util import config
+from util.get_logger import get_logger
+
+from .contenthash import content_slices
+
+logger = get_logger(__name__)
+
+# seconds between two prunes of the artifact directory
+PRUNE_INTERVAL = 60
+
+
+class Artifact(NamedTuple):
+    """A rendered page on disk, named by the SHA-256 of its content
+    (content_hash(): without volatile meta tags)"""
+    sha256: str
+    path: str
+    size: int
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.splitext(self.path)[0] + '.json'
+
+    def meta(self) -> Dict[str, Any]:
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def chunks(self, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+                pass
+            pass
+        pass
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(sha256=self.sha256, path=self.path, size=self.size)
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of rendered pages: `<dir>/<aa>/<sha256>.html`
+    (UTF-8), each with a `<sha256>.json` metadata sidecar listing the
+    renders (url, device, time) which produced it.
+
+    The DOM dump is encoded and hashed in slices on its way to disk, so
+    no full encoded copy of it is ever held in memory. The hash leaves
+    out the render timestamp meta tag: a render whose content is already
+    stored only adds itself to the sidecar (the file keeps the timestamp
+    of the first render).
+
+    Artifacts not rendered again for `max_age` seconds are removed, and
+    so are the least recently rendered ones past `max_bytes` in total
+    (0: no bound), at most every PRUNE_INTERVAL seconds.
+    """
+
+    def __init__(
+            self,
+            directory: str = None,
+            max_renders: int = 32,
+            max_bytes: int = None,
+            max_age: int = None
+    ):
+        self.directory = directory if directory is not None \
+            else config.get('artifact_dir')
+        self.max_renders = max_renders  # kept per sidecar
+        self.max_bytes = max_bytes if max_bytes is not None \
+            else config.get('artifact_max_bytes')
+        self.max_age = max_age if max_age is not None \
+            else config.get('artifact_max_age')
+        self.written = 0
+        self.deduplicated = 0
+        self.pruned = 0
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        pass
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256 + '.html')
+
+    def get(self, sha256: str) -> Union[Artifact, None]:
+        if len(sha256) != 64 or \
+                not all(c in '0123456789abcdef' for c in sha256):
+            return None
+        path = self.path(sha256)
+        try:
+            return Artifact(sha256, path, os.path.getsize(path))
+        except OSError:
+            return None
+
+    def write(self, html: str, meta: Dict[str, str]) -> Artifact:
+        """Store a DOM dump (if new), and record `meta` (the render)"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for text, hashed in content_slices(html):
+                    chunk = text.encode('utf-8')
+                    if hashed:
+                        digest.update(chunk)
+                        pass
+                    f.write(chunk)
+                    size += len(chunk)
+                    pass
+                pass
+            sha256 = digest.hexdigest()
+            artifact = Artifact(sha256, self.path(sha256), size)
+            os.makedirs(os.path.dirname(artifact.path), exist_ok=True)
+            with self._lock:
+                if os.path.exists(artifact.path):
+                    os.unlink(tmp_path)
+                    self.deduplicated += 1
+                    logger.debug('artifacts: %s: already stored', sha256)
+                    # its size is that of the first render
+                    artifact = artifact._replace(
+                        size=os.path.getsize(artifact.path)
+                    )
+                    os.utime(artifact.path)  # recently rendered
+                else:
+                    os.replace(tmp_path, artifact.path)
+                    self.written += 1
+                    pass
+                self._add_render(artifact, meta)
+                pass
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+                pass
+            raise
+        self._maybe_prune()
+        return artifact
+
+    def _add_render(self, artifact: Artifact, meta: Dict[str, str]):
+        try:
+            sidecar = artifact.meta()
+        except (OSError, ValueError):
+            sidecar = dict(
+                sha256=artifact.sha256,
+                size=artifact.size,
+                content_type='text/html; charset=utf-8',
+                renders=[]
+            )
+            pass
+        sidecar['renders'] = \
+            (sidecar['renders'] + [meta])[-self.max_renders:]
+        tmp_path = artifact.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(sidecar, f, indent=2)
+            pass
+        os.replace(tmp_path, artifact.meta_path)
+        pass
+
+    def _maybe_prune(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._pruned_at < PRUNE_INTERVAL:
+                return
+            self._pruned_at = now
+            pass
+        try:
+            self.prune()
+        except OSError as e:
+            logger.warning('artifacts: prune failed: %s', e)
+            pass
+        pass
+
+    def prune(self) -> int:
+        """Remove old artifacts (see the class doc), and leftover
+        temporary files; returns the number of artifacts removed"""
+        if not self.max_bytes and not self.max_age:
+            return 0
+        now = time.time()
+        artifacts: List[Tuple[float, int, str]] = []  # (mtime, size, path)
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.html'):
+                    artifacts.append((st.st_mtime, st.st_size, path))
+                elif name.endswith('.tmp') and self.max_age \
+                        and now - st.st_mtime > self.max_age:
+                    self._unlink(path)
+                    pass
+                pass
+            pass
+        artifacts.sort(reverse=True)  # most recently rendered first
+        total = 0
+        removed = 0
+        with self._lock:
+            for mtime, size, path in artifacts:
+                total += size
+                if (self.max_age and now - mtime > self.max_age) or \
+                        (self.max_bytes and total > self.max_bytes):
+                    try:
+                        if os.stat(path).st_mtime != mtime:
+                            continue  # rendered again since
+                    except OSError:
+                        continue
+                    self._unlink(path)
+                    self._unlink(os.path.splitext(path)[0] + '.json')
+                    removed += 1
+                    pass
+                pass
+            self.pruned += removed
+            pass
+        if removed:
+            logger.info('artifacts: pruned %d artifact(s)', removed)
+            pass
+        return removed
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            written=self.written,
+            deduplicated=self.deduplicated,
+            pruned=self.pruned
+        )
+
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,427 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Set, Union
+from urllib.parse import urlparse
+
+from playwright.async_api import (Browser, BrowserContext, Frame, Page,
+                                  Playwright, async_playwright)
+
+from util import config
+from util.get_logger import get_logger
+
+from .context import device_index, get_browser_context
+from .metrics import phase
+from .options import RenderOptions
+from .retry import ContextLost
+
+logger = get_logger(__name__)
+
+# Site data cleared from a reused context (the HTTP cache is kept, but
+# is only used by renders without request routing, see BrowserPool)
+CLEARED_STORAGE_TYPES = ','.join([
+    'cookies',
+    'local_storage',
+    'indexeddb',
+    'websql',
+    'service_workers',
+    'cache_storage',
+    'file_systems'
+])
+CONTEXT_RESET_TIMEOUT = 5
+
+
+def _process_rss(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def context_key(device_conf: dict, options: RenderOptions) -> str:
+    """Identity of a context profile: the resolved device configuration
+    (final user agent included) and the extra HTTP headers"""
+    return json.dumps(
+        dict(
+            device_conf,
+            extra_http_headers=dict(options.extra_http_headers)
+        ),
+        sort_keys=True,
+        default=str
+    )
+
+
+def _origin(url: str) -> Union[str, None]:
+    parsed_url = urlparse(url)
+    if parsed_url.scheme not in ('http', 'https'):
+        return None
+    return f'{parsed_url.scheme}://{parsed_url.netloc}'
+
+
+class PooledContext:
+    def __init__(self, context: BrowserContext, key: str):
+        self.context = context
+        self.key = key
+        self.renders = 0
+        self.lost = False  # crashed: never reused
+        # origins the frames of its pages navigated to since the last
+        # reset (including pages and frames already gone)
+        self.origins: Set[str] = set()
+        context.on('page', self._track)
+        pass
+
+    def _track(self, page: Page):
+        page.on('framenavigated', self._navigated)
+        pass
+
+    def _navigated(self, frame: Frame):
+        origin = _origin(frame.url)
+        if origin:
+            self.origins.add(origin)
+            pass
+        pass
+
+    async def reset(self):
+        """Drop the state the last render left behind: pages, cookies,
+        permissions and the site data of every origin it visited"""
+        pages = list(self.context.pages)
+        origins = self.origins | {
+            o for p in pages for f in p.frames
+            for o in [_origin(f.url)] if o
+        }
+        self.origins = set()
+        if origins:
+            if not pages:
+                # the CDP session needs a page of the context
+                pages = [await self.context.new_page()]
+                pass
+            cdp = await self.context.new_cdp_session(pages[0])
+            try:
+                for origin in origins:
+                    await cdp.send('Storage.clearDataForOrigin', dict(
+                        origin=origin,
+                        storageTypes=CLEARED_STORAGE_TYPES
+                    ))
+                    pass
+            finally:
+                await cdp.detach()
+                pass
+            pass
+        for page in pages:
+            await page.close()
+            pass
+        await self.context.clear_cookies()
+        await self.context.clear_permissions()
+        pass
+
+    async def close(self):
+        try:
+            await self.context.close()
+        except Exception as e:
+            logger.debug('browser_pool: error closing context: %s', e)
+            pass
+        pass
+
+
+class PooledBrowser:
+    def __init__(self, browser: Browser):
+        self.browser = browser
+        self.renders = 0
+        self.active = 0
+        self.retired = False
+        # context key -> idle contexts, ready for reuse (least recently
+        # used profile first)
+        self.contexts: Dict[str, List[PooledContext]] = {}
+        pass
+
+    def idle_contexts(self) -> int:
+        return sum(len(c) for c in self.contexts.values())
+
+    def healthy(self) -> bool:
+        return self.browser.is_connected()
+
+    async def rss(self) -> int:
+        """Total resident memory (bytes) of all chromium processes
+        (browser, renderers, gpu, utility) belonging to this browser"""
+        try:
+            cdp = await self.browser.new_browser_cdp_session()
+            try:
+                info = await cdp.send('SystemInfo.getProcessInfo')
+            finally:
+                await cdp.detach()
+                pass
+        except Exception as e:
+            logger.debug('browser_pool: could not read process info: %s', e)
+            return 0
+        return sum(
+            _process_rss(int(p['id'])) for p in info.get('processInfo', [])
+        )
+
+
+class BrowserPool:
+    """
+    Long-lived, warm Chromium instances shared by all renders.
+
+    Every browser serves at most `browser_max_pages` concurrent renders;
+    `browser_context()` waits for a free slot on the least busy browser.
+
+    Contexts are kept per profile (device configuration and headers)
+    and handed out exclusively, so renders with the same profile reuse
+    a context, reset after its previous render, rather than creating
+    one. Their HTTP cache is kept too, but Playwright disables it in
+    pages with request routing (request blocking, subresource cache):
+    only renders without routes get a warm cache. A context is closed
+    after `context_max_renders` renders (0: a fresh context for every
+    render); a browser keeps at most `browser_max_pages` idle contexts.
+    """
+
+    def __init__(
+            self,
+            size: int = None,
+            max_pages: int = None,
+            max_renders: int = None,
+            max_rss_mb: int = None,
+            context_max_renders: int = None
+    ):
+        self.size = size or config.get('browser_pool_size')
+        self.max_pages = max_pages or config.get('browser_max_pages')
+        self.max_renders = max_renders if max_renders is not None \
+            else config.get('browser_max_renders')
+        self.max_rss_mb = max_rss_mb if max_rss_mb is not None \
+            else config.get('browser_max_rss_mb')
+        self.context_max_renders = context_max_renders \
+            if context_max_renders is not None \
+            else config.get('context_max_renders')
+        self.headless = not config.get('debug')
+        self.playwright: Union[Playwright, None] = None
+        # read once: playwright.devices builds a new copy on every access
+        self.devices: dict = {}
+        self.browsers: List[PooledBrowser] = []
+        self._start_lock = asyncio.Lock()
+        self._available = asyncio.Condition()
+        pass
+
+    async def start(self):
+        async with self._start_lock:
+            if self.playwright:
+                return
+            self.playwright = await async_playwright().start()
+            self.devices = self.playwright.devices
+            device_index(self.devices)
+            self.browsers = [
+                PooledBrowser(await self._launch()) for _ in range(self.size)
+            ]
+            pass
+        logger.info(
+            'browser_pool: started %d browser(s) (headless=%s, max_pages=%d)',
+            self.size,
+            self.headless,
+            self.max_pages
+        )
+        pass
+
+    async def stop(self):
+        async with self._start_lock:
+            if not self.playwright:
+                return
+            for pooled in self.browsers:
+                await self._close(pooled)
+                pass
+            self.browsers = []
+            await self.playwright.stop()
+            self.playwright = None
+            pass
+        logger.info('browser_pool: stopped')
+        pass
+
+    def stats(self) -> List[Dict[str, int]]:
+        return [
+            dict(
+                renders=b.renders,
+                active=b.active,
+                idle_contexts=b.idle_contexts(),
+                connected=b.healthy()
+            )
+            for b in self.browsers
+        ]
+
+    @asynccontextmanager
+    async def browser_context(
+            self,
+            options: RenderOptions,
+            device_conf: dict
+    ) -> AsyncIterator[BrowserContext]:
+        """Hand out an isolated context (reused or new) on a pooled
+        browser"""
+        await self.start()
+
+        with phase('browser'):
+            if options.debug and self.headless:
+                # headed debug sessions get a dedicated, short-lived browser
+                pooled = PooledBrowser(await self._launch(headless=False))
+                pooled.retired = True
+                pooled.active = 1
+            else:
+                pooled = await self._checkout()
+                pass
+            pass
+
+        try:
+            with phase('context'):
+                pooled_context = await self._checkout_context(
+                    pooled,
+                    context_key(device_conf, options),
+                    device_conf,
+                    options
+                )
+                pass
+            try:
+                yield pooled_context.context
+            except ContextLost:
+                pooled_context.lost = True
+                raise
+            finally:
+                await self._checkin_context(pooled, pooled_context)
+                pass
+        finally:
+            await self._checkin(pooled)
+            pass
+        pass
+
+    async def _checkout_context(
+            self,
+            pooled: PooledBrowser,
+            key: str,
+            device_conf: dict,
+            options: RenderOptions
+    ) -> PooledContext:
+        idle = pooled.contexts.get(key)
+        if idle:
+            pooled_context = idle.pop()
+            if not idle:
+                del pooled.contexts[key]
+                pass
+            return pooled_context
+        return PooledContext(
+            await get_browser_context(pooled.browser, device_conf, options),
+            key
+        )
+
+    async def _checkin_context(
+            self,
+            pooled: PooledBrowser,
+            pooled_context: PooledContext
+    ):
+        pooled_context.renders += 1
+        if pooled_context.lost and not pooled.retired \
+                and not pooled.healthy():
+            await self._retire(pooled, 'browser disconnected')
+            pass
+        if pooled.retired or pooled_context.lost \
+                or not self.context_max_renders \
+                or pooled_context.renders >= self.context_max_renders:
+            await pooled_context.close()
+            return
+        try:
+            async with asyncio.timeout(CONTEXT_RESET_TIMEOUT):
+                await pooled_context.reset()
+                pass
+        except Exception as e:
+            logger.debug('browser_pool: could not reset context: %s', e)
+            await pooled_context.close()
+            return
+        # most recently used profile last
+        idle = pooled.contexts.pop(pooled_context.key, [])
+        idle.append(pooled_context)
+        pooled.contexts[pooled_context.key] = idle
+        while pooled.idle_contexts() > self.max_pages:
+            key = next(iter(pooled.contexts))
+            evicted = pooled.contexts[key].pop(0)
+            if not pooled.contexts[key]:
+                del pooled.contexts[key]
+                pass
+            await evicted.close()
+            pass
+        pass
+
+    async def _launch(self, headless: bool = None) -> Browser:
+        if headless is None:
+            headless = self.headless
+            pass
+        return await self.playwright.chromium.launch(headless=headless)
+
+    @staticmethod
+    async def _close(pooled: PooledBrowser):
+        pooled.contexts = {}
+        try:
+            await pooled.browser.close()
+        except Exception as e:
+            logger.debug('browser_pool: error closing browser: %s', e)
+            pass
+        pass
+
+    async def _retire(self, pooled: PooledBrowser, reason: str):
+        """Swap in a fresh browser; the old one is closed once idle"""
+        if pooled.retired:
+            return
+        pooled.retired = True
+        logger.info(
+            'browser_pool: recycling browser after %d render(s): %s',
+            pooled.renders,
+            reason
+        )
+        fresh = PooledBrowser(await self._launch())
+        async with self._available:
+            self.browsers[self.browsers.index(pooled)] = fresh
+            self._available.notify_all()
+            pass
+        pass
+
+    async def _checkout(self) -> PooledBrowser:
+        while True:
+            async with self._available:
+                await self._available.wait_for(
+                    lambda: any(
+                        b.active < self.max_pages for b in self.browsers
+                    )
+                )
+                pooled = min(self.browsers, key=lambda b: b.active)
+                pooled.active += 1
+                pass
+            if pooled.healthy():
+                return pooled
+            await self._retire(pooled, 'health check failed')
+            await self._checkin(pooled)
+            pass
+
+    async def _checkin(self, pooled: PooledBrowser):
+        pooled.active -= 1
+        pooled.renders += 1
+
+        if not pooled.retired:
+            if self.max_renders and pooled.renders >= self.max_renders:
+                await self._retire(pooled, 'max renders reached')
+            elif self.max_rss_mb:
+                rss_mb = await pooled.rss() / (1024 * 1024)
+                if rss_mb > self.max_rss_mb:
+                    await self._retire(pooled, 'rss %dMB > %dMB' % (
+                        rss_mb,
+                        self.max_rss_mb
+                    ))
+                    pass
+                pass
+            pass
+
+        if pooled.retired and pooled.active == 0:
+            await self._close(pooled)
+            pass
+
+        async with self._available:
+            self._available.notify_all()
+            pass
+        pass
+
+
+browser_pool = BrowserPool()
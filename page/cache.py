@@ -1,29 +1,128 @@
 import re
-from typing import Tuple, Union
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Dict, Iterator, NamedTuple, Tuple, Union
 from urllib.parse import parse_qs, urlencode, urlparse
 
 import boto3
 from botocore.client import BaseClient
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
 from util import config, get_logger
 
+from .artifacts import Artifact
+from .compression import (compress, compress_stream, decompress,
+                          supported_encodings)
+from .contenthash import content_hash
+from .localcache import local_cache
+from .metrics import PAGE_BYTES, PAGE_STORES, phase
+
 logger = get_logger(__name__)
 
+_s3_client: Union[BaseClient, None] = None
+_s3_client_lock = threading.Lock()
+
+# compressed artifacts are uploaded from memory up to this size,
+# from a temporary file past it
+STORE_SPOOL_BYTES = 1 << 22
+
+TIMESTAMP_META_RE = re.compile(
+    r'<meta name="x-spa-renderer-timestamp" content="([^"]+)"'
+)
+
+
+class StoredContent(NamedTuple):
+    hash: str
+    content_encoding: str
+    etag: Union[str, None]  # None: unknown
+
+
+class ContentIndex:
+    """Content hash, encoding and ETag of recently stored or fetched
+    pages, by object name (a bounded LRU). Other instances may have
+    changed the objects since: only trust it for conditional requests"""
+
+    def __init__(self, max_entries: int = 65536):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, StoredContent] = OrderedDict()
+        self._lock = threading.Lock()
+        pass
+
+    def get(self, object_name: str) -> Union[StoredContent, None]:
+        with self._lock:
+            entry = self._entries.get(object_name)
+            if entry is not None:
+                self._entries.move_to_end(object_name)
+                pass
+            return entry
+
+    def put(
+            self,
+            object_name: str,
+            hash_: str,
+            content_encoding: str,
+            etag: str = None
+    ):
+        if not hash_:
+            return
+        with self._lock:
+            known = self._entries.get(object_name)
+            if etag is None and known is not None and \
+                    known[:2] == (hash_, content_encoding):
+                etag = known.etag  # same content, e.g. from the local cache
+                pass
+            self._entries[object_name] = \
+                StoredContent(hash_, content_encoding, etag)
+            self._entries.move_to_end(object_name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                pass
+            pass
+        pass
+
+    def delete(self, object_name: str):
+        with self._lock:
+            self._entries.pop(object_name, None)
+            pass
+        pass
+
+
+content_index = ContentIndex()
+
+
+# (config generation, compiled pattern) of the ignored query params
+_ignore_params: Tuple[int, Union[re.Pattern, None]] = (0, None)
+
+
+def _ignore_params_re() -> Union[re.Pattern, None]:
+    """The ignored query params, as one (cached) alternation regex"""
+    global _ignore_params
+    generation, pattern = _ignore_params
+    if generation != config.generation:
+        ignore_params = [
+            *config.get('s3_ignore_query_params'),
+            *config.get('s3_ignore_query_params_extra')
+        ]
+        pattern = re.compile(
+            '(?:%s)$' % '|'.join(f'(?:{i})' for i in ignore_params)
+        ) if ignore_params else None
+        _ignore_params = (config.generation, pattern)
+        pass
+    return pattern
+
 
 def _ignore_query_params(query) -> str:
+    if not query:
+        return ''
     parsed_query = parse_qs(query)
-    ignore_params = [
-        *config.get('s3_ignore_query_params'),
-        *config.get('s3_ignore_query_params_extra')
-    ]
-    keys = list(parsed_query.keys())
-    for i in ignore_params:
-        ignore_pattern = re.compile(f'^{i}$')
-        for k in keys:
+    ignore_pattern = _ignore_params_re()
+    if ignore_pattern is not None:
+        for k in list(parsed_query.keys()):
             if ignore_pattern.match(k):
                 del parsed_query[k]
-                break
                 pass
             pass
         pass
@@ -39,72 +138,573 @@ def _extract_host_and_path(url):
     return hostname, path + query_sep + query
 
 
-def _s3_config(device, url) -> Tuple[str, str, BaseClient, str, str]:
-    s3_endpoint = config.get('s3_endpoint')
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=config.get('s3_access_key'),
-        aws_secret_access_key=config.get('s3_secret_key'),
-        endpoint_url=f'https://{s3_endpoint}',
-        config=Config(signature_version='s3v4')
-    )
-    bucket_name = config.get('s3_bucket_name')
+def cache_key(device: str, url: str) -> str:
+    """S3 object name of a page: host + device + path (w/o ignored params)"""
     hostname, path = _extract_host_and_path(url)
     if path and path[-1] == '/':
         path = path[0:-1]  # strip trailing '/' from S3 storage key
     pass
-    object_name = hostname + '/' + device.replace(' ', '').lower() + path
+    return hostname + '/' + device.replace(' ', '').lower() + path
+
+
+def s3_client() -> BaseClient:
+    """
+    The process-wide S3 client.
+
+    Created once (boto3 clients are thread-safe) so credentials,
+    endpoint resolution and keep-alive connections are reused by
+    every cache lookup and store
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=config.get('s3_access_key'),
+                    aws_secret_access_key=config.get('s3_secret_key'),
+                    endpoint_url=_s3_endpoint_url(),
+                    config=Config(
+                        signature_version='s3v4',
+                        max_pool_connections=config.get(
+                            's3_max_pool_connections'
+                        ),
+                        connect_timeout=config.get('s3_connect_timeout'),
+                        read_timeout=config.get('s3_read_timeout'),
+                        tcp_keepalive=True,
+                        s3=dict(
+                            addressing_style=config.get('s3_addressing_style')
+                        ),
+                        retries=dict(
+                            mode=config.get('s3_retry_mode'),
+                            max_attempts=config.get('s3_max_attempts')
+                        )
+                    )
+                )
+                pass
+            pass
+        pass
+    return _s3_client
+
+
+def s3_stats() -> Dict[str, int]:
+    """Connection reuse stats of the shared S3 client's HTTP pools"""
+    stats = dict(pools=0, connections=0, requests=0)
+    if _s3_client is None:
+        return stats
+    try:
+        # botocore does not expose its urllib3 PoolManager publicly
+        pools = _s3_client._endpoint.http_session._manager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['pools'] += 1
+            stats['connections'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+            pass
+    except (AttributeError, KeyError) as e:
+        logger.debug('s3_stats: connection pool stats unavailable: %s', e)
+        pass
+    return stats
+
+
+def _s3_config(device, url) -> Tuple[str, str, BaseClient, str, str]:
+    s3_endpoint = config.get('s3_endpoint')
+    s3 = s3_client()
+    bucket_name = config.get('s3_bucket_name')
+    object_name = cache_key(device, url)
     logger.debug(
         '_s3_config: object=%s, endpoint=%s, bucket=%s',
         object_name,
         s3_endpoint,
         bucket_name
     )
+    return bucket_name, object_name, s3, s3_endpoint, _s3_url(object_name)
+
+
+def _s3_endpoint_url() -> str:
+    s3_endpoint = config.get('s3_endpoint')
+    if '://' in s3_endpoint:  # e.g. a local S3 stand-in: http://localhost:9000
+        return s3_endpoint
+    return f'https://{s3_endpoint}'
+
+
+def _s3_url(object_name: str) -> str:
     obj_path = object_name.replace(' ', '%20')
-    s3_url = f'https://{bucket_name}.{s3_endpoint}/{obj_path}'
-    return bucket_name, object_name, s3, s3_endpoint, s3_url
+    s3_endpoint = config.get('s3_endpoint')
+    bucket_name = config.get('s3_bucket_name')
+    if '://' in s3_endpoint:
+        return f'{s3_endpoint}/{bucket_name}/{obj_path}'
+    return f'https://{bucket_name}.{s3_endpoint}/{obj_path}'
 
 
-def get_page(device: str, url: str) -> Tuple[Union[str, None], str]:
-    bucket_name, object_name, s3, _, s3_url = _s3_config(device, url)
+def cached_at(device: str, url: str) -> Union[datetime, None]:
+    """Render time of the cached copy of a page (None if not cached)"""
+    object_name = cache_key(device, url)
+    entry = local_cache.get(object_name)
+    if entry and entry.meta.get('rendered-at'):
+        return datetime.fromisoformat(entry.meta['rendered-at'])
+
+    bucket_name, object_name, s3, _, _ = _s3_config(device, url)
+    try:
+        head = s3.head_object(Bucket=bucket_name, Key=object_name)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            logger.warning('cached_at: error on %s: %s', object_name, e)
+            pass
+        return None
+    value = (head.get('Metadata') or {}).get('rendered-at')
     try:
-        obj = s3.get_object(
-            Bucket=bucket_name,
-            Key=object_name
+        return datetime.fromisoformat(value) if value \
+            else head.get('LastModified')
+    except ValueError:
+        return head.get('LastModified')
+
+
+class CachedPage(NamedTuple):
+    body: bytes  # as stored, i.e. possibly compressed
+    content_encoding: str
+    s3_url: str
+    rendered_at: Union[datetime, None]
+    ttl: int  # seconds, 0: never stale
+    stream: Union[Iterator[bytes], None] = None  # instead of `body`
+    s3_body: Any = None  # the S3 response body `stream` reads
+
+    @property
+    def html(self) -> str:
+        """Decoded page (consumes `stream`, if any)"""
+        body = b''.join(self.stream) if self.stream else self.body
+        return decompress(body, self.content_encoding).decode('utf-8')
+
+    def close(self):
+        """Release the underlying S3 connection of an unconsumed stream
+        (closing a never started generator does not run its `finally`,
+        so the body is closed here too)"""
+        if self.stream:
+            self.stream.close()
+            pass
+        if self.s3_body is not None:
+            self.s3_body.close()
+            pass
+        pass
+
+    def age(self) -> Union[float, None]:
+        if self.rendered_at is None:
+            return None
+        return (datetime.now(timezone.utc) - self.rendered_at).total_seconds()
+
+    def stale(self) -> bool:
+        if not self.ttl:
+            return False
+        age = self.age()
+        return age is None or age > self.ttl
+
+
+def _freshness_meta(rendered_at: datetime, ttl: int) -> Dict[str, str]:
+    return {
+        'rendered-at': rendered_at.isoformat(),
+        'ttl': str(ttl)
+    }
+
+
+def _cached_page(
+        body: bytes,
+        content_encoding: str,
+        meta: Dict[str, str],
+        s3_url: str,
+        stream: Iterator[bytes] = None,
+        s3_body: Any = None
+) -> CachedPage:
+    rendered_at = meta.get('rendered-at')
+    if not rendered_at and not stream:
+        # objects stored before freshness metadata: use the render meta tag
+        html = decompress(body, content_encoding).decode('utf-8')
+        m = TIMESTAMP_META_RE.search(html)
+        rendered_at = m.group(1) if m else None
+        pass
+    try:
+        rendered_at = datetime.fromisoformat(rendered_at) \
+            if rendered_at else None
+    except ValueError:
+        rendered_at = None
+        pass
+    ttl = meta.get('ttl')
+    return CachedPage(
+        body,
+        content_encoding,
+        s3_url,
+        rendered_at,
+        int(ttl) if ttl else config.get('s3_cache_ttl'),
+        stream,
+        s3_body
+    )
+
+
+def _stream_body(
+        obj: dict,
+        object_name: str,
+        local_meta: Dict[str, str]
+) -> Iterator[bytes]:
+    """
+    Yield an S3 object body in chunks. Bodies small enough for the
+    local cache tier are kept (only) until the end of the stream
+    """
+    body = obj['Body']
+    keep = [] if local_cache.accepts(obj.get('ContentLength') or 0) else None
+    try:
+        for chunk in body.iter_chunks(config.get('s3_stream_chunk_size')):
+            if keep is not None:
+                keep.append(chunk)
+                pass
+            yield chunk
+            pass
+        if keep is not None:
+            local_cache.put(object_name, b''.join(keep), local_meta)
+            pass
+    finally:
+        body.close()
+        pass
+
+
+def get_page(
+        device: str,
+        url: str,
+        stream: bool = False
+) -> Union[CachedPage, None]:
+    """
+    Cached page, if any. With `stream`, a page coming from S3 is
+    returned as a chunk `stream` (to be consumed or closed) instead
+    of being read in memory
+    """
+    object_name = cache_key(device, url)
+    entry = local_cache.get(object_name)
+    if entry:
+        logger.debug('get_page: object %s found in local cache', object_name)
+        content_index.put(
+            object_name,
+            entry.meta.get('content-hash'),
+            entry.meta.get('content-encoding', ''),
+            entry.meta.get('etag')
         )
+        return _cached_page(
+            entry.body,
+            entry.meta.get('content-encoding', ''),
+            entry.meta,
+            _s3_url(object_name)
+        )
+
+    bucket_name, object_name, s3, _, s3_url = _s3_config(device, url)
+    try:
+        with phase('s3_get'):
+            obj = s3.get_object(
+                Bucket=bucket_name,
+                Key=object_name
+            )
+            pass
 
     except s3.exceptions.NoSuchKey:
         logger.debug('get_page: object %s not found in S3 cache', object_name)
-        return None, s3_url
+        return None
     except Exception as e:
         logger.exception('get_page: error retrieving %s: %s', object_name, e)
-        return None, s3_url
+        return None
     else:
         logger.debug(
             'get_page: object %s retrieved from S3 cache',
             object_name
         )
-        return obj['Body'].read().decode('utf-8'), s3_url
+        content_encoding = obj.get('ContentEncoding') or ''
+        meta = obj.get('Metadata') or {}
+        content_index.put(
+            object_name,
+            meta.get('content-hash'),
+            content_encoding,
+            obj.get('ETag')
+        )
+        local_meta = dict(
+            meta,
+            **{'content-encoding': content_encoding, 'etag': obj.get('ETag')}
+        )
+        if stream:
+            return _cached_page(
+                b'',
+                content_encoding,
+                meta,
+                s3_url,
+                _stream_body(obj, object_name, local_meta),
+                obj['Body']
+            )
+        with phase('s3_read'):
+            body = obj['Body'].read()
+            pass
+        local_cache.put(object_name, body, local_meta)
+        return _cached_page(body, content_encoding, meta, s3_url)
+
+
+def _content_encoding() -> str:
+    content_encoding = config.get('s3_content_encoding')
+    if content_encoding not in supported_encodings():
+        if content_encoding:
+            logger.warning(
+                'store_page: unsupported s3_content_encoding %s',
+                content_encoding
+            )
+            pass
+        content_encoding = ''
+        pass
+    return content_encoding
 
 
-def store_page(html_data: str, url: str, device: str) -> str:
+def store_page(
+        html_data: str,
+        url: str,
+        device: str,
+        rendered_at: datetime = None,
+        ttl: int = None,
+        hash_: str = None
+) -> str:
+    """
+    Store a rendered page, unless the stored copy has the same content
+    (`hash_`, see content_hash()): then only its freshness metadata is
+    refreshed
+    """
+    hash_ = hash_ or content_hash(html_data)
+    content_encoding = _content_encoding()
+    s3_url = _refresh_unchanged(
+        hash_,
+        content_encoding,
+        url,
+        device,
+        rendered_at,
+        ttl
+    )
+    if s3_url is not None:
+        return s3_url
+    with phase('compress'):
+        body = compress(html_data.encode('utf-8'), content_encoding)
+        pass
+    return _put_page(
+        body,
+        len(body),
+        content_encoding,
+        hash_,
+        url,
+        device,
+        rendered_at,
+        ttl
+    )
+
+
+def store_artifact(
+        artifact: Artifact,
+        url: str,
+        device: str,
+        rendered_at: datetime = None,
+        ttl: int = None,
+        hash_: str = None
+) -> str:
+    """
+    store_page() of a render artifact: compressed chunk by chunk into a
+    temporary file (spilling to disk past `STORE_SPOOL_BYTES`), which
+    is uploaded
+    """
+    hash_ = hash_ or artifact.sha256  # artifacts are named by content_hash()
+    content_encoding = _content_encoding()
+    s3_url = _refresh_unchanged(
+        hash_,
+        content_encoding,
+        url,
+        device,
+        rendered_at,
+        ttl
+    )
+    if s3_url is not None:
+        return s3_url
+    with tempfile.SpooledTemporaryFile(max_size=STORE_SPOOL_BYTES) as body:
+        with phase('compress'):
+            for chunk in compress_stream(
+                    artifact.chunks(config.get('s3_stream_chunk_size')),
+                    content_encoding
+            ):
+                body.write(chunk)
+                pass
+            pass
+        size = body.tell()
+        body.seek(0)
+        return _put_page(
+            body,
+            size,
+            content_encoding,
+            hash_,
+            url,
+            device,
+            rendered_at,
+            ttl
+        )
+
+
+def _stored_content(
+        s3: BaseClient,
+        bucket_name: str,
+        object_name: str
+) -> Union[StoredContent, None]:
+    """Content hash, encoding and ETag of a stored page (None: unknown),
+    from the content index if its ETag is known, else from S3"""
+    known = content_index.get(object_name)
+    if known is not None and known.etag:
+        return known
+    try:
+        with phase('s3_head'):
+            head = s3.head_object(Bucket=bucket_name, Key=object_name)
+            pass
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            logger.warning('store_page: error checking %s: %s', object_name, e)
+            pass
+        return None
+    known = StoredContent(
+        (head.get('Metadata') or {}).get('content-hash'),
+        head.get('ContentEncoding') or '',
+        head.get('ETag')
+    )
+    content_index.put(object_name, *known)
+    return known
+
+
+def _refresh_unchanged(
+        hash_: str,
+        content_encoding: str,
+        url: str,
+        device: str,
+        rendered_at: Union[datetime, None],
+        ttl: Union[int, None]
+) -> Union[str, None]:
+    """
+    If the stored copy of a page has the same content, refresh its
+    freshness metadata with a server-side copy onto itself (no upload)
+    and return its URL. None: the page is to be uploaded.
+
+    The copy is conditional on the ETag the content was seen with, so
+    that a page changed meanwhile (e.g. by another instance) is never
+    marked fresh: it is uploaded instead.
+    """
+    if not config.get('s3_skip_unchanged'):
+        return None
+    bucket_name, object_name, s3, _, s3_url = _s3_config(device, url)
+    known = _stored_content(s3, bucket_name, object_name)
+    if known is None or not known.etag or \
+            known[:2] != (hash_, content_encoding):
+        return None
+    meta = _page_meta(rendered_at, ttl, hash_)
+    extra_args = dict(ContentEncoding=content_encoding) \
+        if content_encoding else {}
+    try:
+        with phase('s3_copy'):
+            result = s3.copy_object(
+                Bucket=bucket_name,
+                Key=object_name,
+                CopySource=dict(Bucket=bucket_name, Key=object_name),
+                CopySourceIfMatch=known.etag,
+                MetadataDirective='REPLACE',
+                ContentType='text/html',
+                ACL='public-read',
+                Metadata=meta,
+                **extra_args
+            )
+            pass
+    except Exception as e:
+        error = getattr(e, 'response', None) or {}
+        if error.get('Error', {}).get('Code') in ('412', 'PreconditionFailed'):
+            logger.debug('store_page: %s changed, uploading it', object_name)
+        else:
+            logger.warning(
+                'store_page: could not refresh %s, uploading it: %s',
+                object_name,
+                e
+            )
+            pass
+        content_index.delete(object_name)
+        return None
+    etag = (result.get('CopyObjectResult') or {}).get('ETag')
+    content_index.put(object_name, hash_, content_encoding, etag)
+    entry = local_cache.get(object_name)
+    if entry:
+        local_cache.put(
+            object_name,
+            entry.body,
+            dict(
+                meta,
+                **{'content-encoding': content_encoding, 'etag': etag}
+            )
+        )
+        pass
+    PAGE_STORES.inc(result='unchanged')
+    logger.debug('store_page: %s unchanged, metadata refreshed', object_name)
+    return s3_url
+
+
+def _page_meta(
+        rendered_at: Union[datetime, None],
+        ttl: Union[int, None],
+        hash_: str
+) -> Dict[str, str]:
+    return dict(
+        _freshness_meta(
+            rendered_at or datetime.now(timezone.utc),
+            config.get('s3_cache_ttl') if ttl is None else ttl
+        ),
+        **{'content-hash': hash_}
+    )
+
+
+def _put_page(
+        body: Union[bytes, BinaryIO],
+        size: int,
+        content_encoding: str,
+        hash_: str,
+        url: str,
+        device: str,
+        rendered_at: Union[datetime, None],
+        ttl: Union[int, None]
+) -> str:
     bucket_name, object_name, s3, s3_endpoint, s3_url = _s3_config(device, url)
+    meta = _page_meta(rendered_at, ttl, hash_)
+    PAGE_BYTES.observe(size, kind='stored')
+    local_meta = dict(meta, **{'content-encoding': content_encoding})
+    if isinstance(body, bytes):
+        local_cache.put(object_name, body, local_meta)  # write-through
+    elif local_cache.accepts(size):
+        local_cache.put(object_name, body.read(), local_meta)
+        body.seek(0)
+        pass
     try:
         # Upload the HTML data to the DigitalOcean Space bucket
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=object_name,
-            Body=html_data,
-            ContentType='text/html',
-            ACL='public-read'
+        extra_args = dict(ContentEncoding=content_encoding) \
+            if content_encoding else {}
+        with phase('s3_put'):
+            result = s3.put_object(
+                Bucket=bucket_name,
+                Key=object_name,
+                Body=body,
+                ContentLength=size,
+                ContentType='text/html',
+                ACL='public-read',
+                Metadata=meta,
+                **extra_args
+            )
+            pass
+        content_index.put(
+            object_name,
+            hash_,
+            content_encoding,
+            result.get('ETag')
         )
-        obj_path = object_name.replace(' ', '%20')
-        url = f'https://{bucket_name}.{s3_endpoint}/{obj_path}'
+        PAGE_STORES.inc(result='uploaded')
         logger.debug(
             'store_page: s3 object direct URL: %s',
             s3_url
         )
         return s3_url
     except Exception as e:
+        PAGE_STORES.inc(result='failed')
         logger.exception('store_page: error storing %s: %s', object_name, e)
         return ''
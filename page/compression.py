@@ -0,0 +1,110 @@
+import gzip
+import zlib
+from typing import Iterator, Set
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+    pass
+
+
+def supported_encodings() -> Set[str]:
+    return {'gzip', 'br'} if brotli else {'gzip'}
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if not encoding:
+        return body
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if encoding == 'br' and brotli:
+        return brotli.compress(body, mode=brotli.MODE_TEXT)
+    raise ValueError(f'unsupported content encoding: {encoding}')
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if not encoding or encoding == 'identity':
+        return body
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'br' and brotli:
+        return brotli.decompress(body)
+    raise ValueError(f'unsupported content encoding: {encoding}')
+
+
+def compress_stream(
+        chunks: Iterator[bytes],
+        encoding: str
+) -> Iterator[bytes]:
+    if not encoding:
+        yield from chunks
+        return
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, wbits=16 + zlib.MAX_WBITS)
+        process, flush = compressor.compress, compressor.flush
+    elif encoding == 'br' and brotli:
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+        process, flush = compressor.process, compressor.finish
+    else:
+        raise ValueError(f'unsupported content encoding: {encoding}')
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+            pass
+        pass
+    yield flush()
+    pass
+
+
+def decompress_stream(
+        chunks: Iterator[bytes],
+        encoding: str
+) -> Iterator[bytes]:
+    if not encoding or encoding == 'identity':
+        yield from chunks
+        return
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        process, flush = decompressor.decompress, decompressor.flush
+    elif encoding == 'br' and brotli:
+        decompressor = brotli.Decompressor()
+        process, flush = decompressor.process, lambda: b''
+    else:
+        raise ValueError(f'unsupported content encoding: {encoding}')
+    try:
+        for chunk in chunks:
+            data = process(chunk)
+            if data:
+                yield data
+                pass
+            pass
+        data = flush()
+        if data:
+            yield data
+            pass
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+            pass
+        pass
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """Whether an `Accept-Encoding` request header accepts `encoding`"""
+    if not accept_encoding or not encoding:
+        return False
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        if name.strip().lower() not in (encoding, '*'):
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
@@ -0,0 +1,42 @@
+import hashlib
+import re
+from typing import Iterator, Tuple
+
+# meta tags which differ between renders of unchanged content
+VOLATILE_META_RE = re.compile(
+    r'<meta name="x-spa-renderer-timestamp" content="[^"]*">'
+)
+# characters of a page hashed at a time
+HASH_CHUNK_CHARS = 1 << 18
+
+
+def content_slices(html: str) -> Iterator[Tuple[str, bool]]:
+    """
+    A rendered page in slices of at most `HASH_CHUNK_CHARS`, each with
+    whether it is content (hashed), rather than a volatile meta tag
+    """
+    start = 0
+    for end, next_start in [
+        *((m.start(), m.end()) for m in VOLATILE_META_RE.finditer(html)),
+        (len(html), len(html))
+    ]:
+        for i in range(start, end, HASH_CHUNK_CHARS):
+            yield html[i:min(i + HASH_CHUNK_CHARS, end)], True
+            pass
+        if next_start > end:
+            yield html[end:next_start], False
+            pass
+        start = next_start
+        pass
+    pass
+
+
+def content_hash(html: str) -> str:
+    """SHA-256 of a rendered page, without its volatile meta tags"""
+    digest = hashlib.sha256()
+    for chunk, hashed in content_slices(html):
+        if hashed:
+            digest.update(chunk.encode('utf-8'))
+            pass
+        pass
+    return digest.hexdigest()
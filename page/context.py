@@ -1,20 +1,130 @@
+import copy
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 from typing import Dict, List, Tuple, Union
 
-from playwright.sync_api import BrowserContext, Playwright
+from playwright.async_api import Browser, BrowserContext
 
 from util import config
 from util.get_logger import get_logger
 
+from .options import RenderOptions
+
 logger = get_logger(__name__)
 
 
+# resolved devices of recent (device, user agent)
+RESOLVE_CACHE_SIZE = 4096
+
+
+class PriorityMatcher:
+    """
+    Which of `needles` is contained in a string, the first one listed
+    winning (not the leftmost): a single pass of one alternation regex,
+    which yields the best needle at each position.
+    """
+
+    def __init__(self, needles: List[str]):
+        self._rank: Dict[str, int] = {}
+        for i, needle in enumerate(needles):
+            self._rank.setdefault(needle, i)
+            pass
+        ordered = sorted(self._rank, key=self._rank.get)
+        self._pattern = re.compile(
+            '(?=(%s))' % '|'.join(re.escape(n) for n in ordered)
+        ) if ordered else None
+        pass
+
+    def search(self, s: str) -> Union[int, None]:
+        """Index of the first listed needle found in `s`"""
+        if self._pattern is None:
+            return None
+        return min(
+            (self._rank[m.group(1)] for m in self._pattern.finditer(s)),
+            default=None
+        )
+
+
+class DeviceIndex:
+    """
+    User agent lookups in the Playwright devices, built once per devices
+    dict (`playwright.devices` returns a new copy on every access: read
+    it once, see BrowserPool.start()). Device names are tried in reverse
+    sorted order; a user agent matches a device (in full) when it is
+    contained in the device's user agent, and (partially) when it
+    contains the device name.
+    """
+
+    def __init__(self, devices: dict):
+        self.devices = devices
+        self.names = sorted(devices.keys(), reverse=True)
+        user_agents = [devices[k].get('user_agent', '') for k in self.names]
+        # one string to search, and the offset of each device's part
+        self._user_agents = '\n'.join(user_agents)
+        self._offsets = list(accumulate(
+            [0] + [len(ua) + 1 for ua in user_agents[:-1]]
+        ))
+        self._partial = PriorityMatcher(self.names)
+        # exact device user agent -> device
+        self.by_user_agent: Dict[str, str] = {}
+        for ua in user_agents:
+            if ua and ua not in self.by_user_agent:
+                self.by_user_agent[ua] = self._search(ua)
+                pass
+            pass
+        pass
+
+    def _search(self, user_agent: str) -> Union[str, None]:
+        if '\n' in user_agent:
+            return None  # would span two devices' user agents
+        pos = self._user_agents.find(user_agent)
+        if pos < 0:
+            return None
+        return self.names[bisect_right(self._offsets, pos) - 1]
+
+    def full_match(self, user_agent: str) -> Union[str, None]:
+        device = self.by_user_agent.get(user_agent)
+        return device if device else self._search(user_agent)
+
+    def partial_match(self, user_agent: str) -> Union[str, None]:
+        i = self._partial.search(user_agent)
+        return None if i is None else self.names[i]
+
+
+_device_index: Union[DeviceIndex, None] = None
+_resolve_generation = 0
+
+# (config generation, user_agent_screen_mapping presets, their matcher)
+_presets: Tuple[int, List[str], Union[PriorityMatcher, None]] = \
+    (0, [], None)
+
+
+def device_index(devices: dict) -> DeviceIndex:
+    """The index of `devices`, (re)built - forgetting the resolved
+    devices - when given another devices dict"""
+    global _device_index
+    if _device_index is None or _device_index.devices is not devices:
+        _device_index = DeviceIndex(devices)
+        _resolve_device_cached.cache_clear()
+        pass
+    return _device_index
+
+
 def _get_preset(user_agent: str):
+    global _presets
     if user_agent:
-        mapping: List[str, str] = config.get('user_agent_screen_mapping')
-        for ua, preset in mapping:
-            if ua in user_agent.lower():
-                return preset
+        generation, presets, matcher = _presets
+        if generation != config.generation:
+            mapping: List[str, str] = config.get('user_agent_screen_mapping')
+            presets = [preset for _, preset in mapping]
+            matcher = PriorityMatcher([ua for ua, _ in mapping])
+            _presets = (config.generation, presets, matcher)
             pass
+        i = matcher.search(user_agent.lower())
+        if i is not None:
+            return presets[i]
         pass
 
     return 'desktop'
@@ -32,25 +142,21 @@ def _resolve_device(
         return device
 
     if user_agent:
-        device_names = [k for k in devices.keys()]
-        device_names.sort()
-        device_names.reverse()
-        for k in device_names:
-            if user_agent in devices[k].get('user_agent', ''):
-                logger.debug(
-                    'resolve_device: user_agent match (full) device=%s',
-                    k
-                )
-                return k
-            pass
-        for k in device_names:
-            if k in user_agent:
-                logger.debug(
-                    'resolve_device: user_agent match (partial) device=%s',
-                    k
-                )
-                return k
-            pass
+        index = device_index(devices)
+        device = index.full_match(user_agent)
+        if device:
+            logger.debug(
+                'resolve_device: user_agent match (full) device=%s',
+                device
+            )
+            return device
+        device = index.partial_match(user_agent)
+        if device:
+            logger.debug(
+                'resolve_device: user_agent match (partial) device=%s',
+                device
+            )
+            return device
         pass
     return None
 
@@ -70,10 +176,15 @@ def _resolve_device_conf(
         user_agent_append = config.get('user_agent_append') or None
         pass
 
-    device = _resolve_device(devices, device, user_agent)
+    if devices is _device_index.devices:
+        device = _resolve_device_cached(device, user_agent)
+    else:
+        device = _resolve_device(devices, device, user_agent)
+        pass
 
     if device:
-        conf = devices[device]
+        # copy: `devices` is shared by every render of a pooled playwright
+        conf = copy.deepcopy(devices[device])
     else:
         device = _get_preset(user_agent)
         screen = screen or config.get('screen_presets').get(device)
@@ -98,50 +209,52 @@ def _resolve_device_conf(
     return device, conf
 
 
-def get_browser_context(
-        playwright: Playwright,
-        screen: str = None,
-        debug: bool = None,
-        user_agent: str = None,
-        user_agent_append: str = None,
-        device: str = None,
-        extra_headers: Dict[str, str] = None
-) -> Tuple[BrowserContext, str]:
-    chromium = playwright.chromium  # or "firefox" or "webkit".
+@lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+def _resolve_device_cached(
+        device: Union[str, None],
+        user_agent: Union[str, None]
+) -> Union[str, None]:
+    return _resolve_device(_device_index.devices, device, user_agent)
 
-    if debug is None:
-        debug = config.get('debug')
-        pass
 
-    if extra_headers is None:
-        extra_headers = config.get('extra_http_headers') or {}
+def resolve_device_conf(
+        devices: dict,
+        options: RenderOptions,
+        screen: str = None,
+        user_agent: str = None,
+        device: str = None
+) -> Tuple[str, dict]:
+    global _resolve_generation
+    device_index(devices)
+    if _resolve_generation != config.generation:
+        # the `device` setting may have changed
+        _resolve_device_cached.cache_clear()
+        _resolve_generation = config.generation
         pass
+    resolved_device, device_conf = _resolve_device_conf(
+        devices,
+        device=device,
+        screen=screen,
+        user_agent=user_agent,
+        user_agent_append=options.user_agent_append
+    )
 
-    browser = chromium.launch(headless=(not debug))
+    logger.debug(
+        'render: using device=%s, device_conf=%s',
+        resolved_device,
+        device_conf
+    )
 
-    try:
-        resolved_device, device_conf = _resolve_device_conf(
-            playwright.devices,
-            device=device,
-            screen=screen,
-            user_agent=user_agent,
-            user_agent_append=user_agent_append
-        )
+    return resolved_device, device_conf
 
-        logger.debug(
-            'render: using device=%s, device_conf=%s',
-            resolved_device,
-            device_conf
-        )
 
-        context = browser.new_context(
-            **device_conf,
-            ignore_https_errors=True,
-            extra_http_headers=extra_headers,
-        )
-
-        return context, resolved_device
-    except Exception as e:
-        browser.close()
-        raise e
-        pass
+async def get_browser_context(
+        browser: Browser,
+        device_conf: dict,
+        options: RenderOptions
+) -> BrowserContext:
+    return await browser.new_context(
+        **device_conf,
+        ignore_https_errors=True,
+        extra_http_headers=dict(options.extra_http_headers),
+    )
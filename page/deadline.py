@@ -0,0 +1,57 @@
+import time
+from typing import Union
+
+from playwright.async_api import TimeoutError
+
+
+class DeadlineExceeded(TimeoutError):
+    """The render budget (`default_timeout`) ran out"""
+    pass
+
+
+class Deadline:
+    """
+    Overall time budget of a render, in milliseconds (0: unbounded).
+
+    Every blocking step asks it for its timeout, so the remaining
+    budget is spread over the steps still to come rather than each
+    using its own default.
+    """
+
+    def __init__(self, budget_ms: int = 0):
+        self.budget = budget_ms
+        self.expires = time.monotonic() + budget_ms / 1000 \
+            if budget_ms else None
+        pass
+
+    def remaining(self) -> Union[float, None]:
+        """Milliseconds left (None: unbounded)"""
+        if self.expires is None:
+            return None
+        return max((self.expires - time.monotonic()) * 1000, 0)
+
+    def expired(self) -> bool:
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def seconds(self) -> Union[float, None]:
+        remaining = self.remaining()
+        return None if remaining is None else remaining / 1000
+
+    def timeout(self, share: float = 1.0, cap: int = None) \
+            -> Union[int, None]:
+        """
+        Timeout (ms) of a step allowed `share` of the remaining budget,
+        and no more than `cap` (0/None: no cap)
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return cap or None
+        timeout = max(int(remaining * share), 1)
+        return min(timeout, cap) if cap else timeout
+
+    def check(self, what: str = 'render'):
+        if self.expired():
+            raise DeadlineExceeded(
+                f'{what}: {self.budget} ms render deadline exceeded'
+            )
+        pass
@@ -0,0 +1,92 @@
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, Pattern, Tuple, Union
+
+from playwright.async_api import Page, Route
+
+from util.get_logger import get_logger
+
+from .options import RenderOptions
+
+logger = get_logger(__name__)
+
+
+class BlockCounters:
+    """Per-rule counts of the requests aborted by `RequestPolicy`"""
+
+    def __init__(self):
+        self.allowed = 0
+        self.blocked: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        pass
+
+    def count(self, rule: str = None):
+        with self._lock:
+            if rule is None:
+                self.allowed += 1
+            else:
+                self.blocked[rule] = self.blocked.get(rule, 0) + 1
+                pass
+            pass
+        pass
+
+    def stats(self) -> Dict[str, Union[int, Dict[str, int]]]:
+        with self._lock:
+            return dict(allowed=self.allowed, blocked=dict(self.blocked))
+
+
+block_counters = BlockCounters()
+
+
+@lru_cache(maxsize=32)
+def _compile(patterns: Tuple[str, ...]) -> Tuple[Tuple[str, Pattern], ...]:
+    return tuple((p, re.compile(p)) for p in patterns)
+
+
+class RequestPolicy:
+    """
+    Aborts the subresource requests whose content can't change the DOM
+    we dump: `block_resource_types` (Playwright resource types, e.g.
+    image, media, font) and URLs matching `block_url_patterns`
+    (e.g. analytics, ads and chat widgets). Navigations are never
+    blocked.
+    """
+
+    def __init__(self, options: RenderOptions):
+        self.resource_types = frozenset(options.block_resource_types)
+        self.url_patterns = _compile(options.block_url_patterns)
+        self.blocked = 0
+        pass
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.resource_types or self.url_patterns)
+
+    def rule(self, resource_type: str, url: str) -> Union[str, None]:
+        """The rule blocking a request, if any"""
+        if resource_type in self.resource_types:
+            return f'type:{resource_type}'
+        for pattern, regex in self.url_patterns:
+            if regex.search(url):
+                return f'url:{pattern}'
+        return None
+
+    async def attach(self, page: Page):
+        if self.enabled:
+            await page.route('**/*', self._handle)
+            pass
+        pass
+
+    async def _handle(self, route: Route):
+        request = route.request
+        rule = None if request.is_navigation_request() \
+            else self.rule(request.resource_type, request.url)
+        block_counters.count(rule)
+        if rule:
+            self.blocked += 1
+            logger.debug('intercept: %s: blocked by %s', request.url, rule)
+            await route.abort('blockedbyclient')
+            return
+        await route.fallback()
+        pass
@@ -0,0 +1,415 @@
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from typing import Any, Dict, List, Tuple, Union
+from urllib.parse import urlparse
+
+from util import config
+from util.get_logger import get_logger
+
+from .options import RenderOptions
+from .render import render
+
+logger = get_logger(__name__)
+
+
+class JobItem:
+    def __init__(self, url: str, device: str = None, status: str = 'pending'):
+        self.url = url
+        self.device = device
+        self.status = status  # pending, running, done, failed
+        self.s3_url: Union[str, None] = None
+        self.cache_hit: Union[bool, None] = None
+        self.artifact: Union[str, None] = None  # sha256
+        self.message: Union[str, None] = None
+        self.duration: Union[float, None] = None
+        pass
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            url=self.url,
+            device=self.device,
+            status=self.status,
+            s3_url=self.s3_url,
+            cache_hit=self.cache_hit,
+            artifact=self.artifact,
+            message=self.message,
+            duration=self.duration
+        )
+
+
+class Job:
+    def __init__(
+            self,
+            job_id: str,
+            items: List[JobItem],
+            priority: int = 0,
+            overrides: Dict[str, Any] = None,
+            created: float = None
+    ):
+        self.id = job_id
+        self.items = items
+        self.priority = priority
+        self.overrides = overrides or {}
+        self.created = created or time.time()
+        self.finished: Union[float, None] = None
+        self.done = asyncio.Event()
+        pass
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict(pending=0, running=0, done=0, failed=0)
+        for item in self.items:
+            counts[item.status] += 1
+            pass
+        return counts
+
+    @property
+    def status(self) -> str:
+        counts = self.counts()
+        if counts['pending'] + counts['running'] == 0:
+            return 'finished'
+        if counts['pending'] == len(self.items):
+            return 'queued'
+        return 'running'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            id=self.id,
+            status=self.status,
+            priority=self.priority,
+            created=self.created,
+            finished=self.finished,
+            progress=self.counts(),
+            items=[i.to_dict() for i in self.items]
+        )
+
+
+class _JobStore:
+    """Optional SQLite persistence, so queued jobs survive a restart"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                priority INTEGER,
+                created REAL,
+                finished REAL,
+                overrides TEXT
+            );
+            CREATE TABLE IF NOT EXISTS items (
+                job_id TEXT,
+                idx INTEGER,
+                url TEXT,
+                device TEXT,
+                status TEXT,
+                s3_url TEXT,
+                cache_hit INTEGER,
+                message TEXT,
+                duration REAL,
+                artifact TEXT,
+                PRIMARY KEY (job_id, idx)
+            );
+        ''')
+        columns = [c[1] for c in self.db.execute('PRAGMA table_info(items)')]
+        if 'artifact' not in columns:  # databases of earlier versions
+            self.db.execute('ALTER TABLE items ADD COLUMN artifact TEXT')
+            pass
+        pass
+
+    def add(self, job: Job):
+        with self.db:
+            self.db.execute(
+                'INSERT INTO jobs VALUES (?, ?, ?, ?, ?)',
+                (
+                    job.id,
+                    job.priority,
+                    job.created,
+                    job.finished,
+                    json.dumps(job.overrides)
+                )
+            )
+            self.db.executemany(
+                'INSERT INTO items (job_id, idx, url, device, status) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [
+                    (job.id, i, item.url, item.device, item.status)
+                    for i, item in enumerate(job.items)
+                ]
+            )
+            pass
+        pass
+
+    def update(self, job: Job, idx: int):
+        item = job.items[idx]
+        with self.db:
+            self.db.execute(
+                'UPDATE items SET status=?, s3_url=?, cache_hit=?, '
+                'artifact=?, message=?, duration=? WHERE job_id=? AND idx=?',
+                (
+                    item.status,
+                    item.s3_url,
+                    item.cache_hit,
+                    item.artifact,
+                    item.message,
+                    item.duration,
+                    job.id,
+                    idx
+                )
+            )
+            self.db.execute(
+                'UPDATE jobs SET finished=? WHERE id=?',
+                (job.finished, job.id)
+            )
+            pass
+        pass
+
+    def delete(self, job_id: str):
+        with self.db:
+            self.db.execute('DELETE FROM items WHERE job_id=?', (job_id,))
+            self.db.execute('DELETE FROM jobs WHERE id=?', (job_id,))
+            pass
+        pass
+
+    def load(self) -> List[Job]:
+        jobs = {}
+        for job_id, priority, created, finished, overrides in \
+                self.db.execute('SELECT * FROM jobs'):
+            job = Job(job_id, [], priority, json.loads(overrides), created)
+            job.finished = finished
+            jobs[job_id] = job
+            pass
+        for job_id, url, device, status, s3_url, cache_hit, artifact, \
+                message, duration in self.db.execute(
+                    'SELECT job_id, url, device, status, s3_url, cache_hit, '
+                    'artifact, message, duration FROM items '
+                    'ORDER BY job_id, idx'
+                ):
+            item = JobItem(url, device, status)
+            item.s3_url = s3_url
+            item.cache_hit = None if cache_hit is None else bool(cache_hit)
+            item.artifact = artifact
+            item.message = message
+            item.duration = duration
+            if job_id in jobs:
+                jobs[job_id].items.append(item)
+                pass
+            pass
+        return list(jobs.values())
+
+
+class JobQueue:
+    """
+    In-process batch render queue.
+
+    Items run on `batch_concurrency` workers in priority order (lower
+    first, then FIFO). Render starts on the same host are spaced by at
+    least `batch_host_interval_ms`. Results go to the page cache.
+    """
+
+    def __init__(
+            self,
+            concurrency: int = None,
+            host_interval_ms: int = None,
+            db_path: str = None
+    ):
+        self.concurrency = concurrency or config.get('batch_concurrency')
+        self.host_interval = (
+            host_interval_ms if host_interval_ms is not None
+            else config.get('batch_host_interval_ms')
+        ) / 1000
+        self.db_path = config.get('batch_jobs_db') if db_path is None \
+            else db_path
+        self.retention = config.get('batch_job_retention')
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Union[asyncio.PriorityQueue, None] = None
+        self._workers: List[asyncio.Task] = []
+        self._next_start: Dict[str, float] = {}
+        self._seq = 0
+        self._store: Union[_JobStore, None] = None
+        pass
+
+    async def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        if self.db_path:
+            self._store = _JobStore(self.db_path)
+            for job in self._store.load():
+                self.jobs[job.id] = job
+                if job.status == 'finished':
+                    job.done.set()
+                    pass
+                for i, item in enumerate(job.items):
+                    if item.status in ('pending', 'running'):
+                        item.status = 'pending'
+                        self._enqueue(job, i)
+                        pass
+                    pass
+                pass
+            logger.info(
+                'job_queue: restored %d job(s), %d pending item(s)',
+                len(self.jobs),
+                self._queue.qsize()
+            )
+            pass
+        self._workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(self.concurrency)
+        ]
+        pass
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+            pass
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        pass
+
+    async def submit(
+            self,
+            urls: List[str],
+            devices: List[str] = None,
+            priority: int = 0,
+            overrides: Dict[str, Any] = None
+    ) -> Job:
+        """Queue every url for every device; `overrides` are (JSON
+        serializable) RenderOptions overrides"""
+        return await self.submit_items(
+            [(url, device) for url in urls for device in (devices or [None])],
+            priority,
+            overrides
+        )
+
+    async def submit_items(
+            self,
+            items: List[Tuple[str, Union[str, None]]],
+            priority: int = 0,
+            overrides: Dict[str, Any] = None
+    ) -> Job:
+        """Queue (url, device) pairs as a single job"""
+        await self.start()
+        self._prune()
+        job = Job(
+            uuid.uuid4().hex,
+            [JobItem(url, device) for url, device in items],
+            priority,
+            overrides
+        )
+        RenderOptions.from_config(**job.overrides)  # validate early
+        self.jobs[job.id] = job
+        if self._store:
+            self._store.add(job)
+            pass
+        for i in range(len(job.items)):
+            self._enqueue(job, i)
+            pass
+        if not job.items:
+            job.finished = time.time()
+            job.done.set()
+            pass
+        logger.info(
+            'job_queue: job %s: %d item(s) queued (priority=%d)',
+            job.id,
+            len(job.items),
+            priority
+        )
+        return job
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        return self.jobs.get(job_id)
+
+    @staticmethod
+    async def wait(job: Job) -> Job:
+        await job.done.wait()
+        return job
+
+    def _enqueue(self, job: Job, idx: int):
+        self._seq += 1
+        self._queue.put_nowait((job.priority, self._seq, job.id, idx))
+        pass
+
+    def _prune(self):
+        if not self.retention:
+            return
+        horizon = time.time() - self.retention
+        for job in list(self.jobs.values()):
+            if job.finished and job.finished < horizon:
+                del self.jobs[job.id]
+                if self._store:
+                    self._store.delete(job.id)
+                    pass
+                pass
+            pass
+        pass
+
+    async def _throttle(self, url: str):
+        host = urlparse(url).hostname or ''
+        now = time.monotonic()
+        start = max(now, self._next_start.get(host, 0))
+        self._next_start[host] = start + self.host_interval
+        if start > now:
+            await asyncio.sleep(start - now)
+            pass
+        pass
+
+    async def _worker(self):
+        while True:
+            _, _, job_id, idx = await self._queue.get()
+            try:
+                job = self.jobs.get(job_id)
+                if job:
+                    await self._run(job, idx)
+                    pass
+            except Exception as e:
+                logger.exception('job_queue: worker error: %s', e)
+                pass
+            finally:
+                self._queue.task_done()
+                pass
+            pass
+
+    async def _run(self, job: Job, idx: int):
+        item = job.items[idx]
+        await self._throttle(item.url)
+        item.status = 'running'
+        started = time.monotonic()
+        try:
+            result = await render(
+                item.url,
+                RenderOptions.from_config(**job.overrides),
+                device=item.device
+            )
+            item.status = 'done'
+            item.s3_url = result.s3_url
+            item.cache_hit = result.cache_hit
+            item.artifact = result.artifact.sha256 if result.artifact \
+                else None
+        except Exception as e:
+            item.status = 'failed'
+            item.message = str(e)
+            pass
+        item.duration = round(time.monotonic() - started, 3)
+        if job.status == 'finished':
+            job.finished = time.time()
+            job.done.set()
+            logger.info('job_queue: job %s: finished %s', job.id, job.counts())
+            pass
+        if self._store:
+            self._store.update(job, idx)
+            pass
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            jobs=len(self.jobs),
+            queued=self._queue.qsize() if self._queue else 0,
+            workers=len(self._workers)
+        )
+
+
+job_queue = JobQueue()
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Union
+
+from util import config
+from util.get_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    meta: Dict[str, str]
+    expires: float  # epoch seconds, 0: never
+
+    def expired(self, now: float = None) -> bool:
+        return bool(self.expires) and self.expires <= (now or time.time())
+
+
+class _Counters:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations
+        )
+
+
+class MemoryCache(_Counters):
+    """Byte-bounded, thread-safe LRU"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        pass
+
+    def get(self, key: str) -> Union[CacheEntry, None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expired():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+                pass
+            pass
+        pass
+
+    def delete(self, key: str):
+        with self._lock:
+            self._remove(key)
+            pass
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            super().stats(),
+            entries=len(self._entries),
+            bytes=self.size
+        )
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+            pass
+        pass
+
+
+class DiskCache(_Counters):
+    """
+    Byte-bounded LRU in a sharded directory: every entry is a
+    `<sha1>.body` file (read through mmap) next to a `<sha1>.json`
+    metadata file. Recency is tracked in memory and rebuilt from file
+    mtimes at startup.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        super().__init__()
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._files: OrderedDict[str, int] = OrderedDict()  # path -> size
+        self._lock = threading.Lock()
+        self._scan()
+        pass
+
+    def get(self, key: str) -> Union[CacheEntry, None]:
+        path = self._path(key)
+        try:
+            with open(path + '.json') as f:
+                header = json.load(f)
+                pass
+            if header['key'] != key:
+                raise KeyError(key)
+            entry = CacheEntry(
+                self._read_body(path + '.body'),
+                header['meta'],
+                header['expires']
+            )
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+                pass
+            return None
+
+        with self._lock:
+            if entry.expired():
+                self._remove(path)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if path in self._files:
+                self._files.move_to_end(path)
+                pass
+            self.hits += 1
+            pass
+        return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        if len(entry.body) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        with open(tmp + '.body', 'wb') as f:
+            f.write(entry.body)
+            pass
+        with open(tmp + '.json', 'w') as f:
+            json.dump(
+                dict(key=key, meta=entry.meta, expires=entry.expires),
+                f
+            )
+            pass
+        with self._lock:
+            self._remove(path)
+            os.replace(tmp + '.body', path + '.body')
+            os.replace(tmp + '.json', path + '.json')
+            self._files[path] = len(entry.body)
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._files)))
+                self.evictions += 1
+                pass
+            pass
+        pass
+
+    def delete(self, key: str):
+        with self._lock:
+            self._remove(self._path(key))
+            pass
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            super().stats(),
+            entries=len(self._files),
+            bytes=self.size
+        )
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    @staticmethod
+    def _read_body(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[:]
+
+    def _remove(self, path: str):
+        size = self._files.pop(path, None)
+        if size is not None:
+            self.size -= size
+            pass
+        for suffix in ('.body', '.json'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+            pass
+        pass
+
+    def _scan(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith('.body'):
+                    continue
+                path = os.path.join(dirpath, name[:-len('.body')])
+                try:
+                    st = os.stat(path + '.body')
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+                pass
+            pass
+        for _, path, size in sorted(files):
+            self._files[path] = size
+            self.size += size
+            pass
+        pass
+
+
+class LocalCache:
+    """
+    Two level (memory, then disk) local cache tier in front of S3,
+    using the S3 object names as keys
+    """
+
+    def __init__(
+            self,
+            memory_bytes: int = None,
+            directory: str = None,
+            disk_bytes: int = None,
+            ttl: int = None,
+            max_entry_bytes: int = None
+    ):
+        if memory_bytes is None:
+            memory_bytes = config.get('local_cache_memory_bytes')
+            pass
+        if directory is None:
+            directory = config.get('local_cache_dir')
+            pass
+        if disk_bytes is None:
+            disk_bytes = config.get('local_cache_disk_bytes')
+            pass
+        self.ttl = config.get('local_cache_ttl') if ttl is None else ttl
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None \
+            else config.get('local_cache_max_entry_bytes')
+        self.memory = MemoryCache(memory_bytes) if memory_bytes else None
+        self.disk = DiskCache(directory, disk_bytes) \
+            if directory and disk_bytes else None
+        pass
+
+    def accepts(self, size: int) -> bool:
+        """Whether a body of `size` bytes would be cached at all"""
+        return bool(self.memory or self.disk) and (
+            not self.max_entry_bytes or size <= self.max_entry_bytes
+        )
+
+    def get(self, key: str) -> Union[CacheEntry, None]:
+        if self.memory:
+            entry = self.memory.get(key)
+            if entry:
+                return entry
+            pass
+        if self.disk:
+            entry = self.disk.get(key)
+            if entry:
+                if self.memory:
+                    self.memory.put(key, entry)
+                    pass
+                return entry
+            pass
+        return None
+
+    def put(
+            self,
+            key: str,
+            body: bytes,
+            meta: Dict[str, str] = None,
+            ttl: int = None
+    ):
+        """Cache `body` for `ttl` seconds (default: `local_cache_ttl`,
+        0: forever)"""
+        if not self.accepts(len(body)):
+            return
+        ttl = self.ttl if ttl is None else ttl
+        entry = CacheEntry(
+            body,
+            meta or {},
+            (time.time() + ttl) if ttl else 0
+        )
+        if self.memory:
+            self.memory.put(key, entry)
+            pass
+        if self.disk:
+            try:
+                self.disk.put(key, entry)
+            except OSError as e:
+                logger.warning('local_cache: disk put %s failed: %s', key, e)
+                pass
+            pass
+        pass
+
+    def delete(self, key: str):
+        if self.memory:
+            self.memory.delete(key)
+            pass
+        if self.disk:
+            self.disk.delete(key)
+            pass
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return dict(
+            memory=self.memory.stats() if self.memory else {},
+            disk=self.disk.stats() if self.disk else {}
+        )
+
+
+local_cache = LocalCache()
@@ -0,0 +1,218 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Tuple, Union
+
+from playwright.async_api import TimeoutError
+
+_registry: List['_Metric'] = []
+
+# phase -> seconds, of the render(s) of the current request
+_timings: ContextVar[Union[Dict[str, float], None]] = ContextVar(
+    'render_timings',
+    default=None
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(f'{k}="{_escape(v)}"' for k, v in pairs)
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+        pass
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+            pass
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.label_names, key)} ' \
+                  f'{_number(value)}'
+            pass
+        pass
+
+    def exposition(self) -> str:
+        return '\n'.join([
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples()
+        ])
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+            pass
+        pass
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+            pass
+        pass
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = ()
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        pass
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key,
+                ([0] * len(self.buckets), 0.0)
+            )
+            counts = [
+                c + (value <= b) for c, b in zip(counts, self.buckets)
+            ]
+            self._values[key] = (counts, total + value)
+            pass
+        pass
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+            pass
+        for key, (counts, total) in sorted(values.items()):
+            for bucket, count in zip(self.buckets, counts):
+                labels = _labels(self.label_names, key, le=_number(bucket))
+                yield f'{self.name}_bucket{labels} {count}'
+                pass
+            labels = _labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_number(total)}'
+            yield f'{self.name}_count{labels} {counts[-1]}'
+            pass
+        pass
+
+
+PHASE_SECONDS = Histogram(
+    'spa_renderer_phase_seconds',
+    'Render phase durations',
+    ('phase',),
+    (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+)
+TIMEOUTS = Counter(
+    'spa_renderer_timeouts_total',
+    'Playwright timeouts, by render phase',
+    ('phase',)
+)
+RENDERS = Counter(
+    'spa_renderer_renders_total',
+    'Browser renders',
+    ('result',)
+)
+RETRIES = Counter(
+    'spa_renderer_render_retries_total',
+    'Render attempts retried, by error (navigation_timeout, ready_timeout, '
+    'origin_error, connection, crash)',
+    ('error',)
+)
+CACHE_LOOKUPS = Counter(
+    'spa_renderer_cache_lookups_total',
+    'Page cache lookups',
+    ('result',)
+)
+DEADLINES = Counter(
+    'spa_renderer_deadline_exceeded_total',
+    'Renders past their deadline, by outcome (cached copy served, failed)',
+    ('outcome',)
+)
+PAGE_STORES = Counter(
+    'spa_renderer_page_stores_total',
+    'S3 page stores, by result (uploaded, unchanged: metadata refreshed, '
+    'failed)',
+    ('result',)
+)
+PAGE_BYTES = Histogram(
+    'spa_renderer_page_bytes',
+    'Rendered (uncompressed) and stored (compressed) page sizes',
+    ('kind',),
+    (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24)
+)
+
+
+def exposition() -> str:
+    """Every metric, in the Prometheus text format"""
+    return '\n'.join(m.exposition() for m in _registry) + '\n'
+
+
+def start_timings() -> Dict[str, float]:
+    """Collect the phase timings of the renders run from the current
+    context (and the tasks and threads it starts) into a new dict"""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+@contextmanager
+def phase(name: str):
+    """Time a render phase (and count the Playwright timeouts in it)"""
+    started = time.perf_counter()
+    try:
+        yield
+    except TimeoutError:
+        TIMEOUTS.inc(phase=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        PHASE_SECONDS.observe(elapsed, phase=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + elapsed
+            pass
+        pass
+    pass
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """`Server-Timing` header value of phase `timings`"""
+    return ', '.join(
+        f'{name};dur={seconds * 1000:.1f}'
+        for name, seconds in timings.items()
+    )
@@ -0,0 +1,73 @@
+from dataclasses import dataclass, field, fields
+from types import MappingProxyType
+from typing import Mapping, Tuple
+
+from util import config
+
+from .waitready import ReadyCondition
+
+
+@dataclass(frozen=True)
+class RenderOptions:
+    """
+    Immutable per-request render settings.
+
+    Built by layering request overrides on top of the base config, so
+    concurrent requests never see each other's settings. Field names
+    match their config.yaml counterparts.
+    """
+    debug: bool
+    default_timeout: int = field(compare=False)  # render budget (ms)
+    add_base_url: bool
+    preload_pages: bool
+    max_tries: int
+    network_idle_check: bool
+    network_idle_time: int
+    network_idle_min_time: int
+    network_idle_max_time: int
+    network_idle_adaptive: bool
+    network_idle_ignore_pattern: str
+    network_idle_requests_url_pattern: str
+    ready_conditions: Tuple[ReadyCondition, ...]
+    ready_timeout: int
+    remove_elements: Tuple[str, ...]
+    block_resource_types: Tuple[str, ...]
+    block_url_patterns: Tuple[str, ...]
+    extra_http_headers: Mapping[str, str] = field(hash=False)
+    user_agent_append: str
+    s3_store_pages: bool
+    s3_return_cached_pages: bool
+    s3_cache_ttl: int
+    s3_stale_while_revalidate: bool
+    render_to_disk: bool
+
+    @classmethod
+    def from_config(cls, **overrides) -> 'RenderOptions':
+        """Base config values, overridden by every non-None `overrides`"""
+        names = {f.name for f in fields(cls)}
+        unknown = set(overrides.keys()) - names
+        if unknown:
+            raise TypeError(f'unknown render options: {sorted(unknown)}')
+
+        values = {name: config.get(name) for name in names}
+        for k, v in overrides.items():
+            if v is not None:
+                values[k] = v
+                pass
+            pass
+
+        values['ready_conditions'] = tuple(
+            (selector, tuple(conditions), state)
+            for selector, conditions, state in values['ready_conditions'] or []
+        )
+        values['remove_elements'] = tuple(values['remove_elements'] or [])
+        values['block_resource_types'] = tuple(
+            values['block_resource_types'] or []
+        )
+        values['block_url_patterns'] = tuple(
+            values['block_url_patterns'] or []
+        )
+        values['extra_http_headers'] = MappingProxyType(
+            dict(values['extra_http_headers'] or {})
+        )
+        return cls(**values)
@@ -1,30 +1,132 @@
+import asyncio
 import re
-from typing import List
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Pattern, Union
 from urllib.parse import urlparse
 
-from playwright.sync_api import Page, Request
+from playwright.async_api import Page, Request
 
-from util import config
 from util.get_logger import get_logger
 
+from .deadline import Deadline
+from .intercept import RequestPolicy
+from .metrics import phase
+from .options import RenderOptions
+from .retry import OriginError
+from .subresources import subresource_cache
+
 logger = get_logger(__name__)
 
+# Shares of the remaining render budget page.goto() and the network
+# idleness wait may use, leaving time for the ready conditions
+GOTO_BUDGET_SHARE = 0.6
+IDLE_BUDGET_SHARE = 0.5
+
+_ROUTE_SEGMENT_RE = re.compile(r'/[^/]*\d[^/]*')
+
+_TRACKED_METHODS = frozenset(['post', 'get', 'put'])
+
+
+@lru_cache(maxsize=256)
+def _compile(pattern: str) -> Pattern:
+    return re.compile(pattern)
+
+
+class IdleWindows:
+    """
+    Per-route network idle windows, learned from the longest quiet gap
+    seen between request bursts of previous loads (a route is the host
+    and path, with segments holding digits - ids, hashes - collapsed).
+
+    A route's window is `margin` times its (slowly decaying) longest
+    gap, kept within [`network_idle_min_time`, `network_idle_time`],
+    and only used once `min_samples` loads were observed.
+    """
+
+    def __init__(self, margin: float = 1.5, decay: float = 0.9,
+                 min_samples: int = 3):
+        self.margin = margin
+        self.decay = decay
+        self.min_samples = min_samples
+        self._routes: Dict[str, List[float]] = {}  # route -> [gap, samples]
+        self._lock = threading.Lock()
+        pass
+
+    @staticmethod
+    def route(url: str) -> str:
+        parsed_url = urlparse(url)
+        return (parsed_url.hostname or '') + \
+            _ROUTE_SEGMENT_RE.sub('/*', parsed_url.path)
+
+    def window(self, url: str, min_time: int, max_time: int) -> int:
+        with self._lock:
+            learned = self._routes.get(self.route(url))
+            pass
+        if not learned or learned[1] < self.min_samples:
+            return max_time
+        return int(min(max(learned[0] * self.margin, min_time), max_time))
+
+    def observe(self, url: str, gap: float):
+        route = self.route(url)
+        with self._lock:
+            learned = self._routes.setdefault(route, [0.0, 0])
+            learned[0] = max(gap, learned[0] * self.decay)
+            learned[1] += 1
+            pass
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                route: dict(gap=round(gap), samples=samples)
+                for route, (gap, samples) in self._routes.items()
+            }
+
+
+idle_windows = IdleWindows()
+
 
 class PageLoader:
-    def __init__(self, page: Page, url: str):
-        self.network_idle_time = config.get('network_idle_time')
-        self.network_idle_ignore_pattern = config.get(
-            'network_idle_ignore_pattern'
-        )
-        self.network_idle_check = config.get('network_idle_check')
+    def __init__(
+            self,
+            page: Page,
+            url: str,
+            options: RenderOptions,
+            deadline: Deadline = None
+    ):
+        self.deadline = deadline or Deadline()
+        self.network_idle_time = options.network_idle_time
+        self.network_idle_ignore_re = \
+            _compile(options.network_idle_ignore_pattern)
+        self.network_idle_check = options.network_idle_check
+        self.network_idle_max_time = options.network_idle_max_time
+        self.network_idle_adaptive = options.network_idle_adaptive
+        if self.network_idle_adaptive:
+            self.network_idle_time = idle_windows.window(
+                url,
+                options.network_idle_min_time,
+                options.network_idle_time
+            )
+            pass
         self.requests: List[str] = []
         self.page = page
         self.url = url
         self.pending_requests = 0
+        # monotonic ms of the last pending count drop to 0 (None: busy)
+        self.idle_since: Union[float, None] = self._now()
+        self.longest_gap = 0.0
+        self._changed = asyncio.Event()
+        self.request_policy = RequestPolicy(options)
+        self.extra_http_headers = options.extra_http_headers
         base_url_pattern = re.escape(self._base_url(url))
-        self.request_wait_url_pattern = config.get(
-            'network_idle_requests_url_pattern'
-        ).replace('@BASE_URL@', base_url_pattern)
+        self.request_wait_url_re = _compile(
+            options.network_idle_requests_url_pattern.replace(
+                '@BASE_URL@',
+                base_url_pattern
+            )
+        )
 
         if self.network_idle_check:
             self._attach_handlers(True)
@@ -66,67 +168,143 @@ class PageLoader:
         pass
 
     def _request_handler(self, request: Request, incr: int):
-        if re.match(
-                self.network_idle_ignore_pattern,
-                request.url
-        ):
+        url = request.url
+        if self.network_idle_ignore_re.match(url):
             return
 
-        if request.method.lower() not in ['post', 'get', 'put']:
+        if request.method.lower() not in _TRACKED_METHODS:
             return
 
-        if re.match(self.request_wait_url_pattern, request.url):
+        if self.request_wait_url_re.match(url):
             self.pending_requests += incr
             match incr:
                 case 1:
-                    self.requests.append(request.url)
+                    self.requests.append(url)
                 case -1:
-                    self.requests.remove(request.url)
+                    self.requests.remove(url)
+
+            if self.pending_requests > 0 and self.idle_since is not None:
+                self.longest_gap = max(
+                    self.longest_gap,
+                    self._now() - self.idle_since
+                )
+                self.idle_since = None
+            elif self.pending_requests == 0:
+                self.idle_since = self._now()
+                pass
+            self._changed.set()
 
             logger.debug(
                 'render: request_handler: %s %s (pending=%d) %s',
-                request.url,
+                url,
                 '>>' if incr == 1 else '<<',
                 self.pending_requests,
                 self.requests
             )
 
-    def load(self) -> Page:
-        self.page.goto(self.url)
-        if self.network_idle_check:
-            self._wait_network_idle()
-            self._attach_handlers(False)
-        else:
-            # simply wait network_idle_time if checks are not enabled
-            self._sleep(self.network_idle_time)
+    async def load(self) -> Page:
+        # route handlers run last registered first: blocking, then cache
+        await subresource_cache.attach(self.page, self.extra_http_headers)
+        await self.request_policy.attach(self.page)
+        with phase('goto'):
+            response = await self.page.goto(
+                self.url,
+                timeout=self.deadline.timeout(GOTO_BUDGET_SHARE)
+            )
+            pass
+        if response is not None and response.status >= 500:
+            raise OriginError(self.url, response.status)
+        self.deadline.check('goto')
+        with phase('idle'):
+            if self.network_idle_check:
+                if not self.pending_requests:
+                    # the quiet window starts once the page has loaded
+                    self.idle_since = self._now()
+                    pass
+                await self._wait_network_idle(self.deadline.timeout(
+                    IDLE_BUDGET_SHARE,
+                    self.network_idle_max_time
+                ))
+                self._attach_handlers(False)
+            elif self.network_idle_time:
+                # simply wait network_idle_time if checks are not enabled
+                await self._sleep(self.deadline.timeout(
+                    IDLE_BUDGET_SHARE,
+                    self.network_idle_time
+                ))
+                pass
             pass
 
+        if self.request_policy.blocked:
+            logger.debug(
+                'load: %s: %d request(s) blocked',
+                self.url,
+                self.request_policy.blocked
+            )
+            pass
         return self.page
 
-    def _sleep(self, ms: int):
-        self.page.wait_for_timeout(ms)
+    async def _sleep(self, ms: int):
+        await self.page.wait_for_timeout(ms)
         pass
 
-    def _wait_network_idle(self):
-        quiet_time = 0
-        while self.pending_requests > 0 or quiet_time < self.network_idle_time:
+    @staticmethod
+    def _now() -> float:
+        return time.monotonic() * 1000
+
+    async def _wait_network_idle(self, max_time: int = None):
+        """
+        Return `network_idle_time` ms after the pending request count
+        last dropped to 0 - woken up by request events rather than
+        polling - or once `max_time` ms have elapsed
+        """
+        started = self._now()
+        deadline = started + max_time if max_time else None
+        while True:
+            now = self._now()
+            if self.idle_since is not None and \
+                    now - self.idle_since >= self.network_idle_time:
+                break
+            if deadline is not None and now >= deadline:
+                logger.warning(
+                    'wait_network_idle: %s: not idle after %d ms, '
+                    'pending: %s',
+                    self.url,
+                    max_time,
+                    self.requests
+                )
+                return
+            if self.idle_since is None:
+                timeout = None  # wait for the pending requests
+            else:
+                timeout = self.idle_since + self.network_idle_time - now
+                pass
+            if deadline is not None:
+                timeout = deadline - now if timeout is None \
+                    else min(timeout, deadline - now)
+                pass
             logger.debug(
-                'wait_network_idle: %d/%d: %s',
-                quiet_time,
-                self.network_idle_time,
+                'wait_network_idle: pending=%d, waiting %s ms: %s',
+                self.pending_requests,
+                'n/a' if timeout is None else round(timeout),
                 self.requests
             )
-            self._sleep(1000)
-            if self.pending_requests > 0:
-                quiet_time = 0
-            else:
-                quiet_time += 1000
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait(),
+                    None if timeout is None else timeout / 1000
+                )
+            except asyncio.TimeoutError:
+                pass
             pass
+
         logger.debug(
-            'wait_network_idle: %d/%d',
-            quiet_time,
+            'wait_network_idle: idle after %d ms (window: %d ms)',
+            self._now() - started,
             self.network_idle_time
         )
+        idle_windows.observe(self.url, self.longest_gap)
         pass
 
     @staticmethod
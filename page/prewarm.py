@@ -0,0 +1,303 @@
+import asyncio
+import gzip
+import statistics
+import time
+import urllib.request
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
+from urllib.parse import urlparse
+
+from util import config
+from util.get_logger import get_logger
+
+from .browserpool import browser_pool
+from .cache import cache_key, cached_at
+from .context import resolve_device_conf
+from .jobs import Job, JobQueue
+from .options import RenderOptions
+
+logger = get_logger(__name__)
+
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+HTTP_SCHEMES = ('http', 'https')
+
+# HTTP(S) only: no file:// or ftp:// (not even through a redirect)
+_http_opener = urllib.request.OpenerDirector()
+for _handler in [
+    urllib.request.ProxyHandler,
+    urllib.request.HTTPHandler,
+    urllib.request.HTTPSHandler,
+    urllib.request.HTTPRedirectHandler,
+    urllib.request.HTTPDefaultErrorHandler,
+    urllib.request.HTTPErrorProcessor
+]:
+    _http_opener.add_handler(_handler())
+    pass
+
+
+class SourceNotAllowed(ValueError):
+    """A sitemap source which is neither an http(s) URL nor (when local
+    sources are allowed) a file"""
+    pass
+
+
+class SitemapEntry(NamedTuple):
+    url: str
+    lastmod: Union[datetime, None] = None
+
+
+def _read(source: str, local: bool = False) -> bytes:
+    """Content of a sitemap source: an http(s) URL or, if `local`, a
+    file path or file:// URL"""
+    scheme = urlparse(source).scheme.lower()
+    if scheme in HTTP_SCHEMES:
+        request = urllib.request.Request(
+            source,
+            headers={'User-Agent': config.get('default_user_agent')}
+        )
+        with _http_opener.open(
+                request,
+                timeout=config.get('prewarm_fetch_timeout')
+        ) as response:
+            data = response.read()
+            pass
+    elif local and scheme in ('', 'file'):
+        path = urllib.request.url2pathname(urlparse(source).path) \
+            if scheme else source
+        with open(path, 'rb') as f:
+            data = f.read()
+            pass
+    else:
+        raise SourceNotAllowed(
+            f'{source}: only http(s) sitemap sources are allowed'
+        )
+        pass
+    if data[:2] == b'\x1f\x8b':  # sitemap.xml.gz
+        data = gzip.decompress(data)
+        pass
+    return data
+
+
+def _parse_lastmod(value: Union[str, None]) -> Union[datetime, None]:
+    if not value:
+        return None
+    try:
+        lastmod = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if lastmod.tzinfo is None:
+        lastmod = lastmod.replace(tzinfo=timezone.utc)
+        pass
+    return lastmod
+
+
+def _page_url(url: str, source: str) -> bool:
+    """Whether a sitemap entry is a page we may render (http(s) only)"""
+    if urlparse(url).scheme.lower() in HTTP_SCHEMES:
+        return True
+    logger.warning('read_sitemap: %s: skipping %.100r', source, url)
+    return False
+
+
+def read_sitemap(
+        source: str,
+        depth: int = 0,
+        local: bool = False
+) -> List[SitemapEntry]:
+    """
+    URLs (and their <lastmod>) of a sitemap, a sitemap index (followed
+    recursively) or a plain text list of URLs - one per line.
+    `source` is an http(s) URL or, if `local` (the CLI), also a file
+    path or file:// URL; sitemaps listed by an index must be http(s).
+    Entries other than http(s) URLs are skipped
+    """
+    data = _read(source, local)
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        return [
+            SitemapEntry(line.strip())
+            for line in data.decode('utf-8').splitlines()
+            if line.strip() and not line.startswith('#')
+            and _page_url(line.strip(), source)
+        ]
+
+    entries: List[SitemapEntry] = []
+    if root.tag == f'{SITEMAP_NS}sitemapindex':
+        if depth >= 3:
+            logger.warning('read_sitemap: %s: nested too deep', source)
+            return entries
+        for sitemap in root.iter(f'{SITEMAP_NS}sitemap'):
+            loc = sitemap.findtext(f'{SITEMAP_NS}loc')
+            if loc:
+                entries.extend(read_sitemap(loc.strip(), depth + 1))
+                pass
+            pass
+        return entries
+
+    for url in root.iter(f'{SITEMAP_NS}url'):
+        loc = url.findtext(f'{SITEMAP_NS}loc')
+        if loc and _page_url(loc.strip(), source):
+            entries.append(SitemapEntry(
+                loc.strip(),
+                _parse_lastmod(url.findtext(f'{SITEMAP_NS}lastmod'))
+            ))
+            pass
+        pass
+    return entries
+
+
+async def _needs_render(
+        entry: SitemapEntry,
+        resolved_device: str,
+        semaphore: asyncio.Semaphore
+) -> bool:
+    async with semaphore:
+        rendered = await asyncio.to_thread(
+            cached_at,
+            resolved_device,
+            entry.url
+        )
+        pass
+    if rendered is None:
+        return True
+    if entry.lastmod is None:
+        return False
+    return rendered < entry.lastmod
+
+
+async def plan(
+        entries: List[SitemapEntry],
+        devices: List[str] = None,
+        force: bool = False
+) -> Tuple[List[Tuple[str, Union[str, None]]], int]:
+    """
+    (url, device) pairs to render - deduplicated by cache key, and
+    without those whose cached copy is newer than their <lastmod> -
+    along with the number of skipped pairs
+    """
+    await browser_pool.start()
+    options = RenderOptions.from_config()
+    semaphore = asyncio.Semaphore(config.get('prewarm_lookup_concurrency'))
+    candidates = []
+    seen = set()
+    for device in devices or config.get('prewarm_devices') or [None]:
+        device = device or None
+        resolved_device, _ = resolve_device_conf(
+            browser_pool.devices,
+            options,
+            device=device
+        )
+        for entry in entries:
+            key = cache_key(resolved_device, entry.url)
+            if key in seen:
+                continue
+            seen.add(key)
+            candidates.append((entry, device, resolved_device))
+            pass
+        pass
+
+    if force:
+        return [(e.url, d) for e, d, _ in candidates], 0
+
+    checks = await asyncio.gather(*[
+        _needs_render(entry, resolved_device, semaphore)
+        for entry, _, resolved_device in candidates
+    ])
+    todo = [
+        (entry.url, device)
+        for (entry, device, _), needed in zip(candidates, checks)
+        if needed
+    ]
+    return todo, len(candidates) - len(todo)
+
+
+def report(job: Job, skipped: int, elapsed: float) -> Dict[str, Any]:
+    counts = job.counts()
+    durations = sorted(
+        i.duration for i in job.items if i.duration is not None
+    )
+    rendered = counts['done'] + counts['failed']
+    return dict(
+        job=job.id,
+        urls=len(job.items) + skipped,
+        skipped=skipped,
+        rendered=counts['done'],
+        failed=counts['failed'],
+        elapsed=round(elapsed, 3),
+        pages_per_second=round(rendered / elapsed, 3) if elapsed else None,
+        render_p50=statistics.median(durations) if durations else None,
+        render_p95=durations[int(0.95 * (len(durations) - 1))]
+        if durations else None,
+        failures=[
+            dict(url=i.url, device=i.device, message=i.message)
+            for i in job.items if i.status == 'failed'
+        ]
+    )
+
+
+async def prewarm(
+        sources: List[str],
+        queue: JobQueue,
+        devices: List[str] = None,
+        force: bool = False,
+        priority: int = 0,
+        local: bool = False
+) -> Tuple[Job, int]:
+    """Queue the renders needed to bring the cache up to date with the
+    given sitemaps/URL lists (`local`: files allowed, see
+    read_sitemap()); returns the job and the skipped count"""
+    for source in sources:
+        if urlparse(source).scheme.lower() not in HTTP_SCHEMES \
+                and not local:
+            raise SourceNotAllowed(
+                f'{source}: only http(s) sitemap sources are allowed'
+            )
+        pass
+    entries: List[SitemapEntry] = []
+    for source in sources:
+        entries.extend(await asyncio.to_thread(
+            read_sitemap,
+            source,
+            local=local
+        ))
+        pass
+    todo, skipped = await plan(entries, devices, force)
+    logger.info(
+        'prewarm: %d url(s) to render, %d up to date',
+        len(todo),
+        skipped
+    )
+    job = await queue.submit_items(
+        todo,
+        priority=priority,
+        overrides=dict(s3_store_pages=True, s3_return_cached_pages=False)
+    )
+    return job, skipped
+
+
+async def run(
+        sources: List[str],
+        devices: List[str] = None,
+        concurrency: int = None,
+        force: bool = False
+) -> Dict[str, Any]:
+    """Pre-warm the cache and wait for it: the CLI entry point"""
+    started = time.monotonic()
+    queue = JobQueue(concurrency=concurrency, db_path='')
+    try:
+        job, skipped = await prewarm(
+            sources,
+            queue,
+            devices,
+            force,
+            local=True
+        )
+        await queue.wait(job)
+    finally:
+        await queue.stop()
+        await browser_pool.stop()
+        pass
+    return report(job, skipped, time.monotonic() - started)
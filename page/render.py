@@ -1,176 +1,586 @@
+import asyncio
+import json
 from datetime import datetime, timezone
-from typing import Callable, Dict, List, Tuple, Union
+from typing import (Awaitable, Callable, Dict, Iterator, NamedTuple, Tuple,
+                    Union)
 
-from playwright.sync_api import Page, TimeoutError, sync_playwright
+from playwright.async_api import Error, Page, TimeoutError
 
-from util import config
 from util.get_logger import get_logger
 
-from .cache import get_page, store_page
-from .context import get_browser_context
+from .artifacts import Artifact, artifact_store
+from .browserpool import browser_pool
+from .cache import cache_key, get_page, store_artifact, store_page
+from .compression import decompress
+from .context import resolve_device_conf
+from .deadline import Deadline, DeadlineExceeded
+from .metrics import (CACHE_LOOKUPS, DEADLINES, PAGE_BYTES, RENDERS, RETRIES,
+                      phase)
+from .options import RenderOptions
 from .pageloader import PageLoader
-from .waitready import ReadyCondition, wait_ready
+from .retry import (FAIL, REPLACE_CONTEXT, RETRY_READY, CircuitOpen,
+                    ContextLost, RetryState, backoff, circuit_breaker,
+                    classify)
+from .singleflight import SingleFlight
+from .waitready import wait_ready
 
-type OnPageReady = Callable[[Page], None]
+type OnPageReady = Callable[[Page], Awaitable[None]]
 
 
 logger = get_logger(__name__)
 
+# Share of the remaining render budget the ready conditions wait may
+# use, leaving time for post-processing and a retry
+READY_BUDGET_SHARE = 0.8
 
-def render_page(context, ready_conditions, url):
-    if config.get('preload_pages'):
-        page = context.new_page()
-        page.goto(url)
-        page.close()
+
+async def render_page(
+        context,
+        url: str,
+        options: RenderOptions,
+        deadline: Deadline = None,
+        retry: RetryState = None
+):
+    """
+    Load `url` in a new page of `context` and wait until it is ready.
+
+    Failed attempts are classified (see retry.classify()) and retried,
+    up to `options.max_tries` attempts in all: readiness timeouts wait
+    again on the same page (once, unless a single attempt is left) then
+    reload it, navigation timeouts, 5xx and
+    connection errors reload the page after a backoff, crashes raise
+    ContextLost for the caller to retry in a new context; the rest
+    (e.g. DNS errors) fail fast.
+    """
+    deadline = deadline or Deadline()
+    retry = retry or RetryState(options.max_tries)
+    if options.preload_pages and not retry.tries:
+        with phase('preload'):
+            page = await context.new_page()
+            try:
+                await page.goto(url, timeout=deadline.timeout())
+            except DeadlineExceeded:
+                raise
+            except Error as e:
+                # a warm-up only: the load proper reports the failure
+                logger.debug('render: %s: preload failed: %s', url, e)
+                pass
+            finally:
+                await _close_page(page)
+                pass
+            pass
         pass
-    max_tries = config.get('max_tries')
-    for i in range(max_tries):
+    page: Union[Page, None] = None
+    ready_retries = 0
+    while True:
+        stage = 'load' if page is None else 'ready'
+        retry.tries += 1
         try:
-            page_loader = PageLoader(context.new_page(), url)
-            page = page_loader.load()
-            return wait_ready(page, ready_conditions)
-        except TimeoutError as e:
-            if i < max_tries - 1:
-                logger.debug(
-                    'render: retrying (%d/%d)',
-                    i + 1,
-                    max_tries - 1
+            deadline.check('render_page')
+            if page is None:
+                page = await context.new_page()
+                await PageLoader(page, url, options, deadline).load()
+                circuit_breaker.success(url)
+                stage = 'ready'
+                pass
+            with phase('ready'):
+                return await wait_ready(
+                    page,
+                    options.ready_conditions,
+                    deadline.timeout(
+                        READY_BUDGET_SHARE,
+                        options.ready_timeout
+                    )
                 )
-                continue
-            raise e
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            failure = classify(e, stage, ready_retries, retry.last_try())
+            if failure.origin:
+                circuit_breaker.failure(url)
+                pass
+            if isinstance(e, TimeoutError) and deadline.expired():
+                raise DeadlineExceeded(
+                    f'{url}: {deadline.budget} ms render deadline exceeded'
+                ) from e
+            retry.failures.append(failure.kind)
+            if failure.action == FAIL or retry.exhausted():
+                raise e
+            RETRIES.inc(error=failure.kind)
+            logger.debug(
+                'render: %s: %s, %s (%d/%d)',
+                url,
+                failure.kind,
+                failure.action,
+                retry.tries,
+                retry.max_tries - 1
+            )
+            if failure.action == REPLACE_CONTEXT:
+                raise ContextLost(f'{url}: {e}') from e
+            if failure.action == RETRY_READY:
+                ready_retries += 1
+            else:
+                ready_retries = 0
+                if page is not None:
+                    await _close_page(page)
+                    page = None
+                    pass
+                pass
+            if failure.backoff:
+                await backoff(retry, deadline.remaining())
+                pass
+            pass
         pass
-    raise AssertionError('HDIGH: could not resolve page')
 
 
-def delete_elements(page: Page, sel: str):
-    page.evaluate(
-        f"document.querySelectorAll('{sel}').forEach(s => s.remove())"
-    )
+async def _close_page(page: Page):
+    try:
+        await page.close()
+    except Exception as e:
+        logger.debug('render: error closing page: %s', e)
+        pass
     pass
 
 
-def clean_page(page, remove_elements):
+# removes javascript `script` tags
+SCRIPT_SELECTOR = \
+    'script:not([type]),script[type="text/javascript"],script[type="module"]'
 
-    delete_elements(  # remove javascript `script` tags
-        page,
-        'script:not([type]),script[type="text/javascript"],script[type="module"]'  # noqa: E501
-    )
+# Post render cleanup, in a single round trip: removes the elements
+# matching `remove`, prepends the `metas` (and `base`) to <head>
+# (the first one ending up first) and returns the serialized page
+# along with the user agent
+POST_PROCESS_JS = """
+({remove, metas, base}) => {
+    for (const selector of remove) {
+        document.querySelectorAll(selector).forEach(e => e.remove());
+    }
+    const userAgent = navigator.userAgent;
+    const head = document.head;
+    const elements = [];
+    if (base) {
+        const e = document.createElement('base');
+        e.href = base;
+        elements.push(e);
+    }
+    for (const [name, content] of metas) {
+        const e = document.createElement('meta');
+        e.name = name;
+        e.content = content === null ? userAgent : content;
+        elements.push(e);
+    }
+    head.prepend(...elements);
+    let html = '';
+    if (document.doctype) {
+        html = new XMLSerializer().serializeToString(document.doctype);
+    }
+    if (document.documentElement) {
+        html += document.documentElement.outerHTML;
+    }
+    return {html, userAgent};
+}
+"""
 
-    if remove_elements:
-        for selector in remove_elements:
-            logger.debug('render: removing elements: %s', selector)
-            delete_elements(page, selector)
-            pass
+
+async def post_process(
+        page: Page,
+        options: RenderOptions,
+        url: str,
+        resolved_device: str,
+        rendered_at: datetime
+) -> Tuple[str, str]:
+    """Clean up the page and add our meta tags; returns the html and
+    the page user agent"""
+    if options.remove_elements:
+        logger.debug('render: removing elements: %s', options.remove_elements)
         pass
-    return page
+    result = await page.evaluate(
+        POST_PROCESS_JS,
+        dict(
+            remove=[SCRIPT_SELECTOR, *options.remove_elements],
+            metas=[
+                ['x-spa-renderer-device', resolved_device],
+                ['x-spa-renderer-timestamp', rendered_at.isoformat()],
+                ['x-spa-renderer-ua', None]  # navigator.userAgent
+            ],
+            base=url if options.add_base_url else None
+        )
+    )
+    return result['html'], result['userAgent']
 
 
-def add_meta(page: Page, name: str, content: str):
-    page.evaluate(f"""
-    let meta = document.createElement('meta');
-    meta.name = '{name}';
-    meta.content = '{content}';
-    document.head.insertBefore(meta, document.head.firstElementChild);
-    """)
-    pass
+class RenderResult(NamedTuple):
+    body: bytes
+    cache_hit: bool
+    s3_url: str
+    device: str
+    user_agent: str
+    cache_stale: bool = False
+    content_encoding: str = ''  # of `body`, cache hits may be compressed
+    stream: Union[Iterator[bytes], None] = None  # instead of `body`
+    deadline_exceeded: bool = False  # cached copy served instead
+    artifact: Union[Artifact, None] = None  # render_to_disk: no `body`
 
+    @property
+    def html(self) -> str:
+        """Decoded page (consumes `stream`, if any)"""
+        if self.artifact:
+            return self.artifact.read().decode('utf-8')
+        body = b''.join(self.stream) if self.stream else self.body
+        return decompress(body, self.content_encoding).decode('utf-8')
 
-def add_base(add_base_url, page, url):
-    if add_base_url is None:
-        add_base_url = config.get('add_base_url')
-        pass
-    if add_base_url:
-        page.evaluate(f"""
-            let base = document.createElement('base');
-            base.href = '{url}';
-            document.head.insertBefore(base, document.head.firstElementChild);
-            """)  # noqa: E501
-        pass
+
+render_flight = SingleFlight('render')
+_revalidating: Dict[str, asyncio.Task] = {}
 
 
-def render(
+async def render(
         url: str,
+        options: RenderOptions = None,
         on_ready: OnPageReady = None,
         screen: str = None,
         user_agent=None,
-        device: str = None
-) -> Tuple[str, bool, str]:
-    config.log_conf()
-
-    ready_conditions: List[ReadyCondition] = config.get('ready_conditions')
-    remove_elements: List[str] = config.get('remove_elements')
-    add_base_url: bool = config.get('add_base_url')
-    debug: bool = config.get('debug')
-    user_agent_append: str = config.get('user_agent_append')
-    extra_headers: Dict[str, str] = config.get('extra_http_headers')
-
-    if debug is None:
-        debug = config.get('debug')
-        pass
+        device: str = None,
+        stream: bool = False
+) -> RenderResult:
+    """
+    Render `url` (or fetch it from cache).
 
-    if extra_headers is None:
-        extra_headers = config.get('extra_http_headers') or {}
+    Concurrent renders of the same page (same cache key, device
+    configuration and options) are coalesced into a single browser
+    job; `on_ready` is only called by the request which ran it.
+    With `stream`, S3 cache hits are returned as a chunk `stream`
+    rather than a `body`.
+
+    Renders are bounded by `options.default_timeout`: past it, the
+    last cached copy of the page (if any) is returned, otherwise
+    DeadlineExceeded is raised. So are renders of a host whose circuit
+    breaker is open (CircuitOpen).
+    """
+    if options is None:
+        options = RenderOptions.from_config()
         pass
+    deadline = Deadline(options.default_timeout)
 
-    with sync_playwright() as playwright:
+    logger.debug('render: url=%s, options=%s', url, options)
 
-        context, resolved_device = get_browser_context(
-            playwright,
-            screen=screen,
-            debug=debug,
-            user_agent=user_agent,
-            user_agent_append=user_agent_append,
-            device=device,
-            extra_headers=extra_headers
-        )
+    await browser_pool.start()
+    resolved_device, device_conf = resolve_device_conf(
+        browser_pool.devices,
+        options,
+        screen=screen,
+        user_agent=user_agent,
+        device=device
+    )
 
-        err = None
-        page: Union[Page, None] = None
-        try:
-            if config.get(
-                's3_store_pages'
-            ) and config.get(
-                's3_return_cached_pages'
-            ):
-                html, s3_url = get_page(resolved_device, url)
-                if html:
-                    return html, True, s3_url
+    cache_miss = False
+    if options.s3_store_pages and options.s3_return_cached_pages:
+        with phase('cache_get'):
+            cached = await asyncio.to_thread(
+                get_page,
+                resolved_device,
+                url,
+                stream
+            )
+            pass
+        stale = bool(cached) and cached.stale()
+        CACHE_LOOKUPS.inc(
+            result='miss' if not cached else 'stale' if stale else 'hit'
+        )
+        cache_miss = not cached
+        if stale and not options.s3_stale_while_revalidate:
+            logger.debug('render: %s: cached copy is stale', url)
+            cached.close()
+            cached = None
+            pass
+        if cached:
+            if stale:
+                _revalidate(url, options, resolved_device, device_conf)
                 pass
+            return RenderResult(
+                body=cached.body,
+                cache_hit=True,
+                s3_url=cached.s3_url,
+                device=resolved_device,
+                user_agent=device_conf.get('user_agent') or '',
+                cache_stale=stale,
+                content_encoding=cached.content_encoding,
+                stream=cached.stream
+            )
+        pass
 
-            page = render_page(
-                context,
-                ready_conditions,
-                url
+    key = _flight_key(url, options, resolved_device, device_conf)
+    try:
+        async with asyncio.timeout(deadline.seconds()):
+            result, shared = await render_flight.do(
+                key,
+                lambda: _render(
+                    url,
+                    options,
+                    resolved_device,
+                    device_conf,
+                    on_ready,
+                    deadline
+                )
+            )
+            pass
+    except (asyncio.TimeoutError, DeadlineExceeded) as e:
+        cached = None
+        if not cache_miss and options.s3_store_pages:
+            cached = await _last_cached(
+                url,
+                resolved_device,
+                device_conf,
+                stream,
+                'deadline exceeded'
             )
+            pass
+        if cached is None:
+            DEADLINES.inc(outcome='failed')
+            raise DeadlineExceeded(f'{url}: {e}') from e
+        DEADLINES.inc(outcome='cached')
+        return cached._replace(deadline_exceeded=True)
+    except CircuitOpen as e:
+        cached = None
+        if not cache_miss and options.s3_store_pages:
+            cached = await _last_cached(
+                url,
+                resolved_device,
+                device_conf,
+                stream,
+                'circuit open'
+            )
+            pass
+        if cached is None:
+            raise e
+        return cached
+    if shared:
+        logger.debug('render: %s: served by an in-flight render', url)
+        pass
+    return result
 
-            clean_page(page, remove_elements)
 
-            add_meta(
-                page,
-                'x-spa-renderer-ua',
-                page.evaluate('navigator.userAgent')
+async def _last_cached(
+        url: str,
+        resolved_device: str,
+        device_conf: dict,
+        stream: bool,
+        reason: str
+) -> Union[RenderResult, None]:
+    """The last cached copy (if any) of a page which could not be rendered
+    (deadline exceeded, circuit open)"""
+    cached = await asyncio.to_thread(get_page, resolved_device, url, stream)
+    if cached is None:
+        return None
+    logger.warning(
+        'render: %s: %s, serving the copy rendered at %s',
+        url,
+        reason,
+        cached.rendered_at
+    )
+    return RenderResult(
+        body=cached.body,
+        cache_hit=True,
+        s3_url=cached.s3_url,
+        device=resolved_device,
+        user_agent=device_conf.get('user_agent') or '',
+        cache_stale=cached.stale(),
+        content_encoding=cached.content_encoding,
+        stream=cached.stream
+    )
+
+
+def _flight_key(
+        url: str,
+        options: RenderOptions,
+        resolved_device: str,
+        device_conf: dict
+) -> tuple:
+    """render_flight key: renders of the same page, device configuration
+    and options are coalesced"""
+    return (
+        cache_key(resolved_device, url),
+        json.dumps(device_conf, sort_keys=True),
+        options
+    )
+
+
+def _revalidate(
+        url: str,
+        options: RenderOptions,
+        resolved_device: str,
+        device_conf: dict
+):
+    """Re-render a stale page in the background (once per cache key),
+    coalesced with renders of the same page already in flight"""
+    key = cache_key(resolved_device, url)
+    if key in _revalidating:
+        return
+
+    async def revalidate():
+        try:
+            await render_flight.do(
+                _flight_key(url, options, resolved_device, device_conf),
+                lambda: _render(
+                    url,
+                    options,
+                    resolved_device,
+                    device_conf,
+                    None,
+                    Deadline(options.default_timeout)
+                )
+            )
+            logger.debug('render: %s: revalidated', key)
+        except Exception as e:
+            logger.warning('render: %s: revalidation failed: %s', key, e)
+            pass
+        finally:
+            del _revalidating[key]
+            pass
+        pass
+
+    logger.debug('render: %s: stale, revalidating in background', key)
+    _revalidating[key] = asyncio.create_task(revalidate())
+    pass
+
+
+async def _render(
+        url: str,
+        options: RenderOptions,
+        resolved_device: str,
+        device_conf: dict,
+        on_ready: OnPageReady,
+        deadline: Deadline
+) -> RenderResult:
+    probe = circuit_breaker.check(url)
+    try:
+        # hard bound, in case a step does not honour its own timeout
+        async with asyncio.timeout(deadline.seconds()):
+            return await _render_page(
+                url,
+                options,
+                resolved_device,
+                device_conf,
+                on_ready,
+                deadline
             )
-            add_meta(
-                page,
-                'x-spa-renderer-timestamp',
-                datetime.now(timezone.utc).isoformat()
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceeded(
+            f'{url}: {deadline.budget} ms render deadline exceeded'
+        ) from e
+    finally:
+        circuit_breaker.release(url, probe)
+        pass
+
+
+async def _render_page(
+        url: str,
+        options: RenderOptions,
+        resolved_device: str,
+        device_conf: dict,
+        on_ready: OnPageReady,
+        deadline: Deadline
+) -> RenderResult:
+    retry = RetryState(options.max_tries)
+    while True:
+        try:
+            return await _render_in_context(
+                url,
+                options,
+                resolved_device,
+                device_conf,
+                on_ready,
+                deadline,
+                retry
             )
-            add_meta(page, 'x-spa-renderer-device', resolved_device)
-            add_base(add_base_url, page, url)
+        except ContextLost as e:
+            logger.warning('render: %s, retrying in a new context', e)
+            pass
+        pass
+
+
+async def _render_in_context(
+        url: str,
+        options: RenderOptions,
+        resolved_device: str,
+        device_conf: dict,
+        on_ready: OnPageReady,
+        deadline: Deadline,
+        retry: RetryState
+) -> RenderResult:
+    async with browser_pool.browser_context(
+            options,
+            device_conf
+    ) as context:
+
+        err = None
+        page: Union[Page, None] = None
+        try:
+            page = await render_page(context, url, options, deadline, retry)
+
+            rendered_at = datetime.now(timezone.utc)
+            with phase('postprocess'):
+                html, page_user_agent = await post_process(
+                    page,
+                    options,
+                    url,
+                    resolved_device,
+                    rendered_at
+                )
+                pass
+            artifact = None
+            if options.render_to_disk:
+                with phase('artifact'):
+                    artifact = await asyncio.to_thread(
+                        artifact_store.write,
+                        html,
+                        dict(
+                            url=url,
+                            device=resolved_device,
+                            user_agent=page_user_agent,
+                            rendered_at=rendered_at.isoformat()
+                        )
+                    )
+                    pass
+                html = None  # only the artifact file copy is kept
+                body = b''
+                PAGE_BYTES.observe(artifact.size, kind='rendered')
+            else:
+                body = html.encode('utf-8')
+                PAGE_BYTES.observe(len(body), kind='rendered')
+                pass
 
             s3_url = ''
-            html = page.content()
-            if config.get('s3_store_pages'):
-                s3_url = store_page(html, url, resolved_device)
+            if options.s3_store_pages:
+                s3_url = await asyncio.to_thread(
+                    store_artifact if artifact else store_page,
+                    artifact or html,
+                    url,
+                    resolved_device,
+                    rendered_at,
+                    options.s3_cache_ttl
+                )
                 pass
-            return html, False, s3_url
+            RENDERS.inc(result='ok')
+            return RenderResult(
+                body=body,
+                cache_hit=False,
+                s3_url=s3_url,
+                device=resolved_device,
+                user_agent=page_user_agent,
+                artifact=artifact
+            )
 
+        except ContextLost as e:
+            err = e
+            raise e
         except Exception as e:
             err = e
+            RENDERS.inc(result='error')
             logger.exception('render: error while rendering %s: %s', url, e)
             raise e
         finally:
             if on_ready and page and not err:
-                on_ready(page)
+                await on_ready(page)
                 pass
             pass
@@ -0,0 +1,272 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from typing import Dict, List, NamedTuple, Union
+from urllib.parse import urlparse
+
+from playwright.async_api import Error, TimeoutError
+
+from util import config
+from util.get_logger import get_logger
+
+logger = get_logger(__name__)
+
+# Retry actions
+RETRY_READY = 'retry_ready'  # wait for the ready conditions again
+REPLACE_PAGE = 'replace_page'  # load the URL again, in a new page
+REPLACE_CONTEXT = 'replace_context'  # ... in a new context (and browser)
+FAIL = 'fail'
+
+# net::ERR_* navigation errors which won't go away by retrying
+_DNS_ERRORS = ('ERR_NAME_NOT_RESOLVED', 'ERR_NAME_RESOLUTION_FAILED')
+_CRASH_MESSAGES = (
+    'crashed',
+    'has been closed',
+    'has disconnected',
+    'Browser closed'
+)
+
+
+class OriginError(Exception):
+    """The page itself was served with a 5xx status"""
+
+    def __init__(self, url: str, status: int):
+        super().__init__(f'{url}: origin responded with status {status}')
+        self.status = status
+        pass
+
+
+class ContextLost(Exception):
+    """The page, context or browser crashed: retry in a new context"""
+    pass
+
+
+class CircuitOpen(Exception):
+    """Renders of the host are suspended after repeated origin failures"""
+
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(
+            f'{host}: circuit open after repeated origin failures, '
+            f'retry after {retry_after:.0f}s'
+        )
+        self.host = host
+        self.retry_after = retry_after
+        pass
+
+
+class Failure(NamedTuple):
+    kind: str  # navigation_timeout, ready_timeout, origin_error, dns,
+    #            connection, crash, other
+    action: str
+    origin: bool  # counts against the host's circuit breaker
+    backoff: bool
+
+
+def classify(
+        error: BaseException,
+        stage: str,
+        ready_retries: int = 0,
+        last_try: bool = False
+) -> Failure:
+    """
+    The kind of a failed render attempt, and what to do about it.
+    `stage` is `load` (navigation and network idleness) or `ready`
+    (ready conditions, the page loaded); `ready_retries` counts the
+    ready waits already repeated on the current page, `last_try` tells
+    whether a single attempt is left.
+    """
+    if isinstance(error, TimeoutError):
+        if stage == 'ready':
+            # the SPA may just be slow: wait on the same page once, then
+            # reload it, in case it got stuck (e.g. on a failed API call);
+            # with a single attempt left, reloading is the better bet
+            return Failure(
+                'ready_timeout',
+                RETRY_READY if not ready_retries and not last_try
+                else REPLACE_PAGE,
+                False,
+                False
+            )
+        return Failure('navigation_timeout', REPLACE_PAGE, True, True)
+    if isinstance(error, OriginError):
+        return Failure('origin_error', REPLACE_PAGE, True, True)
+    if isinstance(error, Error):
+        message = str(error)
+        if any(e in message for e in _DNS_ERRORS):
+            return Failure('dns', FAIL, True, False)
+        if 'net::ERR_' in message:
+            return Failure('connection', REPLACE_PAGE, True, True)
+        if any(m in message for m in _CRASH_MESSAGES):
+            return Failure('crash', REPLACE_CONTEXT, False, False)
+        pass
+    return Failure('other', FAIL, False, False)
+
+
+class RetryState:
+    """Attempts of one render, across the pages and contexts it used"""
+
+    def __init__(
+            self,
+            max_tries: int,
+            backoff_ms: int = None,
+            backoff_max_ms: int = None
+    ):
+        self.max_tries = max(max_tries, 1)
+        self.backoff_ms = backoff_ms if backoff_ms is not None \
+            else config.get('retry_backoff_ms')
+        self.backoff_max_ms = backoff_max_ms if backoff_max_ms is not None \
+            else config.get('retry_backoff_max_ms')
+        self.tries = 0
+        self.backoffs = 0
+        self.failures: List[str] = []
+        pass
+
+    def exhausted(self) -> bool:
+        return self.tries >= self.max_tries
+
+    def last_try(self) -> bool:
+        """Whether a single attempt is left"""
+        return self.max_tries - self.tries == 1
+
+    def delay(self) -> float:
+        """Next backoff delay (seconds): exponential, with full jitter"""
+        if not self.backoff_ms:
+            return 0
+        ceiling = self.backoff_ms * 2 ** self.backoffs
+        if self.backoff_max_ms:
+            ceiling = min(ceiling, self.backoff_max_ms)
+            pass
+        self.backoffs += 1
+        return random.uniform(ceiling / 2, ceiling) / 1000
+
+
+class _Circuit:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Union[float, None] = None
+        self.probe: Union[int, None] = None  # the probe render in flight
+        pass
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker: after `threshold` consecutive origin
+    failures (navigation timeouts, 5xx, DNS and connection errors) the
+    host's renders fail fast for `cooldown` seconds. Then a single probe
+    render is let through: a page load closes the circuit again, another
+    origin failure re-opens it.
+    """
+
+    def __init__(self, threshold: int = None, cooldown: float = None):
+        self.threshold = threshold if threshold is not None \
+            else config.get('circuit_breaker_threshold')
+        self.cooldown = cooldown if cooldown is not None \
+            else config.get('circuit_breaker_cooldown')
+        self._circuits: Dict[str, _Circuit] = {}
+        self._lock = threading.Lock()
+        self._probes = itertools.count(1)
+        pass
+
+    @staticmethod
+    def host(url: str) -> str:
+        return urlparse(url).hostname or ''
+
+    def check(self, url: str) -> Union[int, None]:
+        """Raise CircuitOpen unless a render of `url` may go ahead; if it
+        is the probe, returns its token (for release())"""
+        if not self.threshold:
+            return None
+        host = self.host(url)
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.opened_at is None:
+                return None
+            retry_after = circuit.opened_at + self.cooldown - time.monotonic()
+            if retry_after > 0 or circuit.probe is not None:
+                raise CircuitOpen(host, max(retry_after, 1))
+            circuit.probe = next(self._probes)  # half open
+            probe = circuit.probe
+            pass
+        logger.info('circuit_breaker: %s: probing', host)
+        return probe
+
+    def success(self, url: str):
+        host = self.host(url)
+        with self._lock:
+            circuit = self._circuits.pop(host, None)
+            pass
+        if circuit is not None and circuit.opened_at is not None:
+            logger.info('circuit_breaker: %s: closed', host)
+            pass
+        pass
+
+    def failure(self, url: str):
+        if not self.threshold:
+            return
+        host = self.host(url)
+        with self._lock:
+            circuit = self._circuits.setdefault(host, _Circuit())
+            circuit.failures += 1
+            probing = circuit.probe is not None
+            if probing or circuit.failures >= self.threshold:
+                opened = circuit.opened_at is None or probing
+                circuit.opened_at = time.monotonic()
+                circuit.probe = None
+            else:
+                opened = False
+                pass
+            pass
+        if opened:
+            logger.warning(
+                'circuit_breaker: %s: open for %ss after %d failure(s)',
+                host,
+                self.cooldown,
+                circuit.failures
+            )
+            pass
+        pass
+
+    def release(self, url: str, probe: Union[int, None]):
+        """End of a render (`probe`: what check() returned): a probe which
+        did not reach the origin (e.g. deadline, crash) lets the next
+        render probe"""
+        if probe is None:
+            return
+        with self._lock:
+            circuit = self._circuits.get(self.host(url))
+            if circuit is not None and circuit.probe == probe:
+                circuit.probe = None
+                pass
+            pass
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, bool]]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                host: dict(
+                    failures=c.failures,
+                    open=c.opened_at is not None
+                    and now < c.opened_at + self.cooldown,
+                    probing=c.probe is not None
+                )
+                for host, c in self._circuits.items()
+            }
+
+
+circuit_breaker = CircuitBreaker()
+
+
+async def backoff(state: RetryState, remaining_ms: Union[float, None]):
+    """Sleep before the next attempt, leaving at least half of the
+    remaining render budget to it"""
+    delay = state.delay()
+    if remaining_ms is not None:
+        delay = min(delay, remaining_ms / 2000)
+        pass
+    if delay > 0:
+        await asyncio.sleep(delay)
+        pass
+    pass
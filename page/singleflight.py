@@ -0,0 +1,55 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+from util.get_logger import get_logger
+
+T = TypeVar('T')
+
+logger = get_logger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing the same key into a single call.
+
+    The first caller for a key starts the work in its own task; callers
+    arriving while it is in flight wait on that same task and get its
+    result (or exception). The work is shielded, so a cancelled caller
+    (e.g. a disconnected client) does not abort it for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        pass
+
+    async def do(
+            self,
+            key: Hashable,
+            fun: Callable[[], Awaitable[T]]
+    ) -> Tuple[T, bool]:
+        """Return `fun()`'s result and whether it was shared with a
+        call already in flight"""
+        self.calls += 1
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+            logger.debug('%s: joining in-flight call: %s', self.name, key)
+        else:
+            task = asyncio.ensure_future(fun())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            pass
+        return await asyncio.shield(task), shared
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+            pass
+        pass
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Mapping, Union
+
+from playwright.async_api import Error, Page, Response, Route
+
+from util import config
+from util.get_logger import get_logger
+
+from .localcache import LocalCache
+
+logger = get_logger(__name__)
+
+MAX_AGE_RE = re.compile(r'(?:^|,)\s*(?:s-maxage|max-age)\s*=\s*"?(\d+)')
+
+# hop-by-hop or no longer accurate once the body was decoded
+_DROP_HEADERS = {
+    'content-encoding',
+    'content-length',
+    'transfer-encoding',
+    'connection',
+    'keep-alive',
+    'set-cookie'
+}
+
+# request headers which make a response private unless marked `public`
+_CREDENTIAL_HEADERS = ('authorization', 'cookie')
+
+
+class SubresourceCache:
+    """
+    Cross-render cache of immutable or long max-age subresource
+    responses (JS bundles, CSS, config JSON), served through page.route()
+    interception to later renders instead of being downloaded again.
+
+    Entries live in a memory LRU spilling to an optional disk LRU (the
+    local cache tier classes), keyed by URL, the request headers listed
+    in `subresource_cache_key_headers` and the render's
+    `extra_http_headers`, and expire with their `max-age`.
+
+    Requests are only intercepted (and their responses buffered) once
+    a response for the same key was seen to be cacheable: the others
+    go straight to the network.
+    """
+
+    def __init__(
+            self,
+            memory_bytes: int = None,
+            directory: str = None,
+            disk_bytes: int = None,
+            max_entry_bytes: int = None,
+            max_keys: int = 65536
+    ):
+        self.cache = LocalCache(
+            memory_bytes=memory_bytes if memory_bytes is not None
+            else config.get('subresource_cache_memory_bytes'),
+            directory=directory if directory is not None
+            else config.get('subresource_cache_dir'),
+            disk_bytes=disk_bytes if disk_bytes is not None
+            else config.get('subresource_cache_disk_bytes'),
+            ttl=0,
+            max_entry_bytes=max_entry_bytes if max_entry_bytes is not None
+            else config.get('subresource_cache_max_entry_bytes')
+        )
+        self.min_max_age = config.get('subresource_cache_min_max_age')
+        self.resource_types = frozenset(
+            config.get('subresource_cache_resource_types') or []
+        )
+        self.key_headers = tuple(
+            h.lower()
+            for h in config.get('subresource_cache_key_headers') or []
+        )
+        self.max_keys = max_keys
+        # keys whose last response seen was cacheable (a bounded LRU)
+        self._cacheable: OrderedDict[str, None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.uncacheable = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        pass
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache.accepts(0) and bool(self.resource_types)
+
+    async def attach(
+            self,
+            page: Page,
+            extra_http_headers: Mapping[str, str] = None
+    ):
+        if self.enabled:
+            extra = sorted(
+                (k.lower(), v) for k, v in (extra_http_headers or {}).items()
+            )
+            await page.route('**/*', lambda r: self._handle(r, extra))
+            page.on('response', lambda r: self._observe(r, extra))
+            pass
+        pass
+
+    def key(
+            self,
+            url: str,
+            headers: Dict[str, str],
+            extra_http_headers: list = ()
+    ) -> str:
+        return json.dumps([
+            url,
+            *[headers.get(h, '') for h in self.key_headers],
+            *extra_http_headers
+        ])
+
+    def ttl(
+            self,
+            headers: Dict[str, str],
+            credentials: bool = False
+    ) -> Union[int, None]:
+        """
+        Seconds a response may be reused for (0: forever), None if it
+        is not cacheable - as for responses to requests with
+        `credentials` (authorization, cookies) not marked `public`
+        """
+        cache_control = headers.get('cache-control', '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control or \
+                'no-cache' in cache_control or 'set-cookie' in headers:
+            return None
+        if credentials and 'public' not in cache_control:
+            return None
+        vary = {
+            v.strip().lower()
+            for v in headers.get('vary', '').split(',') if v.strip()
+        }
+        if vary - {'accept-encoding', *self.key_headers}:
+            return None
+        match = MAX_AGE_RE.search(cache_control)
+        max_age = int(match.group(1)) if match else 0
+        if 'immutable' in cache_control:
+            return max_age
+        if max_age and max_age >= self.min_max_age:
+            return max_age
+        return None
+
+    def _wanted(self, method: str, resource_type: str) -> bool:
+        return method == 'GET' and resource_type in self.resource_types
+
+    def _remember(self, key: str, cacheable: bool):
+        with self._lock:
+            if cacheable:
+                self._cacheable[key] = None
+                self._cacheable.move_to_end(key)
+                while len(self._cacheable) > self.max_keys:
+                    self._cacheable.popitem(last=False)
+                    pass
+            else:
+                self._cacheable.pop(key, None)
+                pass
+            pass
+        pass
+
+    def _known_cacheable(self, key: str) -> bool:
+        with self._lock:
+            return key in self._cacheable
+
+    async def _observe(self, response: Response, extra_http_headers: list):
+        """Remember the keys of cacheable responses the page fetched
+        without interception, to intercept them from then on"""
+        request = response.request
+        if response.status != 200 or \
+                not self._wanted(request.method, request.resource_type) or \
+                self.ttl(response.headers) is None:
+            return
+        try:
+            request_headers = await request.all_headers()
+            response_headers = await response.all_headers()
+        except Error as e:
+            logger.debug('subresources: %s: %s', request.url, e)
+            return
+        credentials = any(h in request_headers for h in _CREDENTIAL_HEADERS)
+        if self.ttl(response_headers, credentials) is not None:
+            self._remember(
+                self.key(request.url, request_headers, extra_http_headers),
+                True
+            )
+            pass
+        pass
+
+    async def _handle(self, route: Route, extra_http_headers: list):
+        request = route.request
+        if not self._wanted(request.method, request.resource_type):
+            await route.fallback()
+            return
+
+        request_headers = await request.all_headers()
+        key = self.key(request.url, request_headers, extra_http_headers)
+        entry = await asyncio.to_thread(self.cache.get, key)
+        if entry is not None:
+            self._count(hit=True, size=len(entry.body))
+            await route.fulfill(
+                status=int(entry.meta['status']),
+                headers=json.loads(entry.meta['headers']),
+                body=entry.body
+            )
+            return
+        if not self._known_cacheable(key):
+            await route.fallback()
+            return
+
+        try:
+            response = await route.fetch()
+        except Error as e:
+            # the request was sent: fail it rather than sending it again
+            logger.debug('subresources: %s: fetch failed: %s', request.url, e)
+            try:
+                await route.abort('failed')
+            except Error:
+                pass
+            return
+        body = await response.body()
+        response_headers = {
+            k.lower(): v for k, v in response.headers.items()
+        }
+        headers = {
+            k: v
+            for k, v in response_headers.items()
+            if k not in _DROP_HEADERS
+        }
+        credentials = any(h in request_headers for h in _CREDENTIAL_HEADERS)
+        ttl = self.ttl(response_headers, credentials) \
+            if response.status == 200 else None
+        if ttl is not None and self.cache.accepts(len(body)):
+            await asyncio.to_thread(
+                self.cache.put,
+                key,
+                body,
+                dict(status=str(response.status), headers=json.dumps(headers)),
+                ttl
+            )
+            self._count(stored=True)
+        else:
+            self._remember(key, False)
+            self._count()
+            pass
+        await route.fulfill(
+            status=response.status,
+            headers=headers,
+            body=body
+        )
+        pass
+
+    def _count(self, hit: bool = False, stored: bool = False, size: int = 0):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_served += size
+            else:
+                self.misses += 1
+                if stored:
+                    self.stores += 1
+                else:
+                    self.uncacheable += 1
+                    pass
+                pass
+            pass
+        pass
+
+    def stats(self) -> Dict[str, Union[int, float, Dict[str, int]]]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=round(self.hits / lookups, 3) if lookups else None,
+                stores=self.stores,
+                uncacheable=self.uncacheable,
+                bytes_served=self.bytes_served,
+                **self.cache.stats()
+            )
+
+
+subresource_cache = SubresourceCache()
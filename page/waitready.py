@@ -1,6 +1,8 @@
-from typing import List, Literal, Tuple
+import re
+import time
+from typing import Any, Dict, List, Literal, Set, Tuple
 
-from playwright.sync_api import Page
+from playwright.async_api import Error, Page, TimeoutError
 
 from util.get_logger import get_logger
 
@@ -13,12 +15,194 @@ type ReadyCondition = Tuple[
 
 logger = get_logger(__name__)
 
+# Playwright-only selector engines (text=, role=...) and chains (>>)
+# can't be evaluated in the page: conditions using them fall back to
+# sequential wait_for_selector() calls
+_ENGINE_RE = re.compile(r'^\s*([a-zA-Z_-]+)\s*=')
+# ... and so do those querySelector() rejects, e.g. Playwright's CSS
+# extensions (:has-text(), :visible...), once seen
+_sequential_selectors: Set[str] = set()
+_SEQUENTIAL_SELECTORS_MAX = 1024
 
-def _wait_conditions(page: Page, ready_conditions: List[ReadyCondition]):
+# page.evaluate() error when the page navigates during the wait
+_CONTEXT_DESTROYED = 'Execution context was destroyed'
+
+# Waits for all the ready conditions at once, re-checking them on DOM
+# mutations: resolves once every triggered condition holds (conditions
+# whose trigger is absent by then are ignored) or at the deadline.
+# Condition timings are in milliseconds since the waiter started.
+# CSS selectors also match in open shadow roots, like Playwright's; if
+# querySelector() rejects any, resolves with them (`unsupported`) at once.
+WAIT_READY_JS = """
+({conditions, timeout}) => new Promise((resolve, reject) => {
+    const t0 = performance.now();
+    const since = () => Math.round(performance.now() - t0);
+    const xpathOf = selector => {
+        if (selector.startsWith('xpath=')) {
+            return selector.slice(6);
+        }
+        if (selector.startsWith('//') || selector.startsWith('..')) {
+            return selector;
+        }
+        return null;
+    };
+    const css = selector => selector.replace(/^css=/, '');
+
+    const selectors = new Set(conditions.flatMap(([t, s]) => [t, ...s]));
+    const unsupported = [...selectors].filter(selector => {
+        if (xpathOf(selector) !== null) {
+            return false;
+        }
+        try {
+            document.createDocumentFragment().querySelector(css(selector));
+            return false;
+        } catch (e) {
+            return true;
+        }
+    });
+    if (unsupported.length) {
+        resolve({unsupported});
+        return;
+    }
+
+    const observed = {
+        subtree: true, childList: true, attributes: true, characterData: true
+    };
+    let observer = null, interval = null, timer = null;
+    // the document and the open shadow roots found in it so far
+    const roots = [document], known = new Set(roots);
+    const findRoots = () => {
+        for (let i = 0; i < roots.length; i++) {
+            const walker = document.createTreeWalker(
+                roots[i], NodeFilter.SHOW_ELEMENT
+            );
+            for (let e = walker.nextNode(); e; e = walker.nextNode()) {
+                const root = e.shadowRoot;
+                if (root && !known.has(root)) {
+                    known.add(root);
+                    roots.push(root);
+                    observer && observer.observe(root, observed);
+                }
+            }
+        }
+    };
+    const query = selector => {
+        const xpath = xpathOf(selector);
+        if (xpath === null) {
+            for (const root of roots) {
+                const node = root.querySelector(css(selector));
+                if (node) {
+                    return node;
+                }
+            }
+            return null;
+        }
+        return document.evaluate(
+            xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+        ).singleNodeValue;
+    };
+    const visible = node => {
+        const e = node && node.nodeType !== 1 ? node.parentElement : node;
+        if (!e || !e.isConnected) {
+            return false;
+        }
+        if (getComputedStyle(e).visibility !== 'visible') {
+            return false;
+        }
+        const rect = e.getBoundingClientRect();
+        return rect.width > 0 && rect.height > 0;
+    };
+    const holds = (selector, state) => {
+        const node = query(selector);
+        switch (state) {
+            case 'detached': return !node;
+            case 'visible': return visible(node);
+            case 'hidden': return !visible(node);
+            default: return !!node;
+        }
+    };
+    const state = conditions.map(([trigger, selectors, condition]) => ({
+        trigger, selectors, condition, triggered: null, satisfied: null
+    }));
+    const report = timedOut => ({
+        timedOut,
+        elapsed: since(),
+        conditions: state.map(({trigger, triggered, satisfied}) => ({
+            trigger, triggered, satisfied
+        }))
+    });
+
+    const finish = (result, error) => {
+        observer && observer.disconnect();
+        clearInterval(interval);
+        clearTimeout(timer);
+        error ? reject(error) : resolve(result);
+    };
+    const check = () => {
+        try {
+            findRoots();
+            let pending = false;
+            for (const c of state) {
+                if (c.satisfied !== null) {
+                    continue;
+                }
+                if (c.triggered === null) {
+                    if (!query(c.trigger)) {
+                        continue;
+                    }
+                    c.triggered = since();
+                }
+                if (c.selectors.every(s => holds(s, c.condition))) {
+                    c.satisfied = since();
+                } else {
+                    pending = true;
+                }
+            }
+            if (!pending) {
+                finish(report(false));
+                return true;
+            }
+        } catch (e) {
+            finish(null, e);
+            return true;
+        }
+        return false;
+    };
+
+    if (check()) {
+        return;
+    }
+    observer = new MutationObserver(check);
+    roots.forEach(root => observer.observe(root, observed));
+    // visibility may also change without DOM mutations (stylesheets,
+    // animations, layout)
+    const states = state.map(c => c.condition);
+    if (states.includes('visible') || states.includes('hidden')) {
+        interval = setInterval(check, 100);
+    }
+    if (timeout) {
+        timer = setTimeout(() => finish(report(true)), timeout);
+    }
+})
+"""
+
+
+def _in_page(selector: str) -> bool:
+    if '>>' in selector or selector in _sequential_selectors:
+        return False
+    match = _ENGINE_RE.match(selector)
+    return not match or match.group(1) in ('css', 'xpath')
+
+
+async def _wait_conditions(
+        page: Page,
+        ready_conditions: List[ReadyCondition],
+        deadline: float = None
+):
     remaining_conditions: List[ReadyCondition] = []
     condition_matched = False
     for selector, conditions, state in ready_conditions:
-        if page.query_selector(selector):
+        if await page.query_selector(selector):
             logger.debug('wait_conditions: selector=%s: matched', selector)
             for condition in conditions:
                 logger.debug(
@@ -27,7 +211,12 @@ def _wait_conditions(page: Page, ready_conditions: List[ReadyCondition]):
                     condition,
                     state
                 )
-                page.wait_for_selector(condition, state=state)
+                await page.wait_for_selector(
+                    condition,
+                    state=state,
+                    timeout=None if deadline is None
+                    else max((deadline - time.monotonic()) * 1000, 1)
+                )
                 pass
             logger.debug('wait_conditions: selector=%s: satisfied', selector)
             condition_matched = True
@@ -37,11 +226,17 @@ def _wait_conditions(page: Page, ready_conditions: List[ReadyCondition]):
     return condition_matched, remaining_conditions
 
 
-def wait_ready(page, ready_conditions: List[ReadyCondition]) -> Page:
+async def _wait_sequential(
+        page: Page,
+        ready_conditions: List[ReadyCondition],
+        timeout: int = None
+):
+    deadline = time.monotonic() + timeout / 1000 if timeout else None
     while True:
-        condition_matched, ready_conditions = _wait_conditions(
+        condition_matched, ready_conditions = await _wait_conditions(
             page,
-            ready_conditions or []
+            ready_conditions,
+            deadline
         )
         if not condition_matched:  # no more conditions to match
             logger.debug(
@@ -50,4 +245,106 @@ def wait_ready(page, ready_conditions: List[ReadyCondition]) -> Page:
             )
             break
         pass
+    pass
+
+
+async def wait_conditions(
+        page: Page,
+        ready_conditions: List[ReadyCondition],
+        timeout: int = None
+) -> Dict[str, Any]:
+    """
+    Wait for all `ready_conditions` in a single in-page evaluation.
+
+    Returns the per-condition timings (ms since the wait started at
+    which each trigger matched and each condition was satisfied, None
+    if it never was); raises TimeoutError if they are not all
+    satisfied within `timeout` ms. If querySelector() rejects some of
+    the selectors, returns them (`unsupported`) without waiting
+    """
+    result = await page.evaluate(
+        WAIT_READY_JS,
+        dict(
+            conditions=[
+                [trigger, list(selectors), state]
+                for trigger, selectors, state in ready_conditions
+            ],
+            timeout=timeout or 0
+        )
+    )
+    if result.get('unsupported'):
+        logger.debug(
+            'wait_ready: not supported in the page: %s',
+            result['unsupported']
+        )
+        if len(_sequential_selectors) >= _SEQUENTIAL_SELECTORS_MAX:
+            _sequential_selectors.clear()
+            pass
+        _sequential_selectors.update(result['unsupported'])
+        return result
+    logger.debug(
+        'wait_ready: %s in %d ms: %s',
+        'timed out' if result['timedOut'] else 'satisfied',
+        result['elapsed'],
+        result['conditions']
+    )
+    if result['timedOut']:
+        pending = [
+            c['trigger'] for c in result['conditions']
+            if c['triggered'] is not None and c['satisfied'] is None
+        ]
+        raise TimeoutError(
+            f'ready conditions not satisfied within {timeout} ms: {pending}'
+        )
+    return result
+
+
+async def wait_ready(
+        page: Page,
+        ready_conditions: List[ReadyCondition],
+        timeout: int = None
+) -> Page:
+    """
+    Wait for the ready conditions: in the page (see wait_conditions())
+    unless some selector needs Playwright's own engines, sequentially
+    otherwise. A navigation during the in-page wait starts it over once,
+    in the new document; a second one raises TimeoutError
+    """
+    if not ready_conditions:
+        return page
+    deadline = time.monotonic() + timeout / 1000 if timeout else None
+    retried = False
+    while all(
+            _in_page(selector)
+            for trigger, selectors, _ in ready_conditions
+            for selector in (trigger, *selectors)
+    ):
+        try:
+            result = await wait_conditions(
+                page,
+                ready_conditions,
+                None if deadline is None
+                else max(round((deadline - time.monotonic()) * 1000), 1)
+            )
+        except TimeoutError:
+            raise
+        except Error as e:
+            if _CONTEXT_DESTROYED not in str(e):
+                raise
+            if retried:
+                raise TimeoutError(
+                    f'ready conditions: navigated while waiting: {e}'
+                ) from e
+            logger.debug('wait_ready: navigated while waiting, waiting again')
+            retried = True
+            continue
+        if not result.get('unsupported'):
+            return page
+        pass
+    await _wait_sequential(
+        page,
+        list(ready_conditions),
+        None if deadline is None
+        else max(round((deadline - time.monotonic()) * 1000), 1)
+    )
     return page
@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import json
+
+from page.prewarm import run
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pre-warm the SPA Renderer page cache from sitemaps'
+    )
+    parser.add_argument(
+        'sources',
+        nargs='+',
+        help='sitemap.xml / sitemap index / URL list (URL or file path)'
+    )
+    parser.add_argument(
+        '-d', '--device',
+        action='append',
+        dest='devices',
+        help='render for this device (repeatable, default: prewarm_devices)'
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        type=int,
+        help='concurrent renders (default: batch_concurrency)'
+    )
+    parser.add_argument(
+        '-f', '--force',
+        action='store_true',
+        help='re-render pages even if their cached copy is up to date'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='also write the JSON report to this file'
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(run(
+        args.sources,
+        devices=args.devices,
+        concurrency=args.concurrency,
+        force=args.force
+    ))
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            pass
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
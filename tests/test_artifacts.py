@@ -0,0 +1,42 @@
+import os
+import time
+
+from page.artifacts import ArtifactStore
+from page.contenthash import content_hash
+
+PAGE = (
+    '<html><head>'
+    '<meta name="x-spa-renderer-timestamp" content="%s">'
+    '</head><body>%s</body></html>'
+)
+
+
+def test_identical_renders_are_stored_once(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_bytes=0, max_age=0)
+    body = 'x' * 600000
+    first = store.write(PAGE % ('2026-01-01T00:00:00', body), dict(n='1'))
+    second = store.write(PAGE % ('2026-01-02T00:00:00', body), dict(n='2'))
+    assert first.sha256 == second.sha256 == content_hash(PAGE % ('', body))
+    assert store.stats() == dict(written=1, deduplicated=1, pruned=0)
+    assert [r['n'] for r in second.meta()['renders']] == ['1', '2']
+    assert first.read().decode() == PAGE % ('2026-01-01T00:00:00', body)
+    assert store.get(first.sha256) == first
+    assert store.get('../' + first.sha256[3:]) is None
+
+
+def test_prune_by_size_and_age(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_bytes=0, max_age=0)
+    old = store.write(PAGE % ('', 'a' * 1000), {})
+    recent = store.write(PAGE % ('', 'b' * 1000), {})
+    past = time.time() - 100
+    os.utime(old.path, (past, past))
+    store.max_bytes = old.size + 10
+    assert store.prune() == 1
+    assert store.get(old.sha256) is None
+    assert not os.path.exists(old.meta_path)
+    assert store.get(recent.sha256) is not None
+    store.max_bytes = 0
+    store.max_age = 50
+    os.utime(recent.path, (past, past))
+    assert store.prune() == 1
+    assert store.stats()['pruned'] == 2
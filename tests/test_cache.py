@@ -0,0 +1,43 @@
+import pytest
+
+from page.cache import cache_key
+from util import config
+
+
+@pytest.fixture
+def restore_config():
+    yield config
+    config.load_conf()
+    pass
+
+
+@pytest.mark.parametrize('url, key', [
+    ('https://example.com/a/b', 'example.com/pixel5/a/b'),
+    ('https://example.com/a/b/', 'example.com/pixel5/a/b'),
+    ('https://example.com/a?x=1', 'example.com/pixel5/a?x=1'),
+    # every ignored param goes, whatever its position
+    ('https://example.com/a?utm_source=s&utm_medium=m&x=1',
+     'example.com/pixel5/a?x=1'),
+    ('https://example.com/a?x=1&fbclid=f&y=2&gclid=g',
+     'example.com/pixel5/a?x=1&y=2'),
+    ('https://example.com/a?utm_source=s', 'example.com/pixel5/a'),
+    # patterns match whole names only
+    ('https://example.com/a?si=1&sig=2', 'example.com/pixel5/a?sig=2'),
+    ('https://example.com/a?x=1&x=2', 'example.com/pixel5/a?x=1&x=2'),
+    ('https://example.com/a?q=a%20b', 'example.com/pixel5/a?q=a+b'),
+])
+def test_cache_key(url, key):
+    assert cache_key('Pixel 5', url) == key
+
+
+def test_cache_key_extra_params(restore_config):
+    url = 'https://example.com/a?ref=x&x=1'
+    assert cache_key('desktop', url) == 'example.com/desktop/a?ref=x&x=1'
+    config.set('s3_ignore_query_params_extra', ['ref'])
+    assert cache_key('desktop', url) == 'example.com/desktop/a?x=1'
+
+
+def test_cache_key_no_ignored_params(restore_config):
+    config.set('s3_ignore_query_params', [])
+    assert cache_key('desktop', 'https://example.com/?utm_source=s') == \
+        'example.com/desktop/?utm_source=s'
@@ -0,0 +1,74 @@
+import pytest
+
+from page.compression import (accepts_encoding, compress, compress_stream,
+                              decompress, decompress_stream,
+                              supported_encodings)
+
+BODY = b'<html><body>' + b'<p>hello</p>' * 10000 + b'</body></html>'
+
+
+@pytest.mark.parametrize('encoding', sorted(supported_encodings()) + [''])
+def test_round_trip(encoding):
+    compressed = compress(BODY, encoding)
+    if encoding:
+        assert len(compressed) < len(BODY)
+        pass
+    assert decompress(compressed, encoding) == BODY
+
+
+@pytest.mark.parametrize('encoding', sorted(supported_encodings()) + [''])
+def test_stream_round_trip(encoding):
+    chunks = [BODY[i:i + 4096] for i in range(0, len(BODY), 4096)]
+    compressed = b''.join(compress_stream(iter(chunks), encoding))
+    assert decompress(compressed, encoding) == BODY
+    pieces = [compressed[i:i + 1000] for i in range(0, len(compressed), 1000)]
+    assert b''.join(decompress_stream(iter(pieces), encoding)) == BODY
+
+
+def test_decompress_stream_closes_source():
+    closed = []
+
+    def chunks():
+        try:
+            yield compress(BODY, 'gzip')
+        finally:
+            closed.append(True)
+            pass
+        pass
+
+    assert b''.join(decompress_stream(chunks(), 'gzip')) == BODY
+    assert closed
+
+
+def test_identity():
+    assert decompress(BODY, 'identity') == BODY
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compress(BODY, 'zstd')
+        pass
+    with pytest.raises(ValueError):
+        decompress(BODY, 'zstd')
+        pass
+    with pytest.raises(ValueError):
+        list(compress_stream(iter([BODY]), 'zstd'))
+        pass
+
+
+@pytest.mark.parametrize('accept_encoding, encoding, accepted', [
+    ('gzip, deflate, br', 'gzip', True),
+    ('gzip, deflate, br', 'br', True),
+    ('deflate', 'gzip', False),
+    ('GZIP', 'gzip', True),
+    ('*', 'br', True),
+    ('gzip;q=0', 'gzip', False),
+    ('gzip; q=0.5', 'gzip', True),
+    ('br;q=0.0, gzip', 'br', False),
+    ('gzip;q=0.5', 'gzip', True),
+    ('gzip;q=x', 'gzip', False),
+    ('', 'gzip', False),
+    ('gzip', '', False),
+])
+def test_accepts_encoding(accept_encoding, encoding, accepted):
+    assert accepts_encoding(accept_encoding, encoding) is accepted
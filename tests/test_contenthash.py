@@ -0,0 +1,36 @@
+from page.cache import ContentIndex
+from page.contenthash import content_hash
+
+
+def test_content_hash_ignores_render_timestamp():
+    page = '<html><head>%s</head><body>%s</body></html>'
+    meta = '<meta name="x-spa-renderer-timestamp" content="%s">'
+    first = page % (meta % '2026-01-01T00:00:00', 'x' * 300000)
+    second = page % (meta % '2026-02-01T12:00:00.123', 'x' * 300000)
+    changed = page % (meta % '2026-01-01T00:00:00', 'x' * 299999 + 'y')
+    assert content_hash(first) == content_hash(second)
+    assert content_hash(first) != content_hash(changed)
+    assert content_hash(first) == content_hash(page % ('', 'x' * 300000))
+
+
+def test_content_index_lru():
+    index = ContentIndex(max_entries=2)
+    index.put('a', 'ha', 'gzip', '"e1"')
+    index.put('b', 'hb', '')
+    assert index.get('a') == ('ha', 'gzip', '"e1"')  # a: most recent
+    index.put('c', 'hc', '')
+    assert index.get('b') is None
+    assert index.get('a') is not None and index.get('c') is not None
+    index.put('d', '', '')  # no hash: not indexed
+    assert index.get('d') is None
+    index.delete('a')
+    assert index.get('a') is None
+
+
+def test_content_index_keeps_etag_of_same_content():
+    index = ContentIndex()
+    index.put('a', 'h1', 'gzip', '"e1"')
+    index.put('a', 'h1', 'gzip')  # e.g. from the local cache
+    assert index.get('a').etag == '"e1"'
+    index.put('a', 'h2', 'gzip')
+    assert index.get('a').etag is None
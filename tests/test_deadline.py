@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+from page.deadline import Deadline, DeadlineExceeded
+
+
+def test_unbounded():
+    deadline = Deadline(0)
+    assert deadline.remaining() is None and deadline.seconds() is None
+    assert deadline.timeout() is None
+    assert deadline.timeout(0.5, 2000) == 2000
+    assert not deadline.expired()
+    deadline.check()
+
+
+def test_timeout_shares_remaining_budget():
+    deadline = Deadline(10000)
+    assert 4900 <= deadline.timeout(0.5) <= 5000
+    assert deadline.timeout(0.5, 1000) == 1000
+    assert 9900 <= deadline.timeout(cap=0) <= 10000
+    assert 9.9 <= deadline.seconds() <= 10
+
+
+def test_expired():
+    deadline = Deadline(10)
+    time.sleep(0.02)
+    assert deadline.expired() and deadline.remaining() == 0
+    assert deadline.timeout(0.5) == 1  # never 0: Playwright's "no timeout"
+    with pytest.raises(DeadlineExceeded):
+        deadline.check('goto')
+        pass
@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from page.context import DeviceIndex, PriorityMatcher
+
+UA = 'Mozilla/5.0 (%s) AppleWebKit/537.36 (KHTML, like Gecko) Mobile'
+
+DEVICES = {
+    name: dict(user_agent=UA % platform)
+    for name, platform in [
+        ('Pixel 5', 'Linux; Android 11; Pixel 5'),
+        ('Pixel 5 landscape', 'Linux; Android 11; Pixel 5'),
+        ('Galaxy S9+', 'Linux; Android 8.0.0; SM-G965U'),
+        ('iPhone 12', 'iPhone; CPU iPhone OS 14_2 like Mac OS X'),
+        ('iPhone 12 Pro', 'iPhone; CPU iPhone OS 14_2 like Mac OS X'),
+        ('iPad Mini', 'iPad; CPU OS 12_2 like Mac OS X'),
+        ('Desktop Chrome', 'Windows NT 10.0; Win64; x64'),
+    ]
+}
+DEVICES['Blank'] = {}
+
+
+def _linear_full(devices: dict, user_agent: str):
+    for k in sorted(devices.keys(), reverse=True):
+        if user_agent in devices[k].get('user_agent', ''):
+            return k
+        pass
+    return None
+
+
+def _linear_partial(devices: dict, user_agent: str):
+    for k in sorted(devices.keys(), reverse=True):
+        if k in user_agent:
+            return k
+        pass
+    return None
+
+
+def _linear_first(needles, s: str):
+    for i, needle in enumerate(needles):
+        if needle in s:
+            return i
+        pass
+    return None
+
+
+USER_AGENTS = [
+    DEVICES['Pixel 5']['user_agent'],
+    DEVICES['iPhone 12']['user_agent'],
+    'iPad; CPU OS 12_2',
+    'Android 8.0.0',
+    'like Gecko) Mobile\nMozilla',  # spans two joined user agents
+    'Mozilla/5.0 (iPhone 12 Pro) Custom',
+    'my Pixel 5 landscape, or iPhone 12',
+    'Galaxy S9',
+    'curl/8.0',
+    '',
+]
+
+
+@pytest.mark.parametrize('user_agent', USER_AGENTS)
+def test_device_index_matches_linear_scan(user_agent):
+    index = DeviceIndex(DEVICES)
+    assert index.full_match(user_agent) == _linear_full(DEVICES, user_agent)
+    assert index.partial_match(user_agent) == \
+        _linear_partial(DEVICES, user_agent)
+
+
+def test_device_index_matches_linear_scan_random():
+    rng = random.Random(1)
+    names = list(DEVICES.keys())
+    index = DeviceIndex(DEVICES)
+    for _ in range(500):
+        source = DEVICES[rng.choice(names)].get('user_agent', '') or \
+            rng.choice(names)
+        start = rng.randrange(len(source))
+        user_agent = source[start:start + rng.randrange(1, 40)]
+        if rng.random() < 0.3:
+            user_agent += ' ' + rng.choice(names)
+            pass
+        assert index.full_match(user_agent) == \
+            _linear_full(DEVICES, user_agent)
+        assert index.partial_match(user_agent) == \
+            _linear_partial(DEVICES, user_agent)
+        pass
+
+
+@pytest.mark.parametrize('needles, s', [
+    (['mobile', 'android', 'ipad'], 'linux; android 11; mobile'),
+    (['ipad', 'iphone', 'mobile'], 'iphone; mobile'),
+    (['b', 'ab', 'a'], 'xab'),
+    (['a', 'a', 'b'], 'ba'),
+    (['tablet'], 'desktop'),
+    ([], 'anything'),
+])
+def test_priority_matcher_matches_linear_scan(needles, s):
+    assert PriorityMatcher(needles).search(s) == _linear_first(needles, s)
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from page import jobs
+from page.jobs import JobQueue
+
+
+class _Result:
+    s3_url = 's3://page'
+    cache_hit = False
+    artifact = None
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """URLs rendered by the queue, in order (renders of `fail` URLs
+    raise)"""
+    urls = []
+
+    async def render(url, options, device=None):
+        urls.append((url, device))
+        await asyncio.sleep(0)
+        if 'fail' in url:
+            raise RuntimeError('render failed')
+        return _Result()
+
+    monkeypatch.setattr(jobs, 'render', render)
+    return urls
+
+
+def test_priority_order(rendered):
+    async def run():
+        queue = JobQueue(concurrency=1, host_interval_ms=0, db_path='')
+        try:
+            low = await queue.submit(['https://a.com/1', 'https://a.com/2'],
+                                     priority=5)
+            high = await queue.submit(['https://b.com/1'], priority=0)
+            same = await queue.submit(['https://c.com/1'], priority=5)
+            for job in (low, high, same):
+                await queue.wait(job)
+                pass
+        finally:
+            await queue.stop()
+            pass
+        return low
+
+    low = asyncio.run(run())
+    # higher priority (lower value) first, then FIFO
+    assert [url for url, _ in rendered] == [
+        'https://b.com/1',
+        'https://a.com/1',
+        'https://a.com/2',
+        'https://c.com/1'
+    ]
+    assert low.status == 'finished'
+    assert low.counts()['done'] == 2
+
+
+def test_items_per_device_and_failures(rendered):
+    async def run():
+        queue = JobQueue(concurrency=2, host_interval_ms=0, db_path='')
+        try:
+            job = await queue.submit(
+                ['https://a.com/ok', 'https://a.com/fail'],
+                devices=['Pixel 5', None]
+            )
+            return await queue.wait(job)
+        finally:
+            await queue.stop()
+            pass
+
+    job = asyncio.run(run())
+    assert sorted(rendered, key=str) == sorted([
+        ('https://a.com/ok', 'Pixel 5'),
+        ('https://a.com/ok', None),
+        ('https://a.com/fail', 'Pixel 5'),
+        ('https://a.com/fail', None)
+    ], key=str)
+    failed = [i for i in job.items if i.status == 'failed']
+    assert len(failed) == 2
+    assert all(i.message == 'render failed' for i in failed)
+    assert all(
+        i.s3_url == 's3://page' for i in job.items if i.status == 'done'
+    )
+
+
+def test_empty_job_is_finished():
+    async def run():
+        queue = JobQueue(concurrency=1, host_interval_ms=0, db_path='')
+        try:
+            return await queue.submit([])
+        finally:
+            await queue.stop()
+            pass
+
+    assert asyncio.run(run()).done.is_set()
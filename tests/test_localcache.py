@@ -0,0 +1,99 @@
+import time
+
+from page.localcache import CacheEntry, DiskCache, LocalCache, MemoryCache
+
+
+def _entry(body: bytes, ttl: float = 0) -> CacheEntry:
+    return CacheEntry(body, {'k': 'v'}, time.time() + ttl if ttl else 0)
+
+
+def test_memory_evicts_least_recently_used():
+    cache = MemoryCache(10)
+    cache.put('a', _entry(b'1234'))
+    cache.put('b', _entry(b'1234'))
+    assert cache.get('a').body == b'1234'  # a is now the most recent
+    cache.put('c', _entry(b'1234'))
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+    assert cache.stats()['bytes'] == 8
+    assert cache.stats()['evictions'] == 1
+
+
+def test_memory_skips_oversized_and_replaces():
+    cache = MemoryCache(4)
+    cache.put('big', _entry(b'12345'))
+    assert cache.get('big') is None
+    cache.put('a', _entry(b'12'))
+    cache.put('a', _entry(b'123'))
+    assert cache.get('a').body == b'123'
+    assert cache.stats()['bytes'] == 3
+
+
+def test_memory_expiration():
+    cache = MemoryCache(100)
+    cache.put('a', CacheEntry(b'x', {}, time.time() - 1))
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_disk_round_trip_and_rescan(tmp_path):
+    cache = DiskCache(str(tmp_path), 100)
+    cache.put('example.com/d/page', _entry(b'<html></html>'))
+    entry = cache.get('example.com/d/page')
+    assert entry.body == b'<html></html>'
+    assert entry.meta == {'k': 'v'}
+    # a new instance picks up the files (and their sizes)
+    rescanned = DiskCache(str(tmp_path), 100)
+    assert rescanned.stats()['bytes'] == len(b'<html></html>')
+    assert rescanned.get('example.com/d/page').body == b'<html></html>'
+
+
+def test_disk_evicts_and_deletes(tmp_path):
+    cache = DiskCache(str(tmp_path), 8)
+    cache.put('a', _entry(b'1234'))
+    time.sleep(0.01)
+    cache.put('b', _entry(b'1234'))
+    cache.put('c', _entry(b'1234'))
+    assert cache.get('a') is None
+    assert cache.get('c').body == b'1234'
+    cache.delete('c')
+    assert cache.get('c') is None
+    assert cache.stats()['bytes'] == 4
+
+
+def test_local_cache_promotes_disk_hits(tmp_path):
+    cache = LocalCache(
+        memory_bytes=100,
+        directory=str(tmp_path),
+        disk_bytes=100,
+        ttl=0,
+        max_entry_bytes=50
+    )
+    cache.put('a', b'body', {'content-encoding': 'gzip'})
+    cache.memory.delete('a')
+    assert cache.get('a').meta == {'content-encoding': 'gzip'}
+    assert cache.memory.get('a').body == b'body'
+
+
+def test_local_cache_entry_bounds(tmp_path):
+    cache = LocalCache(
+        memory_bytes=100,
+        directory='',
+        disk_bytes=0,
+        ttl=0,
+        max_entry_bytes=4
+    )
+    assert cache.disk is None
+    assert cache.accepts(4) and not cache.accepts(5)
+    cache.put('a', b'12345')
+    assert cache.get('a') is None
+    cache.put('b', b'1234', ttl=-1)  # negative: already expired
+    assert cache.get('b') is None
+
+
+def test_local_cache_disabled():
+    cache = LocalCache(memory_bytes=0, directory='', disk_bytes=0)
+    assert not cache.accepts(1)
+    cache.put('a', b'x')
+    assert cache.get('a') is None
@@ -0,0 +1,60 @@
+from dataclasses import FrozenInstanceError
+
+import pytest
+
+from page.options import RenderOptions
+from util import config
+
+
+@pytest.fixture
+def restore_config():
+    yield config
+    config.load_conf()
+    pass
+
+
+def test_from_config_defaults():
+    options = RenderOptions.from_config()
+    assert options.max_tries == config.get('max_tries')
+    assert options.debug == config.get('debug')
+    assert options.ready_conditions == ()
+
+
+def test_from_config_overrides_skip_none():
+    options = RenderOptions.from_config(debug=True, max_tries=None)
+    assert options.debug is True
+    assert options.max_tries == config.get('max_tries')
+
+
+def test_from_config_rejects_unknown():
+    with pytest.raises(TypeError):
+        RenderOptions.from_config(no_such_option=1)
+        pass
+
+
+def test_from_config_normalises_collections(restore_config):
+    config.set('block_url_patterns', ['^https://a/'])
+    options = RenderOptions.from_config(
+        remove_elements=['script'],
+        ready_conditions=[['body', ['[data-ready]'], 'attached']],
+        extra_http_headers={'x-a': '1'},
+    )
+    assert options.ready_conditions == \
+        (('body', ('[data-ready]',), 'attached'),)
+    assert options.remove_elements == ('script',)
+    assert options.block_url_patterns == ('^https://a/',)
+    assert options.extra_http_headers == {'x-a': '1'}
+    with pytest.raises(TypeError):
+        options.extra_http_headers['x-a'] = '2'
+        pass
+
+
+def test_options_are_immutable_and_hashable():
+    options = RenderOptions.from_config()
+    with pytest.raises(FrozenInstanceError):
+        options.debug = True
+        pass
+    assert hash(options) == hash(RenderOptions.from_config())
+    assert options == RenderOptions.from_config(
+        default_timeout=options.default_timeout + 1
+    )
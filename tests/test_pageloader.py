@@ -0,0 +1,124 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from page.deadline import Deadline
+from page.options import RenderOptions
+from page.pageloader import IdleWindows, PageLoader
+
+URL = 'https://example.com/a'
+
+
+class FakePage:
+    def __init__(self, goto_ms: int = 0):
+        self.goto_ms = goto_ms
+        self.handlers = {}
+        self.sleeps = []
+        pass
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+        pass
+
+    def remove_listener(self, event, handler):
+        del self.handlers[event]
+        pass
+
+    async def route(self, pattern, handler):
+        pass
+
+    async def goto(self, url, timeout=None):
+        await asyncio.sleep(self.goto_ms / 1000)
+        return None
+
+    async def wait_for_timeout(self, ms):
+        self.sleeps.append(ms)
+        pass
+
+    def emit(self, event: str, url: str):
+        self.handlers[event](SimpleNamespace(url=url, method='GET'))
+        pass
+
+
+def _options(**overrides) -> RenderOptions:
+    overrides.setdefault('network_idle_adaptive', False)
+    return RenderOptions.from_config(**overrides)
+
+
+def _elapsed(started: float) -> float:
+    return (time.monotonic() - started) * 1000
+
+
+def test_idle_windows_learn_after_min_samples():
+    windows = IdleWindows(margin=2, decay=0.5, min_samples=2)
+    windows.observe(URL, 100)
+    assert windows.window(URL, 50, 1000) == 1000
+    windows.observe(URL, 10)
+    assert windows.window(URL, 50, 1000) == 100  # 2 * max(10, 100 * .5)
+    assert windows.window(URL, 150, 1000) == 150
+    assert windows.window(URL, 50, 80) == 80
+    assert windows.stats() == {'example.com/a': dict(gap=50, samples=2)}
+
+
+def test_idle_windows_routes_collapse_ids():
+    assert IdleWindows.route('https://example.com/p/123/x?q=1') == \
+        IdleWindows.route('https://example.com/p/456/x') == \
+        'example.com/p/*/x'
+    assert IdleWindows.route('https://example.com/p/about') == \
+        'example.com/p/about'
+
+
+def test_wait_network_idle_waits_for_pending_requests():
+    page = FakePage()
+    loader = PageLoader(page, URL, _options(network_idle_time=50))
+
+    async def main():
+        page.emit('request', URL + '/api')
+        asyncio.get_running_loop().call_later(
+            0.1, page.emit, 'requestfinished', URL + '/api'
+        )
+        started = time.monotonic()
+        await loader._wait_network_idle(1000)
+        return _elapsed(started)
+
+    elapsed = asyncio.run(main())
+    assert 150 <= elapsed < 500
+    assert loader.pending_requests == 0 and not loader.requests
+
+
+def test_wait_network_idle_gives_up_at_max_time():
+    page = FakePage()
+    loader = PageLoader(page, URL, _options(network_idle_time=50))
+
+    async def main():
+        page.emit('request', URL + '/api')
+        started = time.monotonic()
+        await loader._wait_network_idle(100)
+        return _elapsed(started)
+
+    assert 100 <= asyncio.run(main()) < 400
+
+
+def test_load_restarts_the_quiet_window_after_goto():
+    page = FakePage(goto_ms=100)
+    loader = PageLoader(page, URL, _options(network_idle_time=100))
+
+    async def main():
+        started = time.monotonic()
+        await loader.load()
+        return _elapsed(started)
+
+    assert asyncio.run(main()) >= 180  # goto, then a full quiet window
+    assert 'request' not in page.handlers
+
+
+def test_load_without_idle_check_sleeps_network_idle_time():
+    page = FakePage()
+    options = _options(network_idle_check=False, network_idle_time=200)
+    asyncio.run(PageLoader(page, URL, options, Deadline(0)).load())
+    assert page.sleeps == [200]
+
+    page = FakePage()
+    options = _options(network_idle_check=False, network_idle_time=0)
+    asyncio.run(PageLoader(page, URL, options, Deadline(0)).load())
+    assert page.sleeps == []
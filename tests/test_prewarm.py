@@ -0,0 +1,125 @@
+import asyncio
+import gzip
+import http.server
+import threading
+from datetime import datetime, timezone
+from functools import partial
+
+import pytest
+
+from page.prewarm import SourceNotAllowed, prewarm, read_sitemap
+
+URLSET = '''<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url>
+    <loc> https://example.com/a </loc>
+    <lastmod>2026-01-02</lastmod>
+  </url>
+  <url>
+    <loc>https://example.com/b</loc>
+    <lastmod>2026-01-02T10:00:00Z</lastmod>
+  </url>
+  <url><loc>https://example.com/c</loc><lastmod>yesterday</lastmod></url>
+  <url><loc>file:///etc/passwd</loc></url>
+</urlset>
+'''
+
+
+def _index(*locs: str) -> str:
+    return (
+        '<sitemapindex '
+        'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s'
+        '</sitemapindex>'
+    ) % ''.join(f'<sitemap><loc>{loc}</loc></sitemap>' for loc in locs)
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Serve `tmp_path` over HTTP; yields (directory, base URL)"""
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        partial(
+            type(
+                'Handler',
+                (http.server.SimpleHTTPRequestHandler,),
+                dict(log_message=lambda *args: None)
+            ),
+            directory=str(tmp_path)
+        )
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield tmp_path, 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+    pass
+
+
+def test_urlset(site):
+    directory, base = site
+    (directory / 'sitemap.xml').write_text(URLSET)
+    entries = read_sitemap(base + '/sitemap.xml')
+    assert [e.url for e in entries] == [
+        'https://example.com/a',
+        'https://example.com/b',
+        'https://example.com/c'
+    ]
+    assert entries[0].lastmod == datetime(2026, 1, 2, tzinfo=timezone.utc)
+    assert entries[1].lastmod == \
+        datetime(2026, 1, 2, 10, tzinfo=timezone.utc)
+    assert entries[2].lastmod is None
+
+
+def test_gzip_index_and_url_list(site):
+    directory, base = site
+    (directory / 'pages.xml.gz').write_bytes(gzip.compress(URLSET.encode()))
+    (directory / 'list.txt').write_text(
+        '# comment\nhttps://example.com/d\n\n'
+        '/etc/hosts\nhttps://example.com/e\n'
+    )
+    (directory / 'index.xml').write_text(
+        _index(base + '/pages.xml.gz', base + '/list.txt')
+    )
+    assert [e.url for e in read_sitemap(base + '/index.xml')] == [
+        'https://example.com/a',
+        'https://example.com/b',
+        'https://example.com/c',
+        'https://example.com/d',
+        'https://example.com/e'
+    ]
+
+
+def test_index_depth_is_bounded(site):
+    directory, base = site
+    (directory / 'loop.xml').write_text(_index(base + '/loop.xml'))
+    assert read_sitemap(base + '/loop.xml') == []
+
+
+def test_local_sources(tmp_path):
+    sitemap = tmp_path / 'sitemap.xml'
+    sitemap.write_text(URLSET)
+    for source in (str(sitemap), sitemap.as_uri()):
+        with pytest.raises(SourceNotAllowed):
+            read_sitemap(source)
+            pass
+        assert len(read_sitemap(source, local=True)) == 3
+        pass
+
+
+def test_index_entries_must_be_http(tmp_path):
+    (tmp_path / 'sitemap.xml').write_text(URLSET)
+    index = tmp_path / 'index.xml'
+    index.write_text(_index(str(tmp_path / 'sitemap.xml')))
+    with pytest.raises(SourceNotAllowed):
+        read_sitemap(str(index), local=True)
+        pass
+
+
+@pytest.mark.parametrize('source', [
+    '/etc/passwd',
+    'file:///etc/passwd',
+    'ftp://example.com/sitemap.xml',
+    '.env.local'
+])
+def test_prewarm_rejects_non_http_sources(source):
+    with pytest.raises(SourceNotAllowed):
+        asyncio.run(prewarm([source], queue=None))
+        pass
@@ -0,0 +1,212 @@
+import asyncio
+import sys
+import time
+
+import pytest
+from playwright.async_api import Error, TimeoutError
+
+import page.render  # noqa: F401
+from page.deadline import Deadline
+from page.options import RenderOptions
+from page.retry import (FAIL, REPLACE_CONTEXT, REPLACE_PAGE, RETRY_READY,
+                        CircuitBreaker, CircuitOpen, OriginError, RetryState,
+                        backoff, classify)
+
+URL = 'https://example.com/page'
+
+
+@pytest.mark.parametrize('error, stage, kind, action, origin', [
+    (TimeoutError('Timeout 30000ms exceeded'), 'load',
+     'navigation_timeout', REPLACE_PAGE, True),
+    (OriginError(URL, 503), 'load', 'origin_error', REPLACE_PAGE, True),
+    (Error('net::ERR_NAME_NOT_RESOLVED at https://example.com/'), 'load',
+     'dns', FAIL, True),
+    (Error('net::ERR_CONNECTION_REFUSED at https://example.com/'), 'load',
+     'connection', REPLACE_PAGE, True),
+    (Error('Page crashed'), 'ready', 'crash', REPLACE_CONTEXT, False),
+    (Error('Target page, context or browser has been closed'), 'load',
+     'crash', REPLACE_CONTEXT, False),
+    (Error('SyntaxError: bad selector'), 'ready', 'other', FAIL, False),
+    (ValueError('bug'), 'load', 'other', FAIL, False),
+])
+def test_classify(error, stage, kind, action, origin):
+    failure = classify(error, stage)
+    assert (failure.kind, failure.action, failure.origin) == \
+        (kind, action, origin)
+
+
+def test_classify_ready_timeout():
+    error = TimeoutError('ready conditions not satisfied')
+    first = classify(error, 'ready', ready_retries=0)
+    assert (first.kind, first.action) == ('ready_timeout', RETRY_READY)
+    assert not first.origin and not first.backoff
+    assert classify(error, 'ready', ready_retries=1).action == REPLACE_PAGE
+    assert classify(error, 'ready', last_try=True).action == REPLACE_PAGE
+
+
+def test_retry_state_backoff():
+    state = RetryState(3, backoff_ms=100, backoff_max_ms=300)
+    delays = [state.delay() for _ in range(4)]
+    for delay, ceiling in zip(delays, [0.1, 0.2, 0.3, 0.3]):
+        assert ceiling / 2 <= delay <= ceiling
+        pass
+    assert RetryState(0).max_tries == 1
+    assert RetryState(3, backoff_ms=0).delay() == 0
+
+
+def test_retry_state_exhausted():
+    state = RetryState(2)
+    state.tries = 1
+    assert not state.exhausted() and state.last_try()
+    state.tries = 2
+    assert state.exhausted() and not state.last_try()
+
+
+def test_backoff_leaves_half_the_budget():
+    state = RetryState(3, backoff_ms=10000, backoff_max_ms=10000)
+    started = time.monotonic()
+    asyncio.run(backoff(state, remaining_ms=40))
+    assert time.monotonic() - started < 1
+
+
+def _open(breaker: CircuitBreaker):
+    for _ in range(breaker.threshold):
+        breaker.failure(URL)
+        pass
+    pass
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    assert breaker.check(URL) is None
+    breaker.failure(URL)
+    breaker.check(URL)
+    breaker.failure(URL)
+    with pytest.raises(CircuitOpen) as e:
+        breaker.check(URL)
+        pass
+    assert e.value.host == 'example.com'
+    assert e.value.retry_after > 0
+    # other hosts are not affected
+    assert breaker.check('https://other.example.com/') is None
+    assert breaker.stats()['example.com']['open']
+
+
+def test_breaker_success_resets_failures():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.failure(URL)
+    breaker.success(URL)
+    breaker.failure(URL)
+    assert breaker.check(URL) is None
+
+
+def test_breaker_single_probe():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.01)
+    _open(breaker)
+    time.sleep(0.02)
+    probe = breaker.check(URL)
+    assert probe is not None
+    with pytest.raises(CircuitOpen):
+        breaker.check(URL)  # half open: one probe at a time
+        pass
+    breaker.release(URL, None)  # another render of the host finishing
+    with pytest.raises(CircuitOpen):
+        breaker.check(URL)
+        pass
+    breaker.release(URL, probe)  # the probe ended without an outcome
+    assert breaker.check(URL) is not None
+
+
+def test_breaker_probe_outcome():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.01)
+    _open(breaker)
+    time.sleep(0.02)
+    probe = breaker.check(URL)
+    breaker.failure(URL)  # re-opened for another cooldown
+    breaker.release(URL, probe)
+    with pytest.raises(CircuitOpen):
+        breaker.check(URL)
+        pass
+    time.sleep(0.02)
+    probe = breaker.check(URL)
+    breaker.success(URL)  # closed
+    breaker.release(URL, probe)
+    assert breaker.check(URL) is None
+    assert breaker.stats() == {}
+
+
+def test_breaker_disabled():
+    breaker = CircuitBreaker(threshold=0, cooldown=60)
+    breaker.failure(URL)
+    assert breaker.check(URL) is None
+
+
+class FakePage:
+    def __init__(self, pages: list):
+        pages.append(self)
+        self.closed = False
+        pass
+
+    async def close(self):
+        self.closed = True
+        pass
+
+
+class FakeContext:
+    def __init__(self):
+        self.pages = []
+        pass
+
+    async def new_page(self):
+        return FakePage(self.pages)
+
+
+def _render_page(monkeypatch, max_tries: int, ready_failures: int):
+    """Pages opened and ready waits (page, timeout) of a render_page() call
+    whose first `ready_failures` ready waits time out"""
+    render = sys.modules['page.render']
+    waits = []
+
+    class FakeLoader:
+        def __init__(self, p, url, options, deadline):
+            pass
+
+        async def load(self):
+            pass
+
+    async def fake_wait_ready(p, conditions, timeout):
+        waits.append((p, timeout))
+        if len(waits) <= ready_failures:
+            raise TimeoutError('ready conditions not satisfied')
+        return p
+
+    monkeypatch.setattr(render, 'PageLoader', FakeLoader)
+    monkeypatch.setattr(render, 'wait_ready', fake_wait_ready)
+    context = FakeContext()
+    options = RenderOptions.from_config(
+        max_tries=max_tries,
+        preload_pages=False,
+        ready_timeout=0
+    )
+    ready = asyncio.run(render.render_page(
+        context,
+        URL + '/ready-retry',
+        options,
+        Deadline(10000),
+        RetryState(max_tries, backoff_ms=0)
+    ))
+    assert ready is context.pages[-1] and not ready.closed
+    return context.pages, waits
+
+
+def test_render_page_reloads_on_the_last_try(monkeypatch):
+    pages, waits = _render_page(monkeypatch, max_tries=2, ready_failures=1)
+    assert len(pages) == 2 and pages[0].closed
+    # the wait leaves part of the budget for the retry
+    assert all(timeout <= 8000 for _, timeout in waits)
+
+
+def test_render_page_waits_again_then_reloads(monkeypatch):
+    pages, waits = _render_page(monkeypatch, max_tries=3, ready_failures=2)
+    assert len(pages) == 2
+    assert [p for p, _ in waits] == [pages[0], pages[0], pages[1]]
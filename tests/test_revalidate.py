@@ -0,0 +1,36 @@
+import asyncio
+import sys
+
+import page.render  # noqa: F401
+from page.options import RenderOptions
+
+render = sys.modules['page.render']
+
+
+def test_revalidation_joins_in_flight_render(monkeypatch):
+    calls = []
+
+    async def fake_render(url, *args):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return url
+
+    monkeypatch.setattr(render, '_render', fake_render)
+    options = RenderOptions.from_config()
+    device_conf = {'user_agent': 'ua'}
+    url = 'https://example.com/a'
+
+    async def main():
+        key = render._flight_key(url, options, 'desktop', device_conf)
+        foreground = asyncio.ensure_future(
+            render.render_flight.do(key, lambda: fake_render(url))
+        )
+        await asyncio.sleep(0)
+        render._revalidate(url, options, 'desktop', device_conf)
+        render._revalidate(url, options, 'desktop', device_conf)
+        await asyncio.gather(foreground, *render._revalidating.values())
+        pass
+
+    asyncio.run(main())
+    assert calls == [url]
+    assert not render._revalidating
@@ -0,0 +1,193 @@
+import asyncio
+
+import pytest
+from playwright.async_api import Error
+
+from page.subresources import SubresourceCache
+
+URL = 'https://example.com/app.js'
+CACHEABLE = {'cache-control': 'public, max-age=86400'}
+
+
+class FakeRequest:
+    def __init__(self, headers: dict = None, method: str = 'GET',
+                 resource_type: str = 'script'):
+        self.url = URL
+        self.method = method
+        self.resource_type = resource_type
+        self.headers = headers or {}
+        pass
+
+    async def all_headers(self):
+        return self.headers
+
+
+class FakeResponse:
+    def __init__(self, request: FakeRequest, headers: dict,
+                 status: int = 200, body: bytes = b'x' * 100):
+        self.request = request
+        self.status = status
+        self.headers = headers
+        self._body = body
+        pass
+
+    async def all_headers(self):
+        return self.headers
+
+    async def body(self):
+        return self._body
+
+
+class FakeRoute:
+    def __init__(self, request: FakeRequest, response_headers: dict = None,
+                 fail: bool = False):
+        self.request = request
+        self.response_headers = response_headers or CACHEABLE
+        self.fail = fail
+        self.actions = []
+        pass
+
+    async def fallback(self):
+        self.actions.append('fallback')
+        pass
+
+    async def fetch(self):
+        self.actions.append('fetch')
+        if self.fail:
+            raise Error('net::ERR_CONNECTION_RESET')
+        return FakeResponse(self.request, self.response_headers)
+
+    async def abort(self, error_code=None):
+        self.actions.append('abort')
+        pass
+
+    async def fulfill(self, status=None, headers=None, body=None):
+        self.actions.append(('fulfill', status, body))
+        pass
+
+
+@pytest.fixture
+def cache():
+    cache = SubresourceCache(
+        memory_bytes=1 << 20,
+        directory='',
+        disk_bytes=0,
+        max_entry_bytes=0
+    )
+    cache.min_max_age = 3600
+    cache.resource_types = frozenset(['script'])
+    cache.key_headers = ('accept',)
+    return cache
+
+
+@pytest.mark.parametrize('headers, credentials, ttl', [
+    ({'cache-control': 'max-age=86400'}, False, 86400),
+    ({'cache-control': 's-maxage=7200, max-age=60'}, False, 7200),
+    ({'cache-control': 'max-age=60'}, False, None),
+    ({'cache-control': 'max-age=31536000, immutable'}, False, 31536000),
+    ({'cache-control': 'immutable'}, False, 0),
+    ({}, False, None),
+    ({'cache-control': 'private, max-age=86400'}, False, None),
+    ({'cache-control': 'no-cache, max-age=86400'}, False, None),
+    ({'cache-control': 'max-age=86400', 'set-cookie': 'a=b'}, False, None),
+    ({'cache-control': 'max-age=86400', 'vary': 'Accept-Encoding, Accept'},
+     False, 86400),
+    ({'cache-control': 'max-age=86400', 'vary': 'user-agent'}, False, None),
+    ({'cache-control': 'max-age=86400'}, True, None),
+    ({'cache-control': 'public, max-age=86400'}, True, 86400),
+])
+def test_ttl(cache, headers, credentials, ttl):
+    assert cache.ttl(headers, credentials) == ttl
+
+
+def test_key(cache):
+    json_headers = {'accept': 'application/json'}
+    assert cache.key(URL, {}) == cache.key(URL, {'accept-language': 'fr'})
+    assert cache.key(URL, {}) != cache.key(URL, json_headers)
+    assert cache.key(URL, {}, [('x-tenant', 'a')]) != \
+        cache.key(URL, {}, [('x-tenant', 'b')])
+
+
+def test_intercepts_only_keys_seen_cacheable(cache):
+    async def main():
+        route = FakeRoute(FakeRequest())
+        await cache._handle(route, [])
+        assert route.actions == ['fallback']
+
+        await cache._observe(FakeResponse(route.request, CACHEABLE), [])
+        route = FakeRoute(FakeRequest())
+        await cache._handle(route, [])
+        assert route.actions == ['fetch', ('fulfill', 200, b'x' * 100)]
+
+        route = FakeRoute(FakeRequest())
+        await cache._handle(route, [])
+        assert route.actions == [('fulfill', 200, b'x' * 100)]
+
+        route = FakeRoute(FakeRequest())
+        await cache._handle(route, [('x-tenant', 'a')])
+        assert route.actions == ['fallback']
+        pass
+
+    asyncio.run(main())
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stores']) == (1, 1, 1)
+
+
+def test_forgets_keys_no_longer_cacheable(cache):
+    async def main():
+        request = FakeRequest()
+        await cache._observe(FakeResponse(request, CACHEABLE), [])
+        route = FakeRoute(request, {'cache-control': 'no-store'})
+        await cache._handle(route, [])
+        assert route.actions == ['fetch', ('fulfill', 200, b'x' * 100)]
+        route = FakeRoute(request)
+        await cache._handle(route, [])
+        assert route.actions == ['fallback']
+        pass
+
+    asyncio.run(main())
+
+
+def test_credentialed_responses_not_cached_unless_public(cache):
+    async def main():
+        request = FakeRequest({'cookie': 'session=1'})
+        await cache._observe(
+            FakeResponse(request, {'cache-control': 'max-age=86400'}),
+            []
+        )
+        route = FakeRoute(request)
+        await cache._handle(route, [])
+        assert route.actions == ['fallback']
+        await cache._observe(FakeResponse(request, CACHEABLE), [])
+        route = FakeRoute(request)
+        await cache._handle(route, [])
+        assert route.actions[0] == 'fetch'
+        pass
+
+    asyncio.run(main())
+
+
+def test_failed_fetch_is_not_sent_again(cache):
+    async def main():
+        request = FakeRequest()
+        await cache._observe(FakeResponse(request, CACHEABLE), [])
+        route = FakeRoute(request, fail=True)
+        await cache._handle(route, [])
+        assert route.actions == ['fetch', 'abort']
+        pass
+
+    asyncio.run(main())
+
+
+def test_skips_other_methods_and_types(cache):
+    async def main():
+        for request in (FakeRequest(method='POST'),
+                        FakeRequest(resource_type='image')):
+            await cache._observe(FakeResponse(request, CACHEABLE), [])
+            route = FakeRoute(request)
+            await cache._handle(route, [])
+            assert route.actions == ['fallback']
+            pass
+        pass
+
+    asyncio.run(main())
@@ -20,6 +20,8 @@ except ImportError:
 DEFAULT_NOT_PROVIDED = object()
 GET_MAX_DEPTH = 10
 
+_VAR_RE = re.compile(r'\${([a-zA-Z0-9_]+)}')
+
 logger = get_logger(__name__)
 
 
@@ -27,9 +29,13 @@ class Config:
 
     verbose = False
     config: dict
+    # bumped whenever the config changes, so values derived from it
+    # (e.g. compiled patterns) can tell they are stale
+    generation = 0
 
     def __init__(self):
         self.conffile = '%s/../../config.yaml' % os.path.dirname(os.path.realpath(__file__))  # noqa: E501
+        self._resolved = {}
         self.load_conf()
         pass
 
@@ -37,6 +43,12 @@ class Config:
         with open(self.conffile) as f:
             self.config = self._config_merge_down(yaml.load(f, Loader=Loader))
             pass
+        self._invalidate()
+        pass
+
+    def _invalidate(self):
+        self._resolved = {}
+        self.generation += 1
         pass
 
     def show_conf(self):
@@ -67,9 +79,22 @@ class Config:
                 f'Cannot change type of config variable {key}'
             )
         self.config[key] = val
+        self._invalidate()
         pass
 
     def get(self, key, def_val=DEFAULT_NOT_PROVIDED, depth=0):
+        """
+        Value of `key` (or of `key`_`conf_suffix`), with `${var}`
+        references substituted.
+
+        Resolved values are cached until the next set()/load_conf(), and
+        shared between callers: don't modify them.
+        """
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+
         if depth == GET_MAX_DEPTH:
             raise RecursionError(
                 f'Recursion depth limit of {depth} reached for config variable "{key}"'  # noqa: E501
@@ -84,13 +109,18 @@ class Config:
             self.config.get(key, def_val)
         )
 
-        if retval == DEFAULT_NOT_PROVIDED:
+        if retval is DEFAULT_NOT_PROVIDED:
             raise KeyError(f"missing config variable '{key}'")
 
-        return self._subst_vars(
+        if key_plus_suffix not in self.config and key not in self.config:
+            return retval  # the caller's default: not cached
+
+        retval = self._subst_vars(
             retval,
             depth
         )
+        self._resolved[key] = retval
+        return retval
 
     @classmethod
     def _get_override_envvar(cls, key: str, test_id_parts: [str]) -> Optional[str]:  # noqa: E501
@@ -181,17 +211,16 @@ class Config:
         def subst_vars(m):
             return self.get(m.group(1), DEFAULT_NOT_PROVIDED, depth + 1)
 
-        if t == str:
-            retval = re.sub(
-                r'\${([a-zA-Z0-9_]+)}',
+        if t == str and '${' in retval:
+            retval = _VAR_RE.sub(
                 subst_vars,
                 retval
             )
         if t == list:
             retval = [self._subst_vars(i, depth) for i in retval]
         if t == dict:
-            keys = list(retval.keys())
-            for k in keys:
-                retval[k] = self._subst_vars(retval[k], depth)
+            retval = {
+                k: self._subst_vars(v, depth) for k, v in retval.items()
+            }
         return retval
     pass